@@ -0,0 +1,92 @@
+import datetime
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# Порядок счетчиков в почасовом ведре (совпадает с колонками analytics_hourly)
+MESSAGES, CHATS_STARTED, CHATS_ENDED, SEARCHES, MATCHES, WAIT_TOTAL = range(6)
+
+
+def current_hour():
+    """Час в UTC, как и CURRENT_TIMESTAMP в SQLite: 'YYYY-MM-DD HH'"""
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H")
+
+
+class Analytics:
+    """Почасовые счетчики по районам. Копятся в памяти, в БД уходят раз в flush_interval,
+    так что событие стоит одну операцию со словарем"""
+
+    def __init__(self, db):
+        self.db = db
+        # (час, район) -> [messages, chats_started, chats_ended, searches, matches, wait_total]
+        self._counters = defaultdict(lambda: [0, 0, 0, 0, 0, 0.0])
+        # час -> кто был активен; (user_id, день) еще не записанные в user_activity_days
+        self._active = defaultdict(set)
+        self._unsaved = set()
+        # (час, район) -> сколько активных уже записано: в БД уходит только прирост
+        self._reported = defaultdict(int)
+        self._rolled_hour = None
+
+    def _add(self, district, index, value=1):
+        self._counters[(current_hour(), district or "—")][index] += value
+
+    def message(self, district):
+        self._add(district, MESSAGES)
+
+    def chat_started(self, district):
+        self._add(district, CHATS_STARTED)
+
+    def chat_ended(self, district):
+        self._add(district, CHATS_ENDED)
+
+    def search(self, district):
+        self._add(district, SEARCHES)
+
+    def matched(self, district, waited):
+        """Собеседник найден; waited — сколько секунд ждал тот, кто стоял в очереди"""
+        self._add(district, MATCHES)
+        self._add(district, WAIT_TOTAL, waited)
+
+    def active(self, user_id):
+        hour = current_hour()
+        users = self._active[hour]
+        if user_id not in users:
+            users.add(user_id)
+            self._unsaved.add((user_id, hour[:10]))
+
+    def flush(self):
+        """Сбрасывает накопленное в analytics_hourly и user_activity_days"""
+        counters, self._counters = self._counters, defaultdict(lambda: [0, 0, 0, 0, 0, 0.0])
+        if counters:
+            self.db.add_hourly_counters([(hour, district, *values) for (hour, district), values in counters.items()])
+
+        hour = current_hour()
+        if self._active:
+            districts = self.db.get_districts(set().union(*self._active.values()))
+            for active_hour, users in list(self._active.items()):
+                per_district = defaultdict(int)
+                for uid in users:
+                    per_district[districts.get(uid) or "—"] += 1
+                deltas = {}
+                for district in set(per_district) | {d for h, d in self._reported if h == active_hour}:
+                    delta = per_district[district] - self._reported[(active_hour, district)]
+                    if delta:
+                        deltas[district] = delta
+                        self._reported[(active_hour, district)] = per_district[district]
+                if deltas:
+                    self.db.add_hourly_active(active_hour, deltas)
+                # Закрытый час больше не меняется — его множество не нужно
+                if active_hour != hour:
+                    del self._active[active_hour]
+                    for key in [k for k in self._reported if k[0] == active_hour]:
+                        del self._reported[key]
+            if self._unsaved:
+                self.db.save_activity_days([(uid, day, districts.get(uid)) for uid, day in self._unsaved])
+                self._unsaved = set()
+
+        # Раз в час сворачиваем часы в дни и пересчитываем свежие когорты
+        if self._rolled_hour != hour:
+            self._rolled_hour = hour
+            self.db.rollup_analytics()
+            self.db.update_retention()
@@ -0,0 +1,65 @@
+import datetime
+
+LOG_FILTER_HELP = (
+    "🔎 <b>Фильтр журнала</b>\n\n"
+    "Напиши <code>все</code> или условия, каждое с новой строки:\n"
+    "• <code>админ: 123456</code>\n"
+    "• <code>действие: ban</code>\n"
+    "• <code>цель: 654321</code>\n"
+    "• <code>с: 2026-01-01</code>\n"
+    "• <code>по: 2026-01-31</code>"
+)
+
+_ID_KEYS = {"админ": "admin_id", "цель": "target_id"}
+_DATE_KEYS = {"с": "since", "по": "until"}
+
+
+def parse_log_filter(text):
+    """Разбирает фильтр журнала действий в dict; при ошибке бросает ValueError с текстом для админа"""
+    filters = {}
+    text = text.strip()
+    if text.lower() in ("все", "all"):
+        return filters
+
+    for line in text.splitlines():
+        line = line.strip(" •-")
+        if not line:
+            continue
+        key, _, value = line.partition(":")
+        key, value = key.strip().lower(), value.strip()
+        if not value:
+            raise ValueError(f"«{key}»: не указано значение")
+
+        if key in _ID_KEYS:
+            try:
+                filters[_ID_KEYS[key]] = int(value)
+            except ValueError:
+                raise ValueError(f"«{key}»: нужен числовой ID, а не «{value}»")
+        elif key in _DATE_KEYS:
+            try:
+                datetime.date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"«{key}»: дата в формате ГГГГ-ММ-ДД, а не «{value}»")
+            filters[_DATE_KEYS[key]] = value
+        elif key == "действие":
+            filters["action"] = value
+        else:
+            raise ValueError(f"Непонятное условие «{line}»")
+    return filters
+
+
+def describe_log_filter(filters):
+    if not filters:
+        return "все записи"
+    parts = []
+    if "admin_id" in filters:
+        parts.append(f"админ {filters['admin_id']}")
+    if "action" in filters:
+        parts.append(f"действие {filters['action']}")
+    if "target_id" in filters:
+        parts.append(f"цель {filters['target_id']}")
+    if "since" in filters:
+        parts.append(f"с {filters['since']}")
+    if "until" in filters:
+        parts.append(f"по {filters['until']}")
+    return ", ".join(parts)
@@ -0,0 +1,174 @@
+"""Микробенчмарки горячих путей бота.
+
+    python bench.py                        # все
+    python bench.py relay                  # только выбранные
+    python bench.py coordinator --users 4000 --shards 4
+
+Нагрузочный тест webhook — отдельно, webhook_loadtest.py"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import timeit
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import SendMessage
+from aiogram.types import Update
+
+import keyboards as kb
+from analytics import Analytics
+from cluster import Cluster, LocalBus, MatchCoordinator, COORDINATOR, shard_channel, shard_of, update_user_id
+from database import Database
+from sessions import SessionStore
+
+
+def report(name, call, number):
+    seconds = timeit.timeit(call, number=number)
+    print(f"{name:36} {seconds / number * 1e6:9.2f} мкс")
+
+
+def bench_relay(tmp):
+    """Подготовка одного сообщения к пересылке: чтения SQLite (как было) против ChatSession"""
+    db = Database(os.path.join(tmp, "relay.db"))
+    db.add_user(1, "Сибирский Волк", "🏛️ Центральный")
+    db.add_user(2, "Тюменский Лис", "🏛️ Центральный")
+    store = SessionStore()
+    store.open(1, 2, "1_2_0", "Сибирский Волк", "Тюменский Лис", "🏛️ Центральный",
+               nick1="Сибирский Волк", nick2="Тюменский Лис")
+    store.get(1).set_label(1, "Сибирский Волк")
+
+    def from_db():
+        # Отправитель, его бан, собеседник и премиум статус на каждое сообщение
+        user = db.get_user(1)
+        if not user or db.check_banned(1):
+            return None
+        partner = db.get_user(2)
+        db.get_referral(1)
+        return user["nickname"], partner["nickname"]
+
+    def from_session():
+        session = store.get(1)
+        if session is None or session.is_banned(1):
+            return None
+        return session.label_of(1), session.nick_of(session.partner_of(1))
+
+    report("сообщение: чтения SQLite", from_db, 2000)
+    report("сообщение: ChatSession", from_session, 200000)
+
+
+def bench_keyboards(tmp):
+    """Клавиатуры: сборка pydantic-моделей против общих объектов, сериализация разметки при отправке"""
+    bot = Bot("1:benchmark")
+    menu = kb.admin_menu()
+    plain, shared = AiohttpSession(), kb.SharedMarkupSession()
+    send_menu = SendMessage(chat_id=1, text="Меню", reply_markup=menu)
+
+    def build_admin_menu():
+        return kb._markup([[dict(text=b.text, callback_data=b.callback_data) for b in row]
+                           for row in menu.inline_keyboard])
+
+    report("admin_menu(), сборка заново", build_admin_menu, 2000)
+    report("admin_menu(), общий объект", kb.admin_menu, 2000)
+    report("rating_keyboard(), сборка заново", lambda: kb.rating_keyboard.__wrapped__(42), 2000)
+    report("rating_keyboard(), из кеша", lambda: kb.rating_keyboard(42), 2000)
+    report("model_dump_json(admin_menu)", menu.model_dump_json, 2000)
+    report("build_form_data, AiohttpSession", lambda: plain.build_form_data(bot, send_menu), 2000)
+    report("build_form_data, SharedMarkupSession", lambda: shared.build_form_data(bot, send_menu), 2000)
+
+
+def bench_router(tmp):
+    """Цена апдейта на роутере: модели aiogram и обратно (polling) против сырого JSON (webhook)"""
+    bot = Bot("1:benchmark")
+    body = json.dumps({"update_id": 1, "message": {
+        "message_id": 1, "date": 1700000000, "text": "Привет! Как дела?",
+        "chat": {"id": 42, "type": "private", "first_name": "Волк"},
+        "from": {"id": 42, "is_bot": False, "first_name": "Волк", "language_code": "ru"},
+    }})
+
+    def parsed():
+        update = Update.model_validate(json.loads(body), context={"bot": bot})
+        shard_of(update.message.from_user.id, 4)
+        return json.dumps({"op": "update", "update": update.model_dump(mode="json", exclude_none=True, by_alias=True)})
+
+    def raw():
+        update = json.loads(body)
+        shard_of(update_user_id(update), 4)
+        return json.dumps({"op": "update", "update": update})
+
+    report("апдейт на роутере, модели aiogram", parsed, 20000)
+    report("апдейт на роутере, сырой JSON", raw, 20000)
+
+
+def bench_coordinator(tmp, users=2000, shards=2):
+    """Пропускная способность координатора подбора пар на LocalBus: все процессы в одном"""
+    db = Database(os.path.join(tmp, "coordinator.db"))
+
+    async def run():
+        bus = LocalBus()
+        router = Cluster(bus, shards)
+        coordinator = MatchCoordinator(router, db, Analytics(db))
+        bus.subscribe(COORDINATOR, coordinator.handle)
+        workers = [Cluster(bus, shards, shard) for shard in range(shards)]
+        matched = asyncio.Event()
+        # matched уходит каждому из шардов пары (один раз, если оба на одном)
+        chats = set()
+
+        async def on_shard(message):
+            if message["op"] == "matched":
+                chats.add(message["chat_id"])
+                if len(chats) == users // 2:
+                    matched.set()
+
+        for shard in range(shards):
+            bus.subscribe(shard_channel(shard), on_shard)
+        for c in [router] + workers:
+            await c.start()
+
+        profiles = [dict(user_id=uid, nickname=f"user{uid}", district="Центральный", anon_mode=0, referrals=0)
+                    for uid in range(1, users + 1)]
+        started = time.perf_counter()
+        for user in profiles:
+            workers[shard_of(user["user_id"], shards)].enqueue(user, False)
+        await matched.wait()
+        elapsed = time.perf_counter() - started
+        for c in [router] + workers:
+            await c.stop()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    pairs = users // 2
+    print(f"{users} пользователей, {shards} шарда: {pairs} пар за {elapsed:.2f} с, "
+          f"{pairs / elapsed:.0f} пар/с, {users / elapsed:.0f} enqueue/с")
+
+
+BENCHES = {
+    "relay": bench_relay,
+    "keyboards": bench_keyboards,
+    "router": bench_router,
+    "coordinator": bench_coordinator,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", metavar="name", help=f"что мерить: {', '.join(BENCHES)}")
+    parser.add_argument("--users", type=int, default=2000, help="coordinator: пользователей в очереди")
+    parser.add_argument("--shards", type=int, default=2, help="coordinator: шардов")
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHES]
+    if unknown:
+        parser.error(f"неизвестный бенчмарк: {', '.join(unknown)}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in args.names or BENCHES:
+            print(f"— {name}")
+            if name == "coordinator":
+                bench_coordinator(tmp, args.users, args.shards)
+            else:
+                BENCHES[name](tmp)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,60 @@
+import argparse
 import asyncio
+import hashlib
 import logging
 import datetime
 import os
 import shutil
 import random
 import json
+import time
+import secrets
+import signal
+from contextlib import asynccontextmanager, suppress
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.types import InlineKeyboardButton, FSInputFile
 
-from config import BOT_TOKEN, ADMIN_IDS, TYUMEN_DISTRICTS, DEBUG
+from config import (BOT_TOKEN, ADMIN_IDS, TYUMEN_DISTRICTS, DEBUG, SNAPSHOT_FILE, SNAPSHOT_INTERVAL, FSM_STATE_TTL,
+                    CHAT_IDLE_TIMEOUT, QUEUE_TTL, AUX_DICT_LIMIT, AUX_DICT_TTL, CLEANUP_INTERVAL,
+                    ONLINE_FLUSH_INTERVAL, USER_COUNT_RECONCILE_INTERVAL,
+                    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST,
+                    MEDIA_GROUP_WINDOW, CHAT_ACTION_INTERVAL, FLOOD_BURST, FLOOD_RATE, FLOOD_WARN_AFTER, FLOOD_MUTE_AFTER,
+                    FLOOD_MUTE_SECONDS, FLOOD_FLAG_AFTER, BROADCAST_BATCH, BROADCAST_WORKERS,
+                    BROADCAST_PROGRESS_INTERVAL, BROADCAST_CHECKPOINT_EVERY, USERNAME_TTL, USERNAME_CONCURRENCY,
+                    ANALYTICS_FLUSH_INTERVAL, ADMIN_LOG_RETENTION_DAYS, ADMIN_LOG_ARCHIVE_INTERVAL,
+                    PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL, SCREEN_CACHE_SIZE, UPDATE_MODE,
+                    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET,
+                    CLUSTER_ROLE, CLUSTER_WORKERS, CLUSTER_SHARD, CLUSTER_REDIS_URL)
 from database import Database
+from fsm_storage import SQLiteStorage
+from locks import KeyedLock, ShardedLock
+from middlewares import (UserSerializeMiddleware, ReachabilityMiddleware, UsernameCaptureMiddleware,
+                         ActivityMiddleware)
+from analytics import Analytics
+from reachability import Reachability, ReachabilityRequestMiddleware
+from usernames import UsernameResolver
+from pagination import PAGE_PREFIX, fetch_page, page_keyboard, parse_page_data
+from sessions import SessionStore
+from cache import BoundedDict
+from online import OnlineCounter
+from relay import Relay
+from flood import FloodControl, FLOOD_OK, FLOOD_WARN, FLOOD_MUTE, FLOOD_FLAG
+from outbound import OutboundScheduler, OutboundMiddleware, send_priority, PRIORITY_CHAT
+from snapshot import save_snapshot, load_snapshot
+from broadcast import Broadcaster
+from segments import SEGMENT_HELP, parse_segment, describe_segment
+from audit import LOG_FILTER_HELP, parse_log_filter, describe_log_filter
+from menu import ProfileCache, Screens
+from cluster import (Cluster, RedisBus, ShardForwardMiddleware, ShardForwardWebhook, MatchCoordinator, COORDINATOR,
+                     shard_channel)
+from callbacks import (CallbackRouter, RateCallback, BlacklistAddCallback, BlacklistRemoveCallback,
+                       DistrictCallback, ChangeDistrictCallback, BanCallback, UnbanCallback)
 import keyboards as kb
 
 
@@ -26,9 +66,47 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+def parse_role():
+    """Роль процесса: ключи --role/--shard, по умолчанию из config"""
+    parser = argparse.ArgumentParser(description="ТюменьChat")
+    parser.add_argument("--role", choices=("single", "router", "worker"), default=CLUSTER_ROLE)
+    parser.add_argument("--shard", type=int, default=CLUSTER_SHARD)
+    args, _ = parser.parse_known_args()
+    if not 0 <= args.shard < CLUSTER_WORKERS:
+        parser.error(f"--shard должен быть от 0 до {CLUSTER_WORKERS - 1}")
+    return args.role, args.shard
+
+ROLE, SHARD = parse_role()
+# Связь с роутером и другими воркерами; None, когда бот работает одним процессом
+cluster = None
+if ROLE != "single":
+    cluster = Cluster(RedisBus(CLUSTER_REDIS_URL), CLUSTER_WORKERS, SHARD if ROLE == "worker" else None)
+
+
+bot = Bot(token=BOT_TOKEN, session=kb.SharedMarkupSession(),
+          default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+# Все отправки идут через общий планировщик с лимитами Telegram
+# Глобальный лимит Telegram общий на токен: в кластере он делится между роутером и воркерами
+outbound = OutboundScheduler(OUTBOUND_GLOBAL_RATE if cluster is None else OUTBOUND_GLOBAL_RATE / (CLUSTER_WORKERS + 1),
+                             OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+bot.session.middleware(OutboundMiddleware(outbound))
+fsm_storage = SQLiteStorage(ttl=FSM_STATE_TTL)
+dp = Dispatcher(storage=fsm_storage)
+if ROLE == "router":
+    # Роутер сам апдейты пользователей не обрабатывает: первым делом отдает их шарду
+    # (при webhook апдейт уходит шарду раньше, чем aiogram его разберет — см. webhook_app)
+    dp.update.outer_middleware(ShardForwardMiddleware(cluster))
 db = Database()
+# Кто заблокировал бота или удалил аккаунт: отмечается по ошибкам отправки,
+# снимается при любом новом апдейте от пользователя
+reachability = Reachability(db)
+bot.session.middleware(ReachabilityRequestMiddleware(reachability))
+dp.update.outer_middleware(ReachabilityMiddleware(reachability))
+usernames = UsernameResolver(bot, db, reachability, USERNAME_TTL, USERNAME_CONCURRENCY)
+dp.update.outer_middleware(UsernameCaptureMiddleware(usernames))
+# Почасовая аналитика: события копятся в памяти, в БД раз в ANALYTICS_FLUSH_INTERVAL
+analytics = Analytics(db)
+dp.update.outer_middleware(ActivityMiddleware(analytics))
 from aiogram.fsm.state import State, StatesGroup
 
 
@@ -39,70 +117,75 @@ class States(StatesGroup):
     changing_district = State()
     admin_broadcast = State()
     admin_broadcast_text = State()
+    admin_broadcast_segment = State()
     admin_get_user = State()
     admin_search_district = State()
     admin_search_messages = State()
     admin_view_chat = State()
     admin_ban_reason = State()
+    admin_logs_filter = State()
     
 
-waiting_users = []
-active_chats = {}
-chat_messages = {}
-user_last_message = {}
-search_mode = {}
-active_chat_ids = {}
-broadcast_data = {}
-ban_data = {}
-
-bot_stats = {
-    "total_messages": 0,
-    "total_chats": 0,
-    "active_chats": 0,
-    "online_users": 0,
-    "start_time": datetime.datetime.now(),
-}
-
+# user_id -> время постановки в очередь (dict: O(1) проверка и без дублей).
+# В кластере здесь только ждущие своего шарда, общая очередь у координатора
+waiting_users = {}
+# Чаты, закрытые другим шардом раньше, чем сюда дошло matched: их не открываем
+dropped_chats = BoundedDict(AUX_DICT_LIMIT, ttl=AUX_DICT_TTL)
+# У каждого воркера свой снимок: в нем только его пользователи
+if ROLE == "worker":
+    root, ext = os.path.splitext(SNAPSHOT_FILE)
+    snapshot_file = f"{root}.{SHARD}{ext}"
+else:
+    snapshot_file = SNAPSHOT_FILE
+os.makedirs(os.path.dirname(snapshot_file) or ".", exist_ok=True)
+# Активные чаты: оба собеседника указывают на один ChatSession
+sessions = SessionStore()
+# Онлайн по районам (очередь + чаты), в БД сбрасывается раз в ONLINE_FLUSH_INTERVAL
+online = OnlineCounter()
+chat_relay = Relay(bot, db, sessions, album_window=MEDIA_GROUP_WINDOW,
+                   action_interval=CHAT_ACTION_INTERVAL)
+flood = FloodControl(FLOOD_BURST, FLOOD_RATE, FLOOD_WARN_AFTER, FLOOD_MUTE_AFTER,
+                     FLOOD_MUTE_SECONDS, FLOOD_FLAG_AFTER)
+broadcaster = Broadcaster(bot, db, outbound, BROADCAST_BATCH, BROADCAST_WORKERS, BROADCAST_PROGRESS_INTERVAL,
+                          BROADCAST_CHECKPOINT_EVERY)
+# Незавершенные диалоги админов: ограничены по размеру и времени жизни
+broadcast_data = BoundedDict(AUX_DICT_LIMIT, ttl=AUX_DICT_TTL)
+ban_data = BoundedDict(AUX_DICT_LIMIT, ttl=AUX_DICT_TTL)
+# Токен из callback data -> текст поиска сообщений (сам текст в 64 байта не влезает)
+search_queries = BoundedDict(AUX_DICT_LIMIT, ttl=AUX_DICT_TTL)
+# То же для фильтров журнала действий
+log_filters = BoundedDict(AUX_DICT_LIMIT, ttl=AUX_DICT_TTL)
+# Все кнопки: callback data -> обработчик через таблицу маршрутов с замером времени
+callback_routes = CallbackRouter(ADMIN_IDS)
+# Профили для меню и последние показанные экраны: меню рисуется без БД и без лишних edit_text
+profiles = ProfileCache(db, PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+screens = Screens(SCREEN_CACHE_SIZE)
 
-REFERRAL_FILE = "data/referrals.json"
+# Апдейты одного пользователя обрабатываются по очереди,
+# а изменения очереди и пар защищены шардированными замками по user_id
+user_locks = KeyedLock()
+match_locks = ShardedLock()
+dp.update.outer_middleware(UserSerializeMiddleware(user_locks))
 
 
+# Старое хранилище рефералов: переносится в таблицу referrals при первом запуске
+REFERRAL_FILE = "data/referrals.json"
 
-def load_referral_data():
-    """Загружает данные рефералов из JSON файла"""
-    try:
-        
-        os.makedirs("data", exist_ok=True)
-        
-        if os.path.exists(REFERRAL_FILE):
-            with open(REFERRAL_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-                return {int(k): v for k, v in data.items()}
-        else:
-            
-            with open(REFERRAL_FILE, 'w', encoding='utf-8') as f:
-                json.dump({}, f, ensure_ascii=False, indent=2)
-            return {}
-    except Exception as e:
-        logger.error(f"Ошибка загрузки реферальных данных: {e}")
-        return {}
 
-def save_referral_data(data):
-    """Сохраняет данные рефералов в JSON файл"""
+def import_referral_file():
+    """Переносит referrals.json в БД (ее делят все процессы) и переименовывает файл"""
+    if not os.path.exists(REFERRAL_FILE):
+        return
     try:
-        
-        json_data = {str(k): v for k, v in data.items()}
-        with open(REFERRAL_FILE, 'w', encoding='utf-8') as f:
-            json.dump(json_data, f, ensure_ascii=False, indent=2)
-        return True
+        with open(REFERRAL_FILE, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        imported = db.import_referrals(data)
+        os.replace(REFERRAL_FILE, REFERRAL_FILE + ".imported")
+        logger.info(f"Рефералы перенесены в БД: {imported} из {len(data)}")
     except Exception as e:
-        logger.error(f"Ошибка сохранения реферальных данных: {e}")
-        return False
+        logger.error(f"Ошибка переноса реферальных данных: {e}")
 
 
-referral_stats = load_referral_data()
-
 PREMIUM_STICKERS = {
     2: "⭐",
     5: "💎",
@@ -114,11 +197,8 @@ PREMIUM_BADGES = {
     10: "Легенда",
 }
 
-def get_user_premium_status(user_id):
-    """Возвращает премиум статус пользователя"""
-    user_data = referral_stats.get(user_id, {})
-    count = user_data.get("count", 0)
-    
+def premium_status(count):
+    """Премиум стикер и подпись за count приглашенных"""
     sticker = ""
     badge = ""
     
@@ -133,42 +213,58 @@ def get_user_premium_status(user_id):
     
     return sticker, badge
 
+def get_user_premium_status(user_id):
+    """Возвращает премиум статус пользователя"""
+    return premium_status(db.get_referral(user_id)[0])
+
+def display_name(user_id, nickname, referrals=None):
+    """Ник с премиум стикером и подписью; referrals — число приглашенных, если уже известно"""
+    sticker, badge = get_user_premium_status(user_id) if referrals is None else premium_status(referrals)
+    name = f"{sticker} {nickname}" if sticker else nickname
+    if badge:
+        name += f" [{badge}]"
+    return name
+
+def sender_label(session, user_id, from_user):
+    """Подпись отправителя для пересылки; кешируется в сессии до смены профиля"""
+    if session.is_anon(user_id):
+        label = session.name_of(user_id)
+    else:
+        name = from_user.full_name or "Пользователь"
+        if from_user.username:
+            name += f" (@{from_user.username})"
+        label = display_name(user_id, name)
+    session.set_label(user_id, label)
+    return label
+
 def get_rating_multiplier(user_id):
     """Возвращает множитель рейтинга (1 или 2)"""
-    user_data = referral_stats.get(user_id, {})
-    count = user_data.get("count", 0)
+    count, _ = db.get_referral(user_id)
     return 2 if count >= 2 else 1
 
 def get_protection_count(user_id):
     """Возвращает количество доступных защит от дизлайков"""
-    user_data = referral_stats.get(user_id, {})
-    count = user_data.get("count", 0)
-    protections = count // 2
-    used = user_data.get("protections_used", 0)
-    return max(0, protections - used)
+    count, used = db.get_referral(user_id)
+    return max(0, count // 2 - used)
 
 def use_protection(user_id):
     """Использовать одну защиту (если есть)"""
-    if user_id not in referral_stats:
-        referral_stats[user_id] = {"count": 0, "protections_used": 0}
-    
-    available = get_protection_count(user_id)
-    if available > 0:
-        referral_stats[user_id]["protections_used"] = referral_stats[user_id].get("protections_used", 0) + 1
-        save_referral_data(referral_stats)  
-        return True
-    return False
+    return db.use_protection(user_id)
 
 def add_referral(referrer_id):
     """Добавляет реферала и сохраняет данные"""
-    if referrer_id not in referral_stats:
-        referral_stats[referrer_id] = {"count": 0, "protections_used": 0}
-    
-    referral_stats[referrer_id]["count"] += 1
-    save_referral_data(referral_stats) 
-    
-    
-    return referral_stats[referrer_id]["count"]
+    count = db.add_referral(referrer_id)
+    profile_changed(referrer_id, premium=True)
+    return count
+
+def refresh_premium(user_id):
+    """Премиум стикер мог смениться — обновим подпись в активном чате"""
+    session = sessions.get(user_id)
+    if session:
+        session.update(user_id, name=display_name(user_id, session.nick_of(user_id)))
+
+def percent_of(part, total):
+    return f"{part * 100 // total}%" if total else "—"
 
 def get_ending(number):
     """Для красивого склонения"""
@@ -197,60 +293,76 @@ def get_rating_level(rating):
     if rating >= 10: return "🤔 Гость"
     return "👎 Нарушитель"
 
+def username_suffix(user_id, username):
+    suffix = f" (@{username})" if username else ""
+    return f"{suffix} (недоступен)" if user_id in reachability else suffix
+
 async def get_username_for_admin(user_id):
     """Получает username пользователя для отображения в админке"""
-    try:
-        chat = await bot.get_chat(user_id)
-        if chat.username:
-            return f" (@{chat.username})"
-    except:
-        pass
-    return ""
+    return username_suffix(user_id, await usernames.resolve(user_id))
+
+async def get_usernames_for_admin(user_ids):
+    """То же для списка: один запрос к кешу и параллельные get_chat для промахов"""
+    names = await usernames.resolve_many(user_ids)
+    return {uid: username_suffix(uid, name) for uid, name in names.items()}
+
+def is_local(user_id):
+    """Пользователя обслуживает этот процесс (без кластера — всегда)"""
+    return cluster is None or cluster.is_local(user_id)
+
+def profile_changed(user_id, premium=False, **fields):
+    """Сбрасывает профиль из кеша и обновляет поля сессии (nick, name, anon, banned).
+    Если пользователь с другого шарда, то же самое делает и его шард"""
+    profiles.invalidate(user_id)
+    if fields:
+        sessions.update_user(user_id, **fields)
+    if premium:
+        refresh_premium(user_id)
+    if not is_local(user_id):
+        cluster.send_to_user(user_id, {"op": "profile", "user_id": user_id, "premium": premium, "fields": fields})
+
+def leave_queue(user_id):
+    """Убирает из очереди поиска; вызывается под match_locks. True, если пользователь ждал"""
+    if waiting_users.pop(user_id, None) is None:
+        return False
+    online.remove(user_id)
+    if cluster is not None:
+        cluster.cancel(user_id)
+    return True
+
+def chat_closed(session, user_id):
+    """Копию чата на шарде собеседника тоже пора закрыть"""
+    partner_id = session.partner_of(user_id)
+    if not is_local(partner_id):
+        cluster.send_to_user(partner_id, {"op": "closed", "chat_id": session.chat_id, "user_id": user_id})
+
+@asynccontextmanager
+async def hold_user_pair(user_id):
+    """Берет замки пользователя и его текущего собеседника, отдает partner_id"""
+    while True:
+        partner_id = sessions.partner_of(user_id)
+        async with match_locks.hold(user_id, partner_id):
+            if sessions.partner_of(user_id) == partner_id:
+                yield partner_id
+                return
 
 async def force_cleanup_user(user_id, db):
-    if user_id in waiting_users:
-        waiting_users.remove(user_id)
-        db.update_online_status(user_id, False)
-    
-    if user_id in active_chats:
-        pid = active_chats[user_id]
-        if pid in active_chats:
-            if pid in active_chat_ids:
-                db.end_chat(active_chat_ids[pid])
-                del active_chat_ids[pid]
-            db.update_online_status(pid, False)
-            del active_chats[pid]
-        if user_id in active_chat_ids:
-            db.end_chat(active_chat_ids[user_id])
-            del active_chat_ids[user_id]
-        del active_chats[user_id]
-    
-    if user_id in search_mode:
-        del search_mode[user_id]
-
-async def update_online_stats(db):
-    online_users = set(active_chats.keys()) | set(waiting_users)
-    online_by_district = {}
-    
-    for uid in online_users:
-        user = db.get_user(uid)
-        if user and not db.check_banned(uid):
-            district = user['district']
-            online_by_district[district] = online_by_district.get(district, 0) + 1
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('UPDATE district_stats SET online_now = 0')
-    for district, count in online_by_district.items():
-        cursor.execute('UPDATE district_stats SET online_now = ? WHERE district = ?', (count, district))
-    conn.commit()
-    conn.close()
-    
-    bot_stats["online_users"] = len(online_users)
-    return online_users, online_by_district
-
-async def show_main_menu(message, user_id):
-    user = db.get_user(user_id)
+    async with hold_user_pair(user_id) as pid:
+        leave_queue(user_id)
+        online.remove(user_id)
+        
+        session = sessions.close(user_id)
+        if session:
+            chat_closed(session, user_id)
+            db.end_chat(session.chat_id)
+            analytics.chat_ended(session.district)
+            online.remove(pid)
+            flood.release(user_id, time.monotonic())
+            flood.release(pid, time.monotonic())
+
+async def show_main_menu(message, user_id, edit=True):
+    """Главное меню; edit=False, когда message — сообщение пользователя (его не отредактировать)"""
+    user = profiles.get(user_id)
     if not user:
         return
     
@@ -258,18 +370,11 @@ async def show_main_menu(message, user_id):
     rating = user['rating'] or 50.0
     rating_level = get_rating_level(rating)
     
-    sticker, badge = get_user_premium_status(user_id)
+    ref_count = user['referrals']
+    sticker, badge = premium_status(ref_count)
     premium_text = f"{sticker} " if sticker else ""
     badge_text = f" | {badge}" if badge else ""
     
-    stats = db.get_district_stats()
-    online = 0
-    for s in stats:
-        if s['district'] == user['district']:
-            online = s['online_now']
-            break
-    
-    ref_count = referral_stats.get(user_id, {}).get("count", 0)
     ref_text = f"\n👥 Рефералов: {ref_count}" if ref_count > 0 else ""
     
     text = (
@@ -277,143 +382,161 @@ async def show_main_menu(message, user_id):
         f"👤 {premium_text}{user['nickname']}{badge_text}\n"
         f"🏘️ {user['district']}\n"
         f"{anon} | Рейтинг: {rating:.1f}% ({rating_level}){ref_text}\n"
-        f"📍 В районе онлайн: {online}"
+        f"📍 В районе онлайн: {online.get(user['district'])}"
     )
     
-    try:
-        await message.edit_text(text, reply_markup=kb.main_menu())
-    except:
-        await message.answer(text, reply_markup=kb.main_menu())
+    await screens.show(message, text, kb.main_menu(), edit=edit)
 
-async def create_chat(user1_id, user2_id, db, bot):
-    user1 = db.get_user(user1_id)
-    user2 = db.get_user(user2_id)
-    
-    if not user1 or not user2:
-        return False
-    
+def open_session(user1, user2, chat_uuid, chat_district):
+    """Пара в памяти процесса; в онлайн считаются только свои пользователи"""
+    session = sessions.open(
+        user1['user_id'], user2['user_id'], chat_uuid,
+        display_name(user1['user_id'], user1['nickname'], user1['referrals']),
+        display_name(user2['user_id'], user2['nickname'], user2['referrals']),
+        chat_district,
+        nick1=user1['nickname'], nick2=user2['nickname'],
+        anon1=bool(user1['anon_mode']), anon2=bool(user2['anon_mode'])
+    )
+    if session:
+        for user in (user1, user2):
+            if is_local(user['user_id']):
+                online.add(user['user_id'], user['district'])
+    return session
+
+def open_chat(user1, user2, db):
+    """Регистрирует пару. Вызывается под match_locks, без await внутри"""
+    user1_id = user1['user_id']
+    user2_id = user2['user_id']
     chat_uuid = f"{min(user1_id, user2_id)}_{max(user1_id, user2_id)}_{datetime.datetime.now().timestamp()}"
     chat_district = user1['district'] if user1['district'] == user2['district'] else 'разные районы'
     
-    db.create_chat(chat_uuid, user1_id, user2_id, user1['nickname'], user2['nickname'], chat_district)
-    
-    active_chats[user1_id] = user2_id
-    active_chats[user2_id] = user1_id
-    active_chat_ids[user1_id] = chat_uuid
-    active_chat_ids[user2_id] = chat_uuid
-    
-    bot_stats["total_chats"] += 1
-    bot_stats["active_chats"] = len(active_chats) // 2
-    
-    sticker1, badge1 = get_user_premium_status(user1_id)
-    sticker2, badge2 = get_user_premium_status(user2_id)
-    
-    name1 = f"{sticker1} {user1['nickname']}" if sticker1 else user1['nickname']
-    if badge1:
-        name1 += f" [{badge1}]"
+    session = open_session(user1, user2, chat_uuid, chat_district)
+    if session:
+        db.create_chat(chat_uuid, user1_id, user2_id, user1['nickname'], user2['nickname'], chat_district)
+        analytics.chat_started(chat_district)
+    return session
+
+def find_partner(user_id, user, same_district):
+    """Первый подходящий из очереди. Без await: вызывается под match_locks"""
+    for uid in list(waiting_users):
+        if (uid == user_id or uid in reachability or db.check_banned(uid)
+                or db.is_blocked(user_id, uid) or db.is_blocked(uid, user_id)):
+            continue
+        candidate = db.get_user(uid)
+        if candidate and (not same_district or candidate['district'] == user['district']):
+            return candidate
+    return None
+
+async def match_user(user_id, user, same_district=False):
+    """Атомарно забирает собеседника из очереди или ставит пользователя в очередь.
+    В кластере пару ищет координатор: пользователь встает в общую очередь, ответ придет в matched"""
+    await force_cleanup_user(user_id, db)
+    analytics.search(user['district'])
+    
+    if cluster is not None:
+        async with match_locks.hold(user_id):
+            waiting_users[user_id] = time.monotonic()
+            online.add(user_id, user['district'])
+            cluster.enqueue(user, same_district)
+        return None
+    
+    while True:
+        # Поиск и постановка в очередь идут без await между ними: двое, нажавшие
+        # «Поиск» одновременно, не встанут в очередь, не увидев друг друга
+        async with match_locks.hold(user_id):
+            partner = find_partner(user_id, user, same_district)
+            if partner is None:
+                waiting_users[user_id] = time.monotonic()
+                online.add(user_id, user['district'])
+                return None
+        
+        async with match_locks.hold(user_id, partner['user_id']):
+            # Пока брали замок собеседника, его мог забрать кто-то другой — ищем заново
+            since = waiting_users.pop(partner['user_id'], None)
+            if since is None:
+                continue
+            if open_chat(user, partner, db) is None:
+                waiting_users[partner['user_id']] = time.monotonic()
+                return None
+            analytics.matched(partner['district'], time.monotonic() - since)
+            return partner
+
+async def notify_matched(user, partner, session):
+    """Сообщает user, что собеседник найден"""
+    if user['district'] == partner['district']:
+        info = f"\n📍 Вы оба из {user['district']}!"
+    else:
+        info = f"\n📍 Ты из {user['district']}, собеседник из {partner['district']}"
     
-    name2 = f"{sticker2} {user2['nickname']}" if sticker2 else user2['nickname']
-    if badge2:
-        name2 += f" [{badge2}]"
+    await bot.send_message(
+        user['user_id'],
+        f"🔔 <b>Собеседник найден!</b>\n\n"
+        f"Ты общаешься с: {session.name_of(partner['user_id'])}{info}",
+        reply_markup=kb.chat_actions()
+    )
+
+async def create_chat(user1, user2, db, bot):
+    session = sessions.get(user1['user_id'])
+    if not session:
+        return False
     
     try:
-        if user1['district'] == user2['district']:
-            info1 = f"\n📍 Вы оба из {user1['district']}!"
-            info2 = f"\n📍 Вы оба из {user2['district']}!"
-        else:
-            info1 = f"\n📍 Ты из {user1['district']}, собеседник из {user2['district']}"
-            info2 = f"\n📍 Ты из {user2['district']}, собеседник из {user1['district']}"
-        
-        await bot.send_message(
-            user1_id,
-            f"🔔 <b>Собеседник найден!</b>\n\n"
-            f"Ты общаешься с: {name2}{info1}",
-            reply_markup=kb.chat_actions()
-        )
-        
-        await bot.send_message(
-            user2_id,
-            f"🔔 <b>Собеседник найден!</b>\n\n"
-            f"Ты общаешься с: {name1}{info2}",
-            reply_markup=kb.chat_actions()
-        )
+        await notify_matched(user1, user2, session)
+        await notify_matched(user2, user1, session)
     except Exception as e:
         logger.error(f"Error notifying users: {e}")
         return False
     
-    await update_online_stats(db)
     return True
 
-async def stop_chat(user_id, db, bot):
-    partner_id = active_chats.get(user_id)
-    if not partner_id:
-        return
+async def stop_chat(user_id, db, bot, idle=False):
+    async with hold_user_pair(user_id) as partner_id:
+        if not partner_id:
+            return False
+        
+        session = sessions.close(user_id)
+        chat_closed(session, user_id)
+        db.end_chat(session.chat_id)
+        analytics.chat_ended(session.district)
+        online.remove(user_id)
+        online.remove(partner_id)
+        flood.release(user_id, time.monotonic())
+        flood.release(partner_id, time.monotonic())
     
     user = db.get_user(user_id)
     partner = db.get_user(partner_id)
     
-    if user_id in active_chat_ids:
-        db.end_chat(active_chat_ids[user_id])
-    
-    if user_id in active_chats:
-        del active_chats[user_id]
-        db.update_online_status(user_id, False)
-    if partner_id in active_chats:
-        del active_chats[partner_id]
-        db.update_online_status(partner_id, False)
-    
-    if user_id in active_chat_ids:
-        del active_chat_ids[user_id]
-    if partner_id in active_chat_ids:
-        del active_chat_ids[partner_id]
-    
-    await update_online_stats(db)
-    
     try:
-        await bot.send_message(user_id, "✅ Чат завершен", reply_markup=kb.main_menu())
-        await bot.send_message(partner_id, "❌ Собеседник покинул чат", reply_markup=kb.main_menu())
+        if idle:
+            await bot.send_message(user_id, "⌛ Чат завершен из-за неактивности", reply_markup=kb.main_menu())
+            await bot.send_message(partner_id, "⌛ Чат завершен из-за неактивности", reply_markup=kb.main_menu())
+        else:
+            await bot.send_message(user_id, "✅ Чат завершен", reply_markup=kb.main_menu())
+            await bot.send_message(partner_id, "❌ Собеседник покинул чат", reply_markup=kb.main_menu())
     except:
         pass
     
     if user and not db.check_banned(user_id):
-        rating_keyboard1 = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="👍", callback_data=f"like_{partner_id}"),
-                InlineKeyboardButton(text="👎", callback_data=f"dislike_{partner_id}")
-            ],
-            [
-                InlineKeyboardButton(text="🚫 В ЧС", callback_data=f"blacklist_add_{partner_id}"),
-                InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_menu")
-            ]
-        ])
         try:
             await bot.send_message(
                 user_id,
                 f"👤 Как тебе общение с {partner['nickname']}?\nОцени собеседника:",
-                reply_markup=rating_keyboard1
+                reply_markup=kb.rating_keyboard(partner_id)
             )
         except:
             pass
     
     if partner and not db.check_banned(partner_id):
-        rating_keyboard2 = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="👍", callback_data=f"like_{user_id}"),
-                InlineKeyboardButton(text="👎", callback_data=f"dislike_{user_id}")
-            ],
-            [
-                InlineKeyboardButton(text="🚫 В ЧС", callback_data=f"blacklist_add_{user_id}"),
-                InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_menu")
-            ]
-        ])
         try:
             await bot.send_message(
                 partner_id,
                 f"👤 Как тебе общение с {user['nickname']}?\nОцени собеседника:",
-                reply_markup=rating_keyboard2
+                reply_markup=kb.rating_keyboard(user_id)
             )
         except:
             pass
+    
+    return True
 
 
 @dp.message(Command("start"))
@@ -437,7 +560,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
         await message.answer("❌ Вы заблокированы.")
         return
     
-    user = db.get_user(user_id)
+    user = profiles.get(user_id)
     if not user:
         nickname = generate_nickname()
         
@@ -484,7 +607,7 @@ async def cmd_start(message: types.Message, state: FSMContext):
     
     db.update_user_activity(user_id)
     db.update_daily_stats()
-    await show_main_menu(message, user_id)
+    await show_main_menu(message, user_id, edit=False)
 
 @dp.message(Command("admin"))
 async def cmd_admin(message: types.Message):
@@ -506,12 +629,12 @@ async def cmd_myid(message: types.Message):
 
 @dp.message(Command("online"))
 async def cmd_online(message: types.Message):
-    online_users, online_by_district = await update_online_stats(db)
+    online_by_district = online.by_district()
     
     text = "🟢 <b>Сейчас онлайн</b>\n\n"
-    text += f"👥 Всего: {len(online_users)} человек\n"
+    text += f"👥 Всего: {len(online)} человек\n"
     text += f"⏳ В очереди: {len(waiting_users)}\n"
-    text += f"💬 В чатах: {len(active_chats) // 2}\n\n"
+    text += f"💬 В чатах: {len(sessions)}\n\n"
     
     if online_by_district:
         text += "📊 <b>По районам:</b>\n"
@@ -525,17 +648,26 @@ async def cmd_fix_online(message: types.Message):
     if message.from_user.id not in ADMIN_IDS:
         return
     
-    online_users, online_by_district = await update_online_stats(db)
+    online.flush(db)
+    online_by_district = online.by_district()
+    count_changes = db.reconcile_user_counts()
     
     report = "✅ Онлайн статистика исправлена!\n\n"
-    report += f"👥 Всего онлайн: {len(online_users)}\n"
+    report += f"👥 Всего онлайн: {len(online)}\n"
     report += f"⏳ В очереди: {len(waiting_users)}\n"
-    report += f"💬 В чатах: {len(active_chats) // 2}\n\n"
+    report += f"💬 В чатах: {len(sessions)}\n\n"
     report += "📊 По районам:\n"
     
     for district, count in sorted(online_by_district.items(), key=lambda x: x[1], reverse=True):
         report += f"  {district}: {count} чел.\n"
     
+    if count_changes:
+        report += "\n🔧 Исправлено число пользователей:\n"
+        for district, (old, new) in count_changes.items():
+            report += f"  {district}: {old} → {new}\n"
+    else:
+        report += "\n👥 Число пользователей по районам сходится"
+    
     await message.answer(report)
 
 @dp.message(Command("cancel"))
@@ -556,10 +688,10 @@ async def cmd_ref(message: types.Message):
         await message.answer("❌ Вы заблокированы.")
         return
     
-    count = referral_stats.get(user_id, {}).get("count", 0)
-    protections = get_protection_count(user_id)
-    multiplier = get_rating_multiplier(user_id)
-    sticker, badge = get_user_premium_status(user_id)
+    count, used = db.get_referral(user_id)
+    protections = max(0, count // 2 - used)
+    multiplier = 2 if count >= 2 else 1
+    sticker, badge = premium_status(count)
     
     bot_username = (await bot.me()).username
     ref_link = f"https://t.me/{bot_username}?start=ref_{user_id}"
@@ -600,419 +732,437 @@ async def cmd_ref(message: types.Message):
         need = next_level - count
         text += f"\n\n⬆️ До следующего уровня: {need} приглашени{get_ending(need)}"
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔗 Поделиться ссылкой", url=f"https://t.me/share/url?url={ref_link}&text=Присоединяйся%20к%20ТюменьChat!")]
-    ])
-    
-    await message.answer(text, reply_markup=keyboard, disable_web_page_preview=True)
+    await message.answer(text, reply_markup=kb.referral_keyboard(ref_link), disable_web_page_preview=True)
+
+
+async def safe_edit(callback, text, reply_markup=None):
+    return await screens.show(callback.message, text, reply_markup)
 
 
 @dp.callback_query()
 async def handle_all_callbacks(callback: types.CallbackQuery, state: FSMContext):
-    data = callback.data
+    if not await callback_routes.dispatch(callback, state):
+        await callback.answer()
+
+
+@callback_routes.route("admin_stats", admin=True)
+async def cb_admin_stats(callback, state):
+    stats = db.get_all_stats()
+    text = f"👑 <b>Статистика</b>\n\n👥 Всего: {stats['total_users']}\n🚫 Бан: {stats['banned_users']}\n🟢 Онлайн: {len(online)}\n⏳ В очереди: {len(waiting_users)}\n💬 В чатах: {len(sessions)}\n🧠 Память на сессию: {sessions.memory_per_session()} байт\n📵 Недоступны: {len(reachability)}"
+    out = outbound.stats()
+    text += (
+        f"\n\n📮 <b>Исходящие</b>\n"
+        f"В очереди: {out['queued']} (чаты {out['queued_chat']}, уведомления {out['queued_notify']}, рассылка {out['queued_bulk']})\n"
+        f"Отправлено: {out['sent']} | Ошибок: {out['failed']} | Повторов: {out['retries']}\n"
+        f"Задержка: {out['latency_avg_ms']} мс (макс {out['latency_max_ms']} мс)"
+    )
+    routes = callback_routes.stats(top=5)
+    if routes:
+        text += "\n\n🖱 <b>Кнопки</b> <i>(вызовы | ошибки | сред. | макс.)</i>\n"
+        for key, calls, errors, avg_ms, max_ms in routes:
+            text += f"{key}: {calls} | {errors} | {avg_ms} мс | {max_ms} мс\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@callback_routes.route("admin_online", admin=True)
+async def cb_admin_online(callback, state):
+    online_users = set(sessions.users()) | set(waiting_users)
+    if not online_users:
+        text = "👥 Сейчас нет онлайн пользователей"
+    else:
+        text = "👥 <b>Онлайн пользователи</b>\n\n"
+        page = list(online_users)[:20]
+        names = await get_usernames_for_admin(page)
+        for uid in page:
+            user = db.get_user(uid)
+            if user:
+                status = "💬 в чате" if uid in sessions else "⏳ в очереди"
+                text += f"• {user['nickname']}{names[uid]} - {status}\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@callback_routes.route("admin_districts", admin=True)
+async def cb_admin_districts(callback, state):
+    stats = db.get_district_stats()
+    text = "🗺️ <b>Статистика по районам</b>\n\n"
+    for s in stats:
+        text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {online.get(s['district'])}\n\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@callback_routes.route("admin_bans", admin=True)
+async def cb_admin_bans(callback, state):
+    text, markup = await render_bans_page()
+    await safe_edit(callback, text, markup)
+
+@callback_routes.route("admin_analytics", admin=True)
+async def cb_admin_analytics(callback, state):
+    days = db.get_analytics_daily(7)
+    text = "📊 <b>Аналитика за 7 дней</b>\n\n"
+    if not days:
+        text += "Данных пока нет"
+    for d in days:
+        wait = f"{d['wait_total'] / d['matches']:.0f} с" if d['matches'] else "—"
+        text += (f"<b>{d['day']}:</b> 👥{d['active_users']} 💬{d['messages']} "
+                 f"🔍{d['searches']} 🤝{d['chats_started']} ⏱{wait}\n")
+    if days:
+        text += f"\n<b>Районы за {days[0]['day']}:</b>\n"
+        for r in db.get_analytics_districts(days[0]['day'])[:10]:
+            text += f"{r['district']}: 👥{r['active_users']} 💬{r['messages']} 🤝{r['chats_started']}\n"
+    await safe_edit(callback, text, kb.analytics_menu())
+
+@callback_routes.route("admin_analytics_weekly", admin=True)
+async def cb_admin_analytics_weekly(callback, state):
+    weeks = db.get_analytics_weekly(4)
+    text = "📅 <b>Аналитика по неделям</b>\n\n"
+    if not weeks:
+        text += "Данных пока нет"
+    for w in weeks:
+        wait = f"{w['wait_total'] / w['matches']:.0f} с" if w['matches'] else "—"
+        text += (f"<b>с {w['since']}:</b> 👥{w['active_users']} 💬{w['messages']} "
+                 f"🤝{w['chats_started']} ⏱{wait}\n")
+    await safe_edit(callback, text, kb.analytics_menu())
+
+@callback_routes.route("admin_retention", admin=True)
+async def cb_admin_retention(callback, state):
+    cohorts = db.get_retention(14)
+    text = "👥 <b>Удержание по когортам</b>\n<i>дата регистрации: размер | D1 | D7 | D30</i>\n\n"
+    if not cohorts:
+        text += "Данных пока нет"
+    for c in cohorts:
+        d1, d7, d30 = (percent_of(c[k], c['size']) for k in ('d1', 'd7', 'd30'))
+        text += f"<b>{c['cohort']}:</b> {c['size']} | {d1} | {d7} | {d30}\n"
+    await safe_edit(callback, text, kb.analytics_menu())
+
+@callback_routes.route("admin_daily", admin=True)
+async def cb_admin_daily(callback, state):
+    stats = db.get_all_stats()
+    text = "📈 <b>Статистика по дням</b>\n\n"
+    for d in stats['daily_stats'][:7]:
+        text += f"<b>{d['date']}:</b> 💬{d['total_messages']} 👥+{d['new_users']}\n"
+    await safe_edit(callback, text, kb.admin_menu())
+
+@callback_routes.route("admin_logs", admin=True)
+async def cb_admin_logs(callback, state):
+    text, markup = await render_logs_page("-")
+    await safe_edit(callback, text, markup)
+
+@callback_routes.route("admin_logs_filter", admin=True)
+async def cb_admin_logs_filter(callback, state):
+    await safe_edit(callback, LOG_FILTER_HELP, kb.cancel_keyboard())
+    await state.set_state(States.admin_logs_filter)
+
+@callback_routes.route("admin_getdb", admin=True)
+async def cb_admin_getdb(callback, state):
+    await callback.answer("⏳ Загружаю...")
+    try:
+        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        backup = f"tyumenchat_backup_{ts}.db"
+        shutil.copy2(db.db_name, backup)
+        await callback.message.answer_document(FSInputFile(backup), caption=f"📊 База данных на {ts}")
+        os.remove(backup)
+    except Exception as e:
+        await callback.message.answer(f"❌ Ошибка: {e}")
+    return True
+
+@callback_routes.route("admin_menu", admin=True)
+async def cb_admin_menu(callback, state):
+    await safe_edit(callback, "👑 Панель администратора", kb.admin_menu())
+
+@callback_routes.route("admin_search_district", admin=True)
+async def cb_admin_search_district(callback, state):
+    districts = "\n".join([f"• {d}" for d in TYUMEN_DISTRICTS])
+    await safe_edit(callback, f"🔍 Введи название района:\n\n{districts}", kb.cancel_keyboard())
+    await state.set_state(States.admin_search_district)
+
+@callback_routes.route("admin_search_messages", admin=True)
+async def cb_admin_search_messages(callback, state):
+    await safe_edit(callback, "🔍 Введи текст для поиска:", kb.cancel_keyboard())
+    await state.set_state(States.admin_search_messages)
+
+@callback_routes.route("admin_user_details", admin=True)
+async def cb_admin_user_details(callback, state):
+    await safe_edit(callback, "👤 Введи ID или ник:", kb.cancel_keyboard())
+    await state.set_state(States.admin_get_user)
+
+@callback_routes.route("admin_broadcast", admin=True)
+async def cb_admin_broadcast(callback, state):
+    broadcast_data[callback.from_user.id] = {"step": "waiting_text"}
+    await safe_edit(
+        callback,
+        "📤 <b>Рассылка сообщений</b>\n\n"
+        "Введи текст для рассылки (можно использовать HTML-разметку):\n"
+        "• <b>жирный</b>\n"
+        "• <i>курсив</i>\n"
+        "• <code>моноширинный</code>",
+        kb.cancel_keyboard()
+    )
+    await state.set_state(States.admin_broadcast_text)
+
+@callback_routes.route(PAGE_PREFIX.rstrip(":"), admin=True)
+async def cb_admin_page(callback, state):
+    text, markup = await render_admin_page(callback.data)
+    await safe_edit(callback, text, markup)
+
+@callback_routes.route("menu")
+async def cb_menu(callback, state):
+    await show_main_menu(callback.message, callback.from_user.id)
+
+@callback_routes.route("ref_menu")
+async def cb_ref_menu(callback, state):
+    await cmd_ref(callback.message)
+
+@callback_routes.route("search_menu")
+async def cb_search_menu(callback, state):
+    await safe_edit(callback, "🔍 <b>Поиск собеседника</b>\n\nВыбери режим:", kb.search_menu_keyboard())
+
+async def start_search(callback, same_district):
     user_id = callback.from_user.id
+    user = db.get_user(user_id)
+    if not user:
+        await safe_edit(callback, "❌ Сначала нажми /start", kb.main_menu())
+        return
     
-    print(f"\n🔴 НАЖАТА КНОПКА: {data}")
-    
-    async def safe_edit(text, reply_markup=None):
-        try:
-            await callback.message.edit_text(text, reply_markup=reply_markup)
-        except:
-            await callback.message.answer(text, reply_markup=reply_markup)
-    
-    
-    if data.startswith('admin_'):
-        if user_id not in ADMIN_IDS:
-            await callback.answer("❌ Нет доступа", show_alert=True)
-            return
-        
-        if data == "admin_stats":
-            stats = db.get_all_stats()
-            online = len(set(active_chats.keys()) | set(waiting_users))
-            text = f"👑 <b>Статистика</b>\n\n👥 Всего: {stats['total_users']}\n🚫 Бан: {stats['banned_users']}\n🟢 Онлайн: {online}\n⏳ В очереди: {len(waiting_users)}\n💬 В чатах: {len(active_chats)//2}"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_online":
-            online = set(active_chats.keys()) | set(waiting_users)
-            if not online:
-                text = "👥 Сейчас нет онлайн пользователей"
-            else:
-                text = "👥 <b>Онлайн пользователи</b>\n\n"
-                for uid in list(online)[:20]:
-                    user = db.get_user(uid)
-                    if user:
-                        status = "💬 в чате" if uid in active_chats else "⏳ в очереди"
-                        username = await get_username_for_admin(uid)
-                        text += f"• {user['nickname']}{username} - {status}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_districts":
-            stats = db.get_district_stats()
-            text = "🗺️ <b>Статистика по районам</b>\n\n"
-            for s in stats:
-                text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {s['online_now']}\n\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_bans":
-            banned = db.get_banned_users()
-            if not banned:
-                text = "✅ Нет забаненных пользователей"
-            else:
-                text = "🔨 <b>Забаненные пользователи</b>\n\n"
-                for u in banned[:20]:
-                    username = await get_username_for_admin(u['user_id'])
-                    text += f"• {u['nickname']}{username} (ID: {u['user_id']})\n"
-                    if u['ban_reason']:
-                        text += f"  Причина: {u['ban_reason']}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_daily":
-            stats = db.get_all_stats()
-            text = "📈 <b>Статистика по дням</b>\n\n"
-            for d in stats['daily_stats'][:7]:
-                text += f"<b>{d['date']}:</b> 💬{d['total_messages']} 👥+{d['new_users']}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_logs":
-            logs = db.get_admin_logs(20)
-            if not logs:
-                text = "📋 Логов нет"
-            else:
-                text = "📋 <b>Последние действия</b>\n\n"
-                for log in logs:
-                    admin = db.get_user(log['admin_id'])
-                    name = admin['nickname'] if admin else str(log['admin_id'])
-                    username = await get_username_for_admin(log['admin_id'])
-                    text += f"• {log['timestamp'][:16]} {name}{username}: {log['action']}\n"
-            await safe_edit(text, kb.admin_menu())
-        
-        elif data == "admin_getdb":
-            await callback.answer("⏳ Загружаю...")
-            try:
-                ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-                backup = f"tyumenchat_backup_{ts}.db"
-                shutil.copy2(db.db_name, backup)
-                await callback.message.answer_document(FSInputFile(backup), caption=f"📊 База данных на {ts}")
-                os.remove(backup)
-            except Exception as e:
-                await callback.message.answer(f"❌ Ошибка: {e}")
-        
-        elif data == "admin_menu":
-            await safe_edit("👑 Панель администратора", kb.admin_menu())
-        
-        elif data == "admin_search_district":
-            districts = "\n".join([f"• {d}" for d in TYUMEN_DISTRICTS])
-            await safe_edit(f"🔍 Введи название района:\n\n{districts}", kb.cancel_keyboard())
-            await state.set_state(States.admin_search_district)
-        
-        elif data == "admin_search_messages":
-            await safe_edit("🔍 Введи текст для поиска:", kb.cancel_keyboard())
-            await state.set_state(States.admin_search_messages)
-        
-        elif data == "admin_user_details":
-            await safe_edit("👤 Введи ID или ник:", kb.cancel_keyboard())
-            await state.set_state(States.admin_get_user)
-        
-        elif data == "admin_broadcast":
-            broadcast_data[user_id] = {"step": "waiting_text"}
-            await safe_edit(
-                "📤 <b>Рассылка сообщений</b>\n\n"
-                "Введи текст для рассылки (можно использовать HTML-разметку):\n"
-                "• <b>жирный</b>\n"
-                "• <i>курсив</i>\n"
-                "• <code>моноширинный</code>",
-                kb.cancel_keyboard()
-            )
-            await state.set_state(States.admin_broadcast_text)
-    
+    partner = await match_user(user_id, user, same_district=same_district)
+    if partner:
+        await create_chat(user, partner, db, bot)
+        await safe_edit(callback, "✅ Собеседник найден! Чат создан.")
+    else:
+        where = f" в районе {user['district']}" if same_district else ""
+        await safe_edit(
+            callback,
+            f"⏳ <b>Поиск собеседника{where}...</b>\n\nПозиция в очереди: {len(waiting_users)}",
+            kb.cancel_search_keyboard()
+        )
+
+@callback_routes.route("search_all")
+async def cb_search_all(callback, state):
+    await start_search(callback, same_district=False)
+
+@callback_routes.route("search_district")
+async def cb_search_district(callback, state):
+    await start_search(callback, same_district=True)
+
+@callback_routes.route("cancel_search")
+async def cb_cancel_search(callback, state):
+    user_id = callback.from_user.id
+    async with match_locks.hold(user_id):
+        leave_queue(user_id)
+    await safe_edit(callback, "❌ Поиск отменен", kb.main_menu())
+    await state.clear()
+
+@callback_routes.route("districts_menu")
+async def cb_districts_menu(callback, state):
+    stats = db.get_district_stats()
+    text = "🗺️ <b>Районы Тюмени</b>\n\n"
+    for s in stats:
+        text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {online.get(s['district'])}\n\n"
+    await safe_edit(callback, text, kb.districts_keyboard())
+
+@callback_routes.route(DistrictCallback)
+async def cb_district(callback, state, callback_data: DistrictCallback):
+    user_id = callback.from_user.id
+    district = TYUMEN_DISTRICTS[callback_data.index - 1]
+    st = await state.get_data()
     
-    elif data == "menu":
+    if st.get('new_user'):
+        db.add_user(user_id, st['nickname'], district)
+        await state.clear()
         await show_main_menu(callback.message, user_id)
+    else:
+        user = profiles.get(user_id)
+        if user:
+            db.update_user_district(user_id, district)
+            profiles.invalidate(user_id)
+            online.move(user_id, district)
+            await callback.answer("✅ Район изменен")
+            await show_main_menu(callback.message, user_id)
+            return True
+
+@callback_routes.route("top_rating")
+async def cb_top_rating(callback, state):
+    top = db.get_top_users(10)
+    if not top:
+        await safe_edit(callback, "🏆 Пока нет данных для рейтинга", kb.main_menu())
+    else:
+        text = "🏆 <b>Топ 10 пользователей</b>\n\n"
+        for i, u in enumerate(top, 1):
+            medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
+            text += f"{medal} {u['nickname']} ({u['district']})\n"
+            text += f"   👍 {u['likes']} | 👎 {u['dislikes']} | Рейтинг: {u['rating']:.1f}%\n\n"
+        await safe_edit(callback, text, kb.main_menu())
+
+def settings_text(user):
+    anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
+    return f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
+
+@callback_routes.route("settings")
+async def cb_settings(callback, state):
+    user = profiles.get(callback.from_user.id)
+    if user:
+        await safe_edit(callback, settings_text(user), kb.settings_menu())
+
+@callback_routes.route("change_nick")
+async def cb_change_nick(callback, state):
+    await safe_edit(callback, "✏️ Введи новый ник (до 20 символов):", kb.cancel_keyboard())
+    await state.set_state(States.changing_nick)
+
+@callback_routes.route("change_district")
+async def cb_change_district(callback, state):
+    await safe_edit(callback, "🏘️ Выбери новый район:", kb.change_district_keyboard())
+
+@callback_routes.route(ChangeDistrictCallback)
+async def cb_change_district_to(callback, state, callback_data: ChangeDistrictCallback):
+    user_id = callback.from_user.id
+    district = TYUMEN_DISTRICTS[callback_data.index - 1]
+    db.update_user_district(user_id, district)
+    profiles.invalidate(user_id)
+    online.move(user_id, district)
+    await callback.answer("✅ Район изменен")
+    await safe_edit(callback, settings_text(profiles.get(user_id)), kb.settings_menu())
+    return True
+
+@callback_routes.route("toggle_anon")
+async def cb_toggle_anon(callback, state):
+    user_id = callback.from_user.id
+    db.toggle_anon_mode(user_id)
+    profiles.invalidate(user_id)
+    user = profiles.get(user_id)
+    sessions.update_user(user_id, anon=bool(user['anon_mode']))
+    await safe_edit(callback, settings_text(user), kb.settings_menu())
+
+@callback_routes.route("blacklist")
+async def cb_blacklist(callback, state):
+    bl = db.get_blacklist(callback.from_user.id)
+    text = f"🚫 <b>Черный список</b>\n\nВсего заблокировано: {len(bl)}"
+    await safe_edit(callback, text, kb.blacklist_menu())
+
+async def show_blacklist_page(callback, empty_text):
+    bl = db.get_blacklist(callback.from_user.id)
+    if not bl:
+        await safe_edit(callback, empty_text, kb.blacklist_menu())
+        return
     
-    elif data == "ref_menu":
-        await cmd_ref(callback.message)
+    await safe_edit(
+        callback,
+        "🚫 <b>Черный список:</b>\n\nНажми на пользователя, чтобы удалить:",
+        kb.blacklist_keyboard(tuple((b['blocked_id'], b['nickname']) for b in bl))
+    )
+
+@callback_routes.route("show_blacklist")
+async def cb_show_blacklist(callback, state):
+    await show_blacklist_page(callback, "📋 Твой черный список пуст")
+
+@callback_routes.route(BlacklistRemoveCallback)
+async def cb_blacklist_remove(callback, state, callback_data: BlacklistRemoveCallback):
+    db.remove_from_blacklist(callback.from_user.id, callback_data.user_id)
+    await callback.answer("✅ Пользователь удален из ЧС")
+    await show_blacklist_page(callback, "📋 Черный список пуст")
+    return True
+
+@callback_routes.route(BlacklistAddCallback)
+async def cb_blacklist_add(callback, state, callback_data: BlacklistAddCallback):
+    user_id = callback.from_user.id
+    if user_id == callback_data.user_id:
+        await callback.answer("❌ Нельзя добавить себя в ЧС", show_alert=True)
+    else:
+        db.add_to_blacklist(user_id, callback_data.user_id)
+        await callback.answer("✅ Пользователь добавлен в ЧС")
+        await safe_edit(callback, "✅ Пользователь добавлен в черный список", kb.main_menu())
+    return True
+
+@callback_routes.route("stop")
+async def cb_stop(callback, state):
+    user_id = callback.from_user.id
+    if user_id in sessions:
+        await stop_chat(user_id, db, bot)
+        await safe_edit(callback, "✅ Чат завершен", kb.main_menu())
+    else:
+        async with match_locks.hold(user_id):
+            removed = leave_queue(user_id)
+        if removed:
+            await safe_edit(callback, "✅ Ты удален из очереди поиска", kb.main_menu())
+        else:
+            await callback.answer("❌ Ты не в чате", show_alert=True)
+            return True
+
+@callback_routes.route(RateCallback)
+async def cb_rate(callback, state, callback_data: RateCallback):
+    user_id = callback.from_user.id
+    partner_id = callback_data.partner_id
     
-    elif data == "search_menu":
-        await safe_edit("🔍 <b>Поиск собеседника</b>\n\nВыбери режим:", kb.search_menu_keyboard())
+    if db.check_banned(user_id):
+        await callback.answer("❌ Вы заблокированы", show_alert=True)
+        return True
     
-    elif data == "search_all":
-        user = db.get_user(user_id)
-        if not user:
-            await safe_edit("❌ Сначала нажми /start", kb.main_menu())
-        else:
-            await force_cleanup_user(user_id, db)
-            
-            partner_id = None
-            for uid in waiting_users:
-                if uid != user_id and not db.check_banned(uid) and not db.is_blocked(user_id, uid) and not db.is_blocked(uid, user_id):
-                    partner_id = uid
-                    break
-            
-            if partner_id:
-                waiting_users.remove(partner_id)
-                await create_chat(user_id, partner_id, db, bot)
-                await safe_edit("✅ Собеседник найден! Чат создан.")
-            else:
-                db.update_online_status(user_id, True)
-                if user_id not in waiting_users:
-                    waiting_users.append(user_id)
-                
-                await update_online_stats(db)
-                await safe_edit(
-                    f"⏳ <b>Поиск собеседника...</b>\n\nПозиция в очереди: {len(waiting_users)}",
-                    InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="❌ Отменить поиск", callback_data="cancel_search")]
-                    ])
-                )
+    partner = profiles.get(partner_id)
+    if not partner:
+        await callback.answer("❌ Собеседник не найден", show_alert=True)
+        return True
     
-    elif data == "search_district":
-        user = db.get_user(user_id)
-        if not user:
-            await safe_edit("❌ Сначала нажми /start", kb.main_menu())
-        else:
-            await force_cleanup_user(user_id, db)
-            
-            partner_id = None
-            for uid in waiting_users:
-                partner = db.get_user(uid)
-                if partner and uid != user_id and partner['district'] == user['district'] and not db.check_banned(uid) and not db.is_blocked(user_id, uid) and not db.is_blocked(uid, user_id):
-                    partner_id = uid
-                    break
-            
-            if partner_id:
-                waiting_users.remove(partner_id)
-                await create_chat(user_id, partner_id, db, bot)
-                await safe_edit("✅ Собеседник найден! Чат создан.")
-            else:
-                db.update_online_status(user_id, True)
-                if user_id not in waiting_users:
-                    waiting_users.append(user_id)
-                
-                await update_online_stats(db)
-                await safe_edit(
-                    f"⏳ <b>Поиск собеседника в районе {user['district']}...</b>\n\nПозиция в очереди: {len(waiting_users)}",
-                    InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton(text="❌ Отменить поиск", callback_data="cancel_search")]
-                    ])
-                )
+    user = profiles.get(user_id)
+    if not user:
+        await callback.answer("❌ Ошибка", show_alert=True)
+        return True
     
-    elif data == "cancel_search":
-        if user_id in waiting_users:
-            waiting_users.remove(user_id)
-            db.update_online_status(user_id, False)
-            await update_online_stats(db)
-        await safe_edit("❌ Поиск отменен", kb.main_menu())
-        await state.clear()
+    is_like = (callback_data.action == "like")
+    answered = False
     
-    elif data == "districts_menu":
-        stats = db.get_district_stats()
-        text = "🗺️ <b>Районы Тюмени</b>\n\n"
-        for s in stats:
-            text += f"{s['district']}\n   👥 {s['user_count']} | 🟢 {s['online_now']}\n\n"
-        await safe_edit(text, kb.districts_keyboard())
-    
-    elif data.startswith("district_"):
-        idx = int(data.split("_")[1]) - 1
-        district = TYUMEN_DISTRICTS[idx]
-        st = await state.get_data()
-        
-        if st.get('new_user'):
-            db.add_user(user_id, st['nickname'], district)
-            await state.clear()
-            await show_main_menu(callback.message, user_id)
-        else:
-            user = db.get_user(user_id)
-            if user:
-                db.update_user_district(user_id, district)
-                await callback.answer("✅ Район изменен")
-                await show_main_menu(callback.message, user_id)
-    
-    elif data == "top_rating":
-        top = db.get_top_users(10)
-        if not top:
-            await safe_edit("🏆 Пока нет данных для рейтинга", kb.main_menu())
-        else:
-            text = "🏆 <b>Топ 10 пользователей</b>\n\n"
-            for i, u in enumerate(top, 1):
-                medal = "🥇" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else f"{i}."
-                text += f"{medal} {u['nickname']} ({u['district']})\n"
-                text += f"   👍 {u['likes']} | 👎 {u['dislikes']} | Рейтинг: {u['rating']:.1f}%\n\n"
-            await safe_edit(text, kb.main_menu())
-    
-    elif data == "settings":
-        user = db.get_user(user_id)
-        if user:
-            anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
-            text = f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
-            await safe_edit(text, kb.settings_menu())
-    
-    elif data == "change_nick":
-        await safe_edit("✏️ Введи новый ник (до 20 символов):", kb.cancel_keyboard())
-        await state.set_state(States.changing_nick)
-    
-    elif data == "change_district":
-        await safe_edit("🏘️ Выбери новый район:", kb.change_district_keyboard())
-    
-    elif data.startswith("change_district_"):
-        idx = int(data.split("_")[2]) - 1
-        district = TYUMEN_DISTRICTS[idx]
-        db.update_user_district(user_id, district)
-        await callback.answer("✅ Район изменен")
-        user = db.get_user(user_id)
-        anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
-        text = f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
-        await safe_edit(text, kb.settings_menu())
-    
-    elif data == "toggle_anon":
-        db.toggle_anon_mode(user_id)
-        user = db.get_user(user_id)
-        anon = "🕵️ Вкл" if user['anon_mode'] else "👁️ Выкл"
-        text = f"⚙️ <b>Настройки</b>\n\n👤 {user['nickname']}\n🏘️ {user['district']}\n{anon}"
-        await safe_edit(text, kb.settings_menu())
-    
-    elif data == "blacklist":
-        bl = db.get_blacklist(user_id)
-        text = f"🚫 <b>Черный список</b>\n\nВсего заблокировано: {len(bl)}"
-        await safe_edit(text, kb.blacklist_menu())
-    
-    elif data == "show_blacklist":
-        bl = db.get_blacklist(user_id)
-        if not bl:
-            await safe_edit("📋 Твой черный список пуст", kb.blacklist_menu())
+    if is_like:
+        multiplier = get_rating_multiplier(user_id)
+        for _ in range(multiplier):
+            db.update_rating(partner_id, True)
+    else:
+        if use_protection(partner_id):
+            db.update_rating(partner_id, False)
+            await callback.answer(f"🛡️ Сработала защита! Осталось: {get_protection_count(partner_id)}", show_alert=True)
+            answered = True
         else:
-            keyboard = []
-            for b in bl:
-                keyboard.append([InlineKeyboardButton(
-                    text=f"❌ {b['nickname']}",
-                    callback_data=f"blacklist_remove_{b['blocked_id']}"
-                )])
-            keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="blacklist")])
-            await safe_edit(
-                "🚫 <b>Черный список:</b>\n\nНажми на пользователя, чтобы удалить:",
-                InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
+            db.update_rating(partner_id, False)
     
-    elif data.startswith("blacklist_remove_"):
-        tid = int(data.replace("blacklist_remove_", ""))
-        db.remove_from_blacklist(user_id, tid)
-        await callback.answer("✅ Пользователь удален из ЧС")
-        bl = db.get_blacklist(user_id)
-        if not bl:
-            await safe_edit("📋 Черный список пуст", kb.blacklist_menu())
-        else:
-            keyboard = []
-            for b in bl:
-                keyboard.append([InlineKeyboardButton(
-                    text=f"❌ {b['nickname']}",
-                    callback_data=f"blacklist_remove_{b['blocked_id']}"
-                )])
-            keyboard.append([InlineKeyboardButton(text="◀️ Назад", callback_data="blacklist")])
-            await safe_edit(
-                "🚫 <b>Черный список:</b>\n\nНажми на пользователя, чтобы удалить:",
-                InlineKeyboardMarkup(inline_keyboard=keyboard)
-            )
+    profile_changed(partner_id)
+    updated_partner = profiles.get(partner_id)
+    new_rating = updated_partner['rating'] if updated_partner else 50.0
     
-    elif data.startswith("blacklist_add_"):
-        tid = int(data.replace("blacklist_add_", ""))
-        if user_id == tid:
-            await callback.answer("❌ Нельзя добавить себя в ЧС", show_alert=True)
-        else:
-            db.add_to_blacklist(user_id, tid)
-            await callback.answer("✅ Пользователь добавлен в ЧС")
-            await safe_edit("✅ Пользователь добавлен в черный список", kb.main_menu())
-    
-    elif data == "stop":
-        if user_id in active_chats:
-            partner_id = active_chats[user_id]
-            await stop_chat(user_id, db, bot)
-            await safe_edit("✅ Чат завершен", kb.main_menu())
-        elif user_id in waiting_users:
-            waiting_users.remove(user_id)
-            db.update_online_status(user_id, False)
-            await update_online_stats(db)
-            await safe_edit("✅ Ты удален из очереди поиска", kb.main_menu())
-        else:
-            await callback.answer("❌ Ты не в чате", show_alert=True)
+    sticker, badge = get_user_premium_status(partner_id)
+    partner_name = f"{sticker} {partner['nickname']}" if sticker else partner['nickname']
     
-    elif data.startswith('like_') or data.startswith('dislike_'):
-        parts = data.split('_')
-        action = parts[0]
-        partner_id = int(parts[1])
-        
-        if db.check_banned(user_id):
-            await callback.answer("❌ Вы заблокированы", show_alert=True)
-            return
-        
-        partner = db.get_user(partner_id)
-        if not partner:
-            await callback.answer("❌ Собеседник не найден", show_alert=True)
-            return
-        
-        user = db.get_user(user_id)
-        if not user:
-            await callback.answer("❌ Ошибка", show_alert=True)
-            return
-        
-        is_like = (action == "like")
-        
-        if is_like:
-            multiplier = get_rating_multiplier(user_id)
-            for _ in range(multiplier):
-                db.update_rating(partner_id, True)
-        else:
-            if get_protection_count(partner_id) > 0:
-                use_protection(partner_id)
-                db.update_rating(partner_id, False)
-                await callback.answer(f"🛡️ Сработала защита! Осталось: {get_protection_count(partner_id)}", show_alert=True)
-            else:
-                db.update_rating(partner_id, False)
-        
-        updated_partner = db.get_user(partner_id)
-        new_rating = updated_partner['rating'] if updated_partner else 50.0
-        
-        sticker, badge = get_user_premium_status(partner_id)
-        partner_name = f"{sticker} {partner['nickname']}" if sticker else partner['nickname']
-        
-        if is_like:
-            text = f"👍 Ты поставил лайк пользователю {partner_name}!\n\n"
-            text += f"Теперь его рейтинг: {new_rating:.1f}%"
-            
-            try:
-                await bot.send_message(
-                    partner_id,
-                    f"👍 {user['nickname']} оценил(а) тебя положительно!\n"
-                    f"Твой текущий рейтинг: {new_rating:.1f}%"
-                )
-            except:
-                pass
-        else:
-            text = f"👎 Ты поставил дизлайк пользователю {partner_name}.\n\n"
-            text += f"Теперь его рейтинг: {new_rating:.1f}%"
+    if is_like:
+        text = f"👍 Ты поставил лайк пользователю {partner_name}!\n\n"
+        text += f"Теперь его рейтинг: {new_rating:.1f}%"
         
-        await safe_edit(text, kb.main_menu())
-        
-        if db.check_banned(partner_id):
-            try:
-                await bot.send_message(
-                    partner_id,
-                    "🚫 Вы были заблокированы из-за большого количества дизлайков.\n"
-                    "Обратитесь к администратору для разблокировки."
-                )
-            except:
-                pass
-        
-        await callback.answer()
+        try:
+            await bot.send_message(
+                partner_id,
+                f"👍 {user['nickname']} оценил(а) тебя положительно!\n"
+                f"Твой текущий рейтинг: {new_rating:.1f}%"
+            )
+        except:
+            pass
+    else:
+        text = f"👎 Ты поставил дизлайк пользователю {partner_name}.\n\n"
+        text += f"Теперь его рейтинг: {new_rating:.1f}%"
     
-    elif data == "cancel":
-        user_id = callback.from_user.id
-        if user_id in broadcast_data:
-            del broadcast_data[user_id]
-        if user_id in ban_data:
-            del ban_data[user_id]
-        await state.clear()
-        await show_main_menu(callback.message, user_id)
+    await safe_edit(callback, text, kb.main_menu())
     
-    await callback.answer()
+    if db.check_banned(partner_id):
+        profile_changed(partner_id, banned=True)
+        try:
+            await bot.send_message(
+                partner_id,
+                "🚫 Вы были заблокированы из-за большого количества дизлайков.\n"
+                "Обратитесь к администратору для разблокировки."
+            )
+        except:
+            pass
+    return answered
+
+@callback_routes.route("cancel")
+async def cb_cancel(callback, state):
+    user_id = callback.from_user.id
+    if user_id in broadcast_data:
+        del broadcast_data[user_id]
+    if user_id in ban_data:
+        del ban_data[user_id]
+    await state.clear()
+    await show_main_menu(callback.message, user_id)
 
 
 @dp.message(States.admin_broadcast_text)
@@ -1029,122 +1179,214 @@ async def process_admin_broadcast_text(message: types.Message, state: FSMContext
         await message.answer("❌ Текст не может быть пустым", reply_markup=kb.cancel_keyboard())
         return
     
-    broadcast_data[admin_id] = broadcast_text
+    broadcast_data[admin_id] = {"text": broadcast_text}
+    await message.answer(SEGMENT_HELP, reply_markup=kb.cancel_keyboard())
+    await state.set_state(States.admin_broadcast_segment)
+
+@dp.message(States.admin_broadcast_segment)
+async def process_admin_broadcast_segment(message: types.Message, state: FSMContext):
+    admin_id = message.from_user.id
     
-    confirm_keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Отправить всем", callback_data="broadcast_confirm_send"),
-            InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_confirm_cancel")
-        ]
-    ])
+    if admin_id not in ADMIN_IDS:
+        await state.clear()
+        return
+    
+    draft = broadcast_data.get(admin_id)
+    if not draft:
+        await state.clear()
+        await message.answer("❌ Ошибка: текст не найден", reply_markup=kb.admin_menu())
+        return
+    
+    try:
+        segment = parse_segment(message.text or "", TYUMEN_DISTRICTS)
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{SEGMENT_HELP}", reply_markup=kb.cancel_keyboard())
+        return
     
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT COUNT(*) FROM users')
-    total_users = cursor.fetchone()[0]
-    cursor.execute('SELECT COUNT(*) FROM ratings WHERE banned = 1')
-    banned_users = cursor.fetchone()[0]
-    conn.close()
+    audience = describe_segment(segment)
+    draft["segment"] = segment
+    total = db.count_broadcast_recipients(segment)
     
     await message.answer(
         f"📤 <b>Подтверждение рассылки</b>\n\n"
-        f"Текст:\n{broadcast_text}\n\n"
-        f"👥 Всего пользователей: {total_users}\n"
-        f"🚫 Забаненных (не получат): {banned_users}\n"
-        f"✅ Получат: {total_users - banned_users}\n\n"
+        f"Текст:\n{draft['text']}\n\n"
+        f"🎯 Аудитория: {audience}\n"
+        f"✅ Получат: {total} (забаненные исключены)\n\n"
         f"Отправить?",
-        reply_markup=confirm_keyboard
+        reply_markup=kb.broadcast_confirm_keyboard()
     )
     
     await state.clear()
 
-@dp.callback_query(lambda c: c.data == "broadcast_confirm_send")
-async def broadcast_confirm_send(callback: types.CallbackQuery):
+@callback_routes.route("broadcast_confirm_send", admin=True)
+async def broadcast_confirm_send(callback: types.CallbackQuery, state: FSMContext):
     admin_id = callback.from_user.id
+    draft = broadcast_data.get(admin_id)
     
-    if admin_id not in ADMIN_IDS:
-        await callback.answer("❌ Нет доступа", show_alert=True)
-        return
-    
-    broadcast_text = broadcast_data.get(admin_id)
-    
-    if not broadcast_text:
+    if not draft or "segment" not in draft:
         await callback.message.edit_text("❌ Ошибка: текст не найден", reply_markup=kb.admin_menu())
         return
     
-    await callback.message.edit_text("⏳ Начинаю рассылку... Это может занять некоторое время.")
-    
-    conn = db.get_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id FROM users')
-    users = cursor.fetchall()
-    conn.close()
-    
-    sent = 0
-    failed = 0
-    banned_skipped = 0
-    
-    status_message = await callback.message.answer("📊 Прогресс: 0%")
-    
-    for i, (uid,) in enumerate(users):
-        if db.check_banned(uid):
-            banned_skipped += 1
-            continue
-        
-        try:
-            await bot.send_message(
-                uid, 
-                f"📢 <b>Рассылка от администрации</b>\n\n{broadcast_text}",
-                parse_mode=ParseMode.HTML
-            )
-            sent += 1
-        except Exception as e:
-            failed += 1
-            logger.error(f"Ошибка отправки пользователю {uid}: {e}")
-        
-        if i % 10 == 0:
-            progress = int((i + 1) / len(users) * 100)
-            try:
-                await status_message.edit_text(f"📊 Прогресс: {progress}%")
-            except:
-                pass
-        
-        await asyncio.sleep(0.05)
-    
-    try:
-        await status_message.delete()
-    except:
-        pass
-    
-    db.log_admin_action(
-        admin_id, 
-        "broadcast", 
-        details=f"Отправлено: {sent}, Ошибок: {failed}, Пропущено (бан): {banned_skipped}"
+    status_message = await callback.message.edit_text(
+        "⏳ Рассылка запущена. Прогресс будет обновляться здесь, по окончании придет отчет."
     )
-    
-    result_text = (
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"📨 Отправлено: {sent}\n"
-        f"❌ Ошибок: {failed}\n"
-        f"🚫 Пропущено (забанены): {banned_skipped}"
+    job_id = db.create_broadcast(
+        admin_id, draft["text"], db.count_broadcast_recipients(draft["segment"]),
+        status_message.chat.id, status_message.message_id, draft["segment"]
     )
-    
-    await callback.message.answer(result_text, reply_markup=kb.admin_menu())
+    if cluster is None:
+        broadcaster.start(job_id)
+    else:
+        # Рассылки ведет роутер: задача уже в БД, ему нужен только ее номер
+        cluster.send(COORDINATOR, {"op": "broadcast", "job_id": job_id})
     
     if admin_id in broadcast_data:
         del broadcast_data[admin_id]
-    
-    await callback.answer()
 
-@dp.callback_query(lambda c: c.data == "broadcast_confirm_cancel")
-async def broadcast_confirm_cancel(callback: types.CallbackQuery):
+@callback_routes.route("broadcast_confirm_cancel")
+async def broadcast_confirm_cancel(callback: types.CallbackQuery, state: FSMContext):
     admin_id = callback.from_user.id
     
     if admin_id in broadcast_data:
         del broadcast_data[admin_id]
     
     await callback.message.edit_text("❌ Рассылка отменена", reply_markup=kb.admin_menu())
-    await callback.answer()
+
+
+# Размеры страниц в списках админки (с запасом под лимит в 4096 символов)
+DISTRICT_PAGE_SIZE = 10
+BANS_PAGE_SIZE = 15
+SEARCH_PAGE_SIZE = 10
+LOGS_PAGE_SIZE = 15
+
+
+async def render_district_page(index, key=None, direction="n"):
+    district = TYUMEN_DISTRICTS[index]
+    page = fetch_page(
+        lambda k, forward, limit: db.get_users_by_district(district, k, forward, limit),
+        key, direction, DISTRICT_PAGE_SIZE, lambda u: (u['id'],)
+    )
+    if not page.rows and key is None:
+        return f"👥 В районе {district} пока нет пользователей", kb.admin_menu()
+    
+    total = next((s['user_count'] for s in db.get_district_stats() if s['district'] == district), 0)
+    text = f"🏘️ <b>Район: {district}</b>\n\n"
+    text += f"👥 Всего пользователей: {total}\n"
+    text += f"🟢 Сейчас онлайн: {online.get(district)}\n\n"
+    text += f"<b>Список пользователей:</b>\n\n"
+    
+    names = await get_usernames_for_admin([user[0] for user in page.rows])
+    for user in page.rows:
+        last_active = user[3][:16] if user[3] else "никогда"
+        status = "🚫 БАН" if user[9] else "✅"
+        is_online = "🟢" if user[0] in online else "⚫"
+        
+        text += f"{is_online} <b>{user[1]}{names[user[0]]}</b> {status}\n"
+        text += f"   🆔 <code>{user[0]}</code>\n"
+        text += f"   🕐 {last_active} | 💬 {user[4]} чатов\n"
+        text += f"   👍 {user[6] or 0} | 👎 {user[7] or 0} | Рейтинг: {user[8] or 50:.1f}%\n\n"
+    
+    return text, page_keyboard("d", index, page)
+
+async def render_bans_page(key=None, direction="n"):
+    page = fetch_page(db.get_banned_users, key, direction, BANS_PAGE_SIZE,
+                      lambda u: (u['ban_date'], u['user_id']))
+    if not page.rows and key is None:
+        return "✅ Нет забаненных пользователей", kb.admin_menu()
+    
+    text = "🔨 <b>Забаненные пользователи</b>\n\n"
+    names = await get_usernames_for_admin([u['user_id'] for u in page.rows])
+    for u in page.rows:
+        text += f"• {u['nickname']}{names[u['user_id']]} (ID: {u['user_id']})\n"
+        if u['ban_reason']:
+            text += f"  Причина: {u['ban_reason']}\n"
+    return text, page_keyboard("b", "-", page)
+
+async def render_search_page(token, key=None, direction="n"):
+    search_text = search_queries.get(token)
+    if search_text is None:
+        return "⌛ Поиск устарел, повтори запрос", kb.admin_menu()
+    
+    page = fetch_page(
+        lambda k, forward, limit: db.search_messages(search_text, k, forward, limit),
+        key, direction, SEARCH_PAGE_SIZE, lambda m: (m['id'],)
+    )
+    if not page.rows and key is None:
+        return f"❌ Сообщения с текстом '{search_text}' не найдены", kb.admin_menu()
+    
+    text = f"🔍 <b>Сообщения с текстом '{search_text}':</b>\n\n"
+    for msg in page.rows:
+        sent_at = msg['timestamp'][:16] if msg['timestamp'] else "неизвестно"
+        msg_text = msg['message_text']
+        if msg_text and len(msg_text) > 50:
+            msg_text = msg_text[:50] + "..."
+        
+        text += f"📅 {sent_at}\n"
+        text += f"👤 {msg['from_nick']} → {msg['to_nick']}\n"
+        text += f"💬 {msg_text}\n\n"
+    return text, page_keyboard("m", token, page)
+
+async def render_logs_page(token, key=None, direction="n"):
+    """Журнал действий; token "-" — без фильтра, иначе ключ в log_filters"""
+    filters = {} if token == "-" else log_filters.get(token)
+    if filters is None:
+        return "⌛ Фильтр устарел, задай его заново", kb.admin_menu()
+    
+    page = fetch_page(
+        lambda k, forward, limit: db.get_admin_logs(filters, k, forward, limit),
+        key, direction, LOGS_PAGE_SIZE, lambda log: (log['timestamp'], log['id'])
+    )
+    filter_button = [[InlineKeyboardButton(text="🔎 Фильтр", callback_data="admin_logs_filter")]]
+    if not page.rows and key is None:
+        return f"📋 Логов нет ({describe_log_filter(filters)})", page_keyboard("l", token, page, extra=filter_button)
+    
+    text = f"📋 <b>Действия админов</b> — {describe_log_filter(filters)}\n\n"
+    names = await get_usernames_for_admin(
+        {log['admin_id'] for log in page.rows} | {log['target_id'] for log in page.rows if log['target_id']}
+    )
+    for log in page.rows:
+        admin = log['admin_nick'] or str(log['admin_id'])
+        text += f"• {log['timestamp'][:16]} {admin}{names[log['admin_id']]}: {log['action']}"
+        if log['target_id']:
+            target = log['target_nick'] or str(log['target_id'])
+            text += f" → {target}{names[log['target_id']]}"
+        text += "\n"
+        if log['details']:
+            text += f"   {log['details'][:80]}\n"
+    return text, page_keyboard("l", token, page, extra=filter_button)
+
+async def render_admin_page(data):
+    """Страница по callback data кнопок ◀️/▶️"""
+    view, arg, direction, key = parse_page_data(data)
+    if view == "d":
+        return await render_district_page(int(arg), key, direction)
+    if view == "b":
+        return await render_bans_page(key, direction)
+    if view == "l":
+        return await render_logs_page(arg, key, direction)
+    return await render_search_page(arg, key, direction)
+
+@dp.message(States.admin_logs_filter)
+async def process_admin_logs_filter(message: types.Message, state: FSMContext):
+    admin_id = message.from_user.id
+    
+    if admin_id not in ADMIN_IDS:
+        await state.clear()
+        return
+    
+    try:
+        filters = parse_log_filter(message.text or "")
+    except ValueError as e:
+        await message.answer(f"❌ {e}\n\n{LOG_FILTER_HELP}", reply_markup=kb.cancel_keyboard())
+        return
+    
+    token = "-"
+    if filters:
+        token = secrets.token_urlsafe(6)
+        log_filters[token] = filters
+    text, markup = await render_logs_page(token)
+    await message.answer(text, reply_markup=markup)
+    await state.clear()
 
 @dp.message(States.admin_search_district)
 async def process_admin_search_district(message: types.Message, state: FSMContext):
@@ -1178,40 +1420,8 @@ async def process_admin_search_district(message: types.Message, state: FSMContex
         )
         return
     
-    district = matching_districts[0]
-    users = db.get_users_by_district(district)
-    
-    if not users:
-        await message.answer(
-            f"👥 В районе {district} пока нет пользователей",
-            reply_markup=kb.admin_menu()
-        )
-        await state.clear()
-        return
-    
-    online_users = set(active_chats.keys()) | set(waiting_users)
-    
-    text = f"🏘️ <b>Район: {district}</b>\n\n"
-    text += f"👥 Всего пользователей: {len(users)}\n"
-    text += f"🟢 Сейчас онлайн: {len([u for u in users if u[0] in online_users])}\n\n"
-    text += f"<b>Список пользователей:</b>\n\n"
-    
-    for user in users[:30]:
-        last_active = user[3][:16] if user[3] else "никогда"
-        status = "🚫 БАН" if user[9] else "✅"
-        online = "🟢" if user[0] in online_users else "⚫"
-        
-        username = await get_username_for_admin(user[0])
-        
-        text += f"{online} <b>{user[1]}{username}</b> {status}\n"
-        text += f"   🆔 <code>{user[0]}</code>\n"
-        text += f"   🕐 {last_active} | 💬 {user[4]} чатов\n"
-        text += f"   👍 {user[6] or 0} | 👎 {user[7] or 0} | Рейтинг: {user[8] or 50:.1f}%\n\n"
-    
-    if len(users) > 30:
-        text += f"... и ещё {len(users) - 30} пользователей"
-    
-    await message.answer(text, reply_markup=kb.admin_menu())
+    text, markup = await render_district_page(TYUMEN_DISTRICTS.index(matching_districts[0]))
+    await message.answer(text, reply_markup=markup)
     await state.clear()
 
 @dp.message(States.admin_search_messages)
@@ -1231,48 +1441,10 @@ async def process_admin_search_messages(message: types.Message, state: FSMContex
         )
         return
     
-    status_msg = await message.answer("🔍 Ищу сообщения...")
-    
-    messages = db.search_messages(search_text, limit=30)
-    
-    await status_msg.delete()
-    
-    if not messages:
-        await message.answer(
-            f"❌ Сообщения с текстом '{search_text}' не найдены",
-            reply_markup=kb.admin_menu()
-        )
-        await state.clear()
-        return
-    
-    text = f"🔍 <b>Найдено {len(messages)} сообщений с текстом '{search_text}':</b>\n\n"
-    
-    for msg in messages[:20]:
-        try:
-            time = msg['timestamp'][:16] if msg['timestamp'] else "неизвестно"
-            from_nick = msg['from_nick']
-            to_nick = msg['to_nick']
-            msg_text = msg['message_text']
-            if msg_text and len(msg_text) > 50:
-                msg_text = msg_text[:50] + "..."
-            
-            text += f"📅 {time}\n"
-            text += f"👤 {from_nick} → {to_nick}\n"
-            text += f"💬 {msg_text}\n\n"
-        except Exception as e:
-            logger.error(f"Error formatting message: {e}")
-            continue
-    
-    if len(messages) > 20:
-        text += f"... и ещё {len(messages) - 20} сообщений"
-    
-    if len(text) > 4000:
-        parts = [text[i:i+4000] for i in range(0, len(text), 4000)]
-        for part in parts:
-            await message.answer(part, reply_markup=kb.admin_menu())
-    else:
-        await message.answer(text, reply_markup=kb.admin_menu())
-    
+    token = secrets.token_urlsafe(6)
+    search_queries[token] = search_text
+    text, markup = await render_search_page(token)
+    await message.answer(text, reply_markup=markup)
     await state.clear()
 
 @dp.message(States.admin_get_user)
@@ -1285,10 +1457,11 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
     
     search_text = message.text.strip()
     
+    details = None
     try:
         target_id = int(search_text)
-        user = db.get_user_details(target_id)
-        users = [user] if user else []
+        details = db.get_user_details(target_id)
+        users = [details] if details else []
     except ValueError:
         conn = db.get_connection()
         cursor = conn.cursor()
@@ -1310,12 +1483,11 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
     if len(users) > 1:
         text = f"🔍 <b>Найдено {len(users)} пользователей:</b>\n\n"
         
+        names = await get_usernames_for_admin([user['user_id'] for user in users[:10]])
         for i, user in enumerate(users[:10], 1):
             last_active = user['last_activity'][:16] if user['last_activity'] else "никогда"
             
-            username = await get_username_for_admin(user['user_id'])
-            
-            text += f"{i}. <b>{user['nickname']}{username}</b> ({user['district']})\n"
+            text += f"{i}. <b>{user['nickname']}{names[user['user_id']]}</b> ({user['district']})\n"
             text += f"   🆔 <code>{user['user_id']}</code>\n"
             text += f"   🕐 {last_active}\n"
             text += f"   👍 {user['likes']} | 👎 {user['dislikes']} | 🚫 {'Да' if user['banned'] else 'Нет'}\n\n"
@@ -1324,33 +1496,32 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
         await state.clear()
         return
     
-    user = users[0]
+    # Поиск по нику вернул строку users без черного списка и последних чатов
+    user = details or db.get_user_details(users[0]['user_id'])
     
-    username = await get_username_for_admin(user['user_id'])
+    blacklist = user['blacklist']
+    recent_chats = user['recent_chats']
+    names = await get_usernames_for_admin(
+        [user['user_id']] + [b['blocked_id'] for b in blacklist] + [c['partner_id'] for c in recent_chats]
+    )
+    username = names[user['user_id']]
     
-    blacklist = db.get_blacklist(user['user_id'])
     blacklist_text = ""
     if blacklist:
-        blacklist_text = "\n🚫 <b>В ЧС у пользователя:</b>\n"
-        for blocked in blacklist[:5]:
-            blocked_username = await get_username_for_admin(blocked['blocked_id'])
-            blacklist_text += f"  • {blocked['nickname']}{blocked_username}\n"
+        blacklist_text = f"\n🚫 <b>В ЧС у пользователя ({user['blacklist_count']}):</b>\n"
+        for blocked in blacklist:
+            blacklist_text += f"  • {blocked['nickname']}{names[blocked['blocked_id']]}\n"
     
-    recent_chats = db.get_user_chats(user['user_id'], 5)
     chats_text = ""
     if recent_chats:
         chats_text = "\n📋 <b>Последние чаты:</b>\n"
-        for chat in recent_chats[:3]:
-            partner_nick = chat['user2_nick'] if chat['user1_id'] == user['user_id'] else chat['user1_nick']
-            partner_id = chat['user2_id'] if chat['user1_id'] == user['user_id'] else chat['user1_id']
-            
-            partner_username = await get_username_for_admin(partner_id)
-            
+        for chat in recent_chats:
             chat_time = chat['start_time'][:16]
             msg_count = chat['message_count']
-            chats_text += f"  • С {partner_nick}{partner_username} | {chat_time} | {msg_count} сообщ.\n"
+            chats_text += (f"  • С {chat['partner_nick']}{names[chat['partner_id']]} | "
+                           f"{chat_time} | {msg_count} сообщ.\n")
     
-    online_status = "🟢 Онлайн" if user['user_id'] in set(active_chats.keys()) | set(waiting_users) else "⚫ Офлайн"
+    online_status = "🟢 Онлайн" if user['user_id'] in sessions or user['user_id'] in waiting_users else "⚫ Офлайн"
     
     text = (
         f"👤 <b>Детали пользователя</b>\n\n"
@@ -1366,6 +1537,7 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
         f"🏆 <b>Рейтинг:</b> {user['rating']:.1f}%\n"
         f"👍 <b>Лайки:</b> {user['likes']}\n"
         f"👎 <b>Дизлайки:</b> {user['dislikes']}\n"
+        f"⛔ <b>В чужих ЧС:</b> {user['blocked_by_count']}\n"
         f"🚫 <b>Забанен:</b> {'Да' if user['banned'] else 'Нет'}"
     )
     
@@ -1374,26 +1546,13 @@ async def process_admin_get_user(message: types.Message, state: FSMContext):
     
     text += f"\n{blacklist_text}{chats_text}"
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🔨 Забанить", callback_data=f"admin_ban_{user['user_id']}"),
-            InlineKeyboardButton(text="✅ Разбанить", callback_data=f"admin_unban_{user['user_id']}")
-        ],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="admin_user_details")]
-    ])
-    
-    await message.answer(text, reply_markup=keyboard)
+    await message.answer(text, reply_markup=kb.admin_user_keyboard(user['user_id']))
     await state.clear()
 
-@dp.callback_query(lambda c: c.data.startswith("admin_ban_"))
-async def admin_ban_user(callback: types.CallbackQuery, state: FSMContext):
+@callback_routes.route(BanCallback, admin=True)
+async def admin_ban_user(callback: types.CallbackQuery, state: FSMContext, callback_data: BanCallback):
     admin_id = callback.from_user.id
-    
-    if admin_id not in ADMIN_IDS:
-        await callback.answer("❌ Нет доступа", show_alert=True)
-        return
-    
-    target_id = int(callback.data.replace("admin_ban_", ""))
+    target_id = callback_data.user_id
     
     target_user = db.get_user(target_id)
     if not target_user:
@@ -1412,7 +1571,6 @@ async def admin_ban_user(callback: types.CallbackQuery, state: FSMContext):
         reply_markup=kb.cancel_keyboard()
     )
     await state.set_state(States.admin_ban_reason)
-    await callback.answer()
 
 @dp.message(States.admin_ban_reason)
 async def process_admin_ban_reason(message: types.Message, state: FSMContext):
@@ -1436,6 +1594,7 @@ async def process_admin_ban_reason(message: types.Message, state: FSMContext):
         return
     
     db.ban_user(target_id, reason)
+    profile_changed(target_id, banned=True)
     
     target_user = db.get_user(target_id)
     username = await get_username_for_admin(target_id)
@@ -1470,15 +1629,10 @@ async def process_admin_ban_reason(message: types.Message, state: FSMContext):
     
     await state.clear()
 
-@dp.callback_query(lambda c: c.data.startswith("admin_unban_"))
-async def admin_unban_user(callback: types.CallbackQuery):
+@callback_routes.route(UnbanCallback, admin=True)
+async def admin_unban_user(callback: types.CallbackQuery, state: FSMContext, callback_data: UnbanCallback):
     admin_id = callback.from_user.id
-    
-    if admin_id not in ADMIN_IDS:
-        await callback.answer("❌ Нет доступа", show_alert=True)
-        return
-    
-    target_id = int(callback.data.replace("admin_unban_", ""))
+    target_id = callback_data.user_id
     
     target_user = db.get_user(target_id)
     if not target_user:
@@ -1488,6 +1642,7 @@ async def admin_unban_user(callback: types.CallbackQuery):
     username = await get_username_for_admin(target_id)
     
     db.unban_user(target_id)
+    profile_changed(target_id, banned=False)
     
     db.log_admin_action(admin_id, "unban", target_id, "Разбанен администратором")
     
@@ -1506,8 +1661,24 @@ async def admin_unban_user(callback: types.CallbackQuery):
         f"🆔 <code>{target_id}</code>",
         reply_markup=kb.admin_menu()
     )
-    
-    await callback.answer()
+
+
+async def handle_flood(message, user_id, verdict):
+    """Реакция на флуд: предупреждение, временный мьют, сигнал админам"""
+    if verdict == FLOOD_WARN:
+        await message.answer("⚠️ Слишком часто! Часть сообщений не доставлена собеседнику.")
+    elif verdict in (FLOOD_MUTE, FLOOD_FLAG):
+        await message.answer(f"🔇 Ты временно не можешь писать: {FLOOD_MUTE_SECONDS} сек.")
+    if verdict == FLOOD_FLAG:
+        logger.warning(f"Флуд: пользователь {user_id} снова получил мьют")
+        for admin_id in ADMIN_IDS:
+            try:
+                await bot.send_message(
+                    admin_id,
+                    f"🚨 <b>Флуд</b>\n\nПользователь <code>{user_id}</code> регулярно получает мьют за флуд."
+                )
+            except:
+                pass
 
 
 @dp.message()
@@ -1525,99 +1696,322 @@ async def handle_messages(message: types.Message, state: FSMContext):
             return
         
         db.update_nickname(user_id, new_nick)
+        profiles.invalidate(user_id)
+        sessions.update_user(user_id, nick=new_nick, name=display_name(user_id, new_nick))
         await state.clear()
-        await show_main_menu(message, user_id)
+        await show_main_menu(message, user_id, edit=False)
         return
     
-    user = db.get_user(user_id)
-    if not user:
+    # Дальше — пересылка: все нужное уже лежит в сессии, в БД не ходим
+    send_priority.set(PRIORITY_CHAT)
+    session = sessions.get(user_id)
+    if not session or session.is_banned(user_id):
         return
     
-    if db.check_banned(user_id):
+    verdict = flood.check(user_id, time.monotonic(), message.media_group_id)
+    if verdict != FLOOD_OK:
+        await handle_flood(message, user_id, verdict)
         return
     
-    if user_id not in active_chats:
-        return
+    sender = session.label_of(user_id)
+    if sender is None:
+        sender = sender_label(session, user_id, message.from_user)
     
-    partner_id = active_chats[user_id]
-    if partner_id not in active_chats:
-        del active_chats[user_id]
-        return
+    sessions.touch(session)
+    analytics.message(online.district_of(user_id))
+    partner_id = session.partner_of(user_id)
+    # Чат с другого шарда завершает по неактивности шард user1: ему сообщаем, что переписка идет
+    if partner_id == session.user1_id and not is_local(partner_id):
+        if session.last_activity - (session.touched_at or 0.0) > CHAT_IDLE_TIMEOUT / 10:
+            session.touched_at = session.last_activity
+            cluster.send_to_user(partner_id, {"op": "touch", "chat_id": session.chat_id, "user_id": partner_id})
     
-    partner = db.get_user(partner_id)
-    if not partner:
+    try:
+        await chat_relay.relay(message, session, user_id, sender)
+    except Exception as e:
+        logger.error(f"Error sending message: {e}")
+
+
+async def reap_idle_state():
+    """Завершает брошенные чаты, чистит устаревшую очередь и служебные словари"""
+    started = time.monotonic()
+    now = time.time()
+    
+    idle_chats = 0
+    for session in [s for s in sessions.sessions()
+                    if now - s.last_activity > CHAT_IDLE_TIMEOUT and is_local(s.user1_id)]:
+        async with user_locks.hold(session.user1_id):
+            if sessions.get(session.user1_id) is session and await stop_chat(session.user1_id, db, bot, idle=True):
+                idle_chats += 1
+    
+    deadline = time.monotonic() - QUEUE_TTL
+    expired = []
+    for uid in [u for u, since in waiting_users.items() if since < deadline]:
+        async with match_locks.hold(uid):
+            since = waiting_users.get(uid)
+            if since is not None and since < deadline:
+                leave_queue(uid)
+                expired.append(uid)
+    for uid in expired:
+        try:
+            await bot.send_message(uid, "⌛ Поиск остановлен: собеседник так и не нашелся", reply_markup=kb.main_menu())
+        except:
+            pass
+    
+    aux = (broadcast_data.prune() + ban_data.prune() + search_queries.prune() + log_filters.prune()
+           + profiles.prune() + dropped_chats.prune())
+    
+    if idle_chats or expired or aux:
+        logger.info(
+            f"Очистка: чатов {idle_chats}, из очереди {len(expired)}, служебных записей {aux} "
+            f"за {(time.monotonic() - started) * 1000:.1f} мс"
+        )
+
+# Апдейты и объявления о паре с шины обрабатываются в задачах: держим ссылки, чтобы задачу
+# не собрал сборщик мусора, и пишем в лог ошибки, которые иначе никто бы не увидел
+shard_tasks = set()
+
+def spawn_shard_task(coro):
+    task = asyncio.create_task(coro)
+    shard_tasks.add(task)
+    task.add_done_callback(shard_task_done)
+
+def shard_task_done(task):
+    shard_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Ошибка обработки сообщения шарда", exc_info=task.exception())
+
+async def announce_match(user, partner, session):
+    try:
+        await notify_matched(user, partner, session)
+    except Exception as e:
+        logger.error(f"Error notifying users: {e}")
+
+async def on_matched(message):
+    """Координатор нашел пару: открываем копию чата для своих пользователей"""
+    chat_id = message["chat_id"]
+    user1, user2 = message["user1"], message["user2"]
+    local = [u['user_id'] for u in (user1, user2) if is_local(u['user_id'])]
+    remote = [u['user_id'] for u in (user1, user2) if not is_local(u['user_id'])]
+    
+    async with match_locks.hold(user1['user_id'], user2['user_id']):
+        requests = {uid: cluster.queued.pop(uid, None) for uid in local}
+        waiting = [uid for uid in local if uid in waiting_users]
+        dropped = dropped_chats.pop(chat_id) is not None
+        session = None
+        if len(waiting) == len(local) and not dropped:
+            session = open_session(user1, user2, chat_id, message["district"])
+        if session is not None:
+            for uid in local:
+                del waiting_users[uid]
+        else:
+            # Кто-то успел отменить поиск: оставшихся возвращаем в общую очередь, чат закрываем
+            for uid in waiting:
+                if requests[uid] is not None:
+                    cluster.queued[uid] = requests[uid]
+                    cluster.send(COORDINATOR, requests[uid])
+            db.end_chat(chat_id)
+            if not dropped:
+                for uid in remote:
+                    cluster.send_to_user(uid, {"op": "closed", "chat_id": chat_id, "user_id": local[0]})
+    
+    if session is None:
+        for uid in ([] if dropped else remote):
+            try:
+                await bot.send_message(uid, "❌ Собеседник покинул чат", reply_markup=kb.main_menu())
+            except:
+                pass
         return
     
-    if user['anon_mode']:
-        sender = user['nickname']
+    for user, partner in ((user1, user2), (user2, user1)):
+        if is_local(user['user_id']):
+            spawn_shard_task(announce_match(user, partner, session))
+
+async def on_closed(message):
+    """Собеседник с другого шарда завершил чат (он же и разослал уведомления): закрываем свою копию"""
+    user_id, chat_id = message["user_id"], message["chat_id"]
+    async with hold_user_pair(user_id) as partner_id:
+        session = sessions.get(user_id)
+        if session is None or session.chat_id != chat_id:
+            # matched сюда еще не дошел — когда дойдет, чат не откроется
+            dropped_chats[chat_id] = True
+            return
+        sessions.close(user_id)
+        online.remove(partner_id)
+        flood.release(partner_id, time.monotonic())
+
+async def on_shard_message(message):
+    """Сообщения этому воркеру: апдейты от роутера и события чатов с других шардов"""
+    op = message["op"]
+    if op == "update":
+        # Апдейт может ждать замков и Telegram — шину он не держит
+        spawn_shard_task(dp.feed_raw_update(bot, message["update"]))
+    elif op == "matched":
+        await on_matched(message)
+    elif op == "closed":
+        await on_closed(message)
+    elif op == "touch":
+        session = sessions.get(message["user_id"])
+        if session is not None and session.chat_id == message["chat_id"]:
+            session.last_activity = time.time()
+    elif op == "profile":
+        user_id = message["user_id"]
+        profiles.invalidate(user_id)
+        if message["fields"]:
+            sessions.update_user(user_id, **message["fields"])
+        if message["premium"]:
+            refresh_premium(user_id)
+    elif op == "resync":
+        logger.info(f"Координатор перезапущен, в общую очередь возвращено: {cluster.requeue()}")
+
+async def restore_state():
+    """Восстанавливает чаты и очередь из снимка, зависшие в БД чаты закрывает"""
+    started = time.monotonic()
+    reachability.load()
+    snap = load_snapshot(snapshot_file)
+    open_chats = db.get_open_chats()
+    if cluster is not None:
+        open_chats = {cid: pair for cid, pair in open_chats.items() if any(map(is_local, pair))}
+    open_ids = set(open_chats)
+    banned = db.get_banned_ids()
+    dead = []
+    
+    if snap:
+        sessions.total_opened = snap.get("total_opened", 0)
+        sessions.total_messages = snap.get("total_messages", 0)
+        for session in snap["sessions"]:
+            alive = (session.chat_id in open_ids
+                     and session.user1_id not in banned and session.user2_id not in banned)
+            if not (alive and sessions.add(session)):
+                dead.append(session)
+        
+        now = time.monotonic()
+        for uid, waited in snap.get("queue", []):
+            if uid not in banned and uid not in sessions:
+                waiting_users[uid] = now - waited
+    
+    stale = open_ids - {s.chat_id for s in sessions.sessions()}
+    if stale:
+        db.end_chats(stale)
+        # Копию чата на шарде собеседника тоже закрываем
+        for cid in stale:
+            user1_id, user2_id = open_chats[cid]
+            if not (is_local(user1_id) and is_local(user2_id)):
+                local, remote = (user1_id, user2_id) if is_local(user1_id) else (user2_id, user1_id)
+                cluster.send_to_user(remote, {"op": "closed", "chat_id": cid, "user_id": local})
+    
+    districts = db.get_districts([uid for uid in list(sessions.users()) + list(waiting_users) if is_local(uid)])
+    for uid, district in districts.items():
+        online.add(uid, district)
+    if cluster is None:
+        online.flush(db)
     else:
-        sender = message.from_user.full_name or "Пользователь"
-        if message.from_user.username:
-            sender += f" (@{message.from_user.username})"
+        # Координатор мог перезапуститься вместе с нами: ставим ждущих заново
+        # (режим «только мой район» в снимке не хранится — ищем по всей Тюмени)
+        for uid in waiting_users:
+            user = db.get_user(uid)
+            if user:
+                cluster.enqueue(user, False)
     
-    sticker, badge = get_user_premium_status(user_id)
-    if sticker:
-        sender = f"{sticker} {sender}"
-    if badge:
-        sender += f" [{badge}]"
+    logger.info(
+        f"Восстановлено: чатов {len(sessions)}, в очереди {len(waiting_users)}, "
+        f"закрыто зависших {len(stale)} за {time.monotonic() - started:.2f} с"
+    )
     
-    chat_uuid = active_chat_ids.get(user_id)
+    for session in dead:
+        for uid in (session.user1_id, session.user2_id):
+            try:
+                await bot.send_message(uid, "❌ Чат завершен из-за перезапуска бота", reply_markup=kb.main_menu())
+            except:
+                pass
+
+def write_snapshot():
+    try:
+        save_snapshot(snapshot_file, sessions, waiting_users)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения снимка: {e}")
+
+async def run_polling():
+    # Telegram не отдает getUpdates, пока установлен webhook (например, после запуска в режиме webhook)
+    await bot.delete_webhook()
+    await dp.start_polling(bot)
+
+def webhook_secret():
+    """Секрет из конфига, иначе производный от токена: одинаковый у всех инстансов за балансировщиком"""
+    return WEBHOOK_SECRET or hashlib.sha256(f"webhook:{BOT_TOKEN}".encode()).hexdigest()
+
+def webhook_app(secret):
+    app = web.Application()
+    # Апдейты без верного X-Telegram-Bot-Api-Secret-Token получают 401
+    if ROLE == "router":
+        # Апдейты пользователей уходят шардам неразобранными, остальные обрабатываются здесь
+        local = lambda update: spawn_shard_task(dp.feed_raw_update(bot, update))
+        ShardForwardWebhook(cluster, secret, local).register(app, path=WEBHOOK_PATH)
+    else:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=secret).register(app, path=WEBHOOK_PATH)
+    return app
+
+async def run_webhook():
+    """aiohttp-сервер с SimpleRequestHandler; работает до SIGINT/SIGTERM"""
+    secret = webhook_secret()
+    app = webhook_app(secret)
+    # startup/shutdown диспетчера и закрытие сессии бота вместе с приложением
+    setup_application(app, dp, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    await bot.set_webhook(
+        f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=secret,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+    logger.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
     
     try:
-        if message.text:
-            await bot.send_message(partner_id, f"<b>{sender}:</b> {message.text}")
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.text, "text")
-        
-        elif message.sticker:
-            await bot.send_sticker(partner_id, message.sticker.file_id)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], None, "sticker", message.sticker.file_id)
-        
-        elif message.photo:
-            photo = message.photo[-1]
-            caption = f"<b>{sender}:</b> {message.caption or '📸 Фото'}"
-            await bot.send_photo(partner_id, photo.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "photo", photo.file_id)
-        
-        elif message.video:
-            caption = f"<b>{sender}:</b> {message.caption or '🎥 Видео'}"
-            await bot.send_video(partner_id, message.video.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "video", message.video.file_id)
-        
-        elif message.voice:
-            await bot.send_voice(partner_id, message.voice.file_id)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], None, "voice", message.voice.file_id)
-        
-        elif message.animation:
-            caption = f"<b>{sender}:</b> {message.caption or '🎬 GIF'}"
-            await bot.send_animation(partner_id, message.animation.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "animation", message.animation.file_id)
-        
-        elif message.video_note:
-            await bot.send_video_note(partner_id, message.video_note.file_id)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], None, "video_note", message.video_note.file_id)
-        
-        elif message.audio:
-            caption = f"<b>{sender}:</b> {message.caption or '🎵 Аудио'}"
-            await bot.send_audio(partner_id, message.audio.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "audio", message.audio.file_id)
-        
-        elif message.document:
-            caption = f"<b>{sender}:</b> {message.caption or '📎 Документ'}"
-            await bot.send_document(partner_id, message.document.file_id, caption=caption)
-            if chat_uuid:
-                db.save_message(chat_uuid, user_id, partner_id, sender, partner['nickname'], message.caption, "document", message.document.file_id)
+        await wait_for_stop()
+    finally:
+        # Webhook не снимаем: Telegram придержит апдейты до следующего запуска
+        await runner.cleanup()
+
+async def wait_for_stop():
+    """Ждет SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # На Windows обработчиков сигналов в цикле нет: там остается KeyboardInterrupt
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def run_router():
+    """Роутер: получает апдейты и раздает их шардам, ведет общую очередь поиска и рассылки"""
+    coordinator = MatchCoordinator(cluster, db, analytics)
     
-    except Exception as e:
-        logger.error(f"Error sending message: {e}")
+    async def on_coordinator_message(message):
+        if message["op"] == "broadcast":
+            broadcaster.start(message["job_id"])
+        else:
+            await coordinator.handle(message)
+    
+    cluster.bus.subscribe(COORDINATOR, on_coordinator_message)
+    await cluster.start()
+    coordinator.resync()
+    if UPDATE_MODE == "webhook":
+        await run_webhook()
+    else:
+        await run_polling()
 
+async def run_worker():
+    """Воркер: обрабатывает апдейты своего шарда, которые присылает роутер"""
+    cluster.bus.subscribe(shard_channel(SHARD), on_shard_message)
+    await cluster.start()
+    logger.info(f"Воркер {SHARD} из {CLUSTER_WORKERS} запущен")
+    try:
+        await wait_for_stop()
+    finally:
+        await bot.session.close()
 
 async def main():
     print("=" * 50)
@@ -1627,14 +2021,92 @@ async def main():
     print(f"📁 Реферальные данные: {REFERRAL_FILE}")
     print(f"👑 Администраторы: {ADMIN_IDS}")
     print(f"🤖 ID бота: {bot.id}")
+    print(f"📡 Режим: {UPDATE_MODE}")
+    print(f"🧩 Роль: {ROLE}" + (f" (шард {SHARD} из {CLUSTER_WORKERS})" if ROLE == "worker" else ""))
     print("=" * 50)
     
+    outbound.start()
+    # Чаты, очередь и снимок есть у процессов с пользователями; рефералы, рассылки,
+    # пересчет счетчиков и журнал админов — общие, ими занимается один процесс
+    serves_users = ROLE != "router"
+    serves_shared = ROLE != "worker"
+    if serves_shared:
+        import_referral_file()
+        broadcaster.resume()
+    if serves_users:
+        await restore_state()
+    
     async def periodic_cleanup():
         while True:
-            await asyncio.sleep(60)
+            await asyncio.sleep(CLEANUP_INTERVAL)
+            try:
+                await reap_idle_state()
+            except Exception as e:
+                logger.error(f"Ошибка очистки: {e}")
     
-    asyncio.create_task(periodic_cleanup())
-    await dp.start_polling(bot)
+    async def periodic_online_flush():
+        while True:
+            await asyncio.sleep(ONLINE_FLUSH_INTERVAL)
+            try:
+                online.flush(db)
+            except Exception as e:
+                logger.error(f"Ошибка записи онлайна: {e}")
+    
+    async def periodic_user_count_reconcile():
+        while True:
+            changes = db.reconcile_user_counts()
+            if changes:
+                logger.warning(f"Исправлены счетчики пользователей по районам: {changes}")
+            await asyncio.sleep(USER_COUNT_RECONCILE_INTERVAL)
+    
+    async def periodic_analytics_flush():
+        while True:
+            await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL)
+            try:
+                analytics.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи аналитики: {e}")
+    
+    async def periodic_admin_log_archive():
+        while True:
+            moved = db.archive_admin_logs(ADMIN_LOG_RETENTION_DAYS)
+            if moved:
+                logger.info(f"В архив журнала админов перенесено записей: {moved}")
+            await asyncio.sleep(ADMIN_LOG_ARCHIVE_INTERVAL)
+    
+    async def periodic_snapshot():
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            write_snapshot()
+    
+    if serves_users:
+        asyncio.create_task(periodic_cleanup())
+        asyncio.create_task(periodic_snapshot())
+    # online_now в district_stats один на всех: воркеры его не перезаписывают своими частями
+    if cluster is None:
+        asyncio.create_task(periodic_online_flush())
+    if serves_shared:
+        asyncio.create_task(periodic_user_count_reconcile())
+        asyncio.create_task(periodic_admin_log_archive())
+    asyncio.create_task(periodic_analytics_flush())
+    try:
+        if ROLE == "router":
+            await run_router()
+        elif ROLE == "worker":
+            await run_worker()
+        elif UPDATE_MODE == "webhook":
+            await run_webhook()
+        else:
+            await run_polling()
+    finally:
+        if serves_users:
+            write_snapshot()
+        analytics.flush()
+        await broadcaster.stop()
+        if cluster is not None:
+            await cluster.stop()
+        await fsm_storage.close()
+        await outbound.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
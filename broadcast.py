@@ -0,0 +1,181 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from aiogram.enums import ParseMode
+
+from outbound import send_priority, PRIORITY_BULK, PRIORITY_NOTIFY
+import keyboards as kb
+
+logger = logging.getLogger(__name__)
+
+
+class Broadcaster:
+    """Рассылка по задаче из broadcast_jobs: получатели порциями по курсору user_id,
+    пул отправок подстраивается под retry_after после каждой отправки,
+    курсор сохраняется каждые checkpoint_every получателей"""
+
+    def __init__(self, bot, db, outbound, batch_size=500, workers=16, progress_interval=5.0, checkpoint_every=10):
+        self.bot = bot
+        self.db = db
+        self.outbound = outbound
+        self.batch_size = batch_size
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.checkpoint_every = checkpoint_every
+        self._tasks = {}
+
+    def start(self, job_id):
+        if job_id not in self._tasks:
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+
+    def resume(self):
+        """Продолжает рассылки, прерванные перезапуском"""
+        jobs = self.db.get_running_broadcasts()
+        for job in jobs:
+            logger.info(f"Продолжаю рассылку #{job['id']} с user_id > {job['cursor']}")
+            self.start(job["id"])
+        return len(jobs)
+
+    @property
+    def active(self):
+        return len(self._tasks)
+
+    async def _send(self, user_id, text):
+        try:
+            await self.bot.send_message(
+                user_id,
+                f"📢 <b>Рассылка от администрации</b>\n\n{text}",
+                parse_mode=ParseMode.HTML
+            )
+            return True
+        except Exception as e:
+            logger.debug(f"Ошибка отправки пользователю {user_id}: {e}")
+            return False
+
+    async def _run(self, job_id):
+        send_priority.set(PRIORITY_BULK)
+        job = None
+        inflight = set()
+        try:
+            job = self.db.get_broadcast(job_id)
+            cursor, sent, failed = job["cursor"], job["sent"], job["failed"]
+            segment = json.loads(job["segment"]) if job["segment"] else None
+            workers = self.workers
+            retries = self.outbound.retries
+            reported = 0.0
+            # Получатели по порядку user_id: [user_id, результат или None, пока отправка в пути].
+            # Курсор двигается только по сплошному префиксу, чтобы после перезапуска никто
+            # не остался без сообщения; порции подгружаются, не дожидаясь конца предыдущей
+            window = deque()
+            batch = deque()
+            fetched = cursor
+            exhausted = False
+            saved = calm = 0
+
+            while True:
+                # Зависшая отправка в голове окна держит курсор: окно не шире двух порций,
+                # чтобы повторов после перезапуска было ограниченное число
+                while len(inflight) < workers and len(window) < 2 * self.batch_size:
+                    if not batch and not exhausted:
+                        batch.extend(self.db.get_broadcast_recipients(fetched, self.batch_size, segment))
+                        exhausted = not batch
+                        if batch:
+                            fetched = batch[-1]
+                    if not batch:
+                        break
+                    entry = [batch.popleft(), None]
+                    window.append(entry)
+                    inflight.add(asyncio.create_task(self._deliver(entry, job["text"])))
+                if not inflight:
+                    break
+
+                done, inflight = await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+                # Telegram просил подождать — сужаем пул сразу, иначе понемногу расширяем
+                if self.outbound.retries > retries:
+                    retries = self.outbound.retries
+                    workers = max(1, workers // 2)
+                    calm = 0
+                elif workers < self.workers:
+                    calm += len(done)
+                    if calm >= workers:
+                        calm = 0
+                        workers += 1
+
+                while window and window[0][1] is not None:
+                    user_id, ok = window.popleft()
+                    cursor = user_id
+                    if ok:
+                        sent += 1
+                    else:
+                        failed += 1
+                    saved += 1
+                if saved >= self.checkpoint_every or (not window and saved):
+                    saved = 0
+                    self.db.checkpoint_broadcast(job_id, cursor, sent, failed)
+
+                now = time.monotonic()
+                if now - reported >= self.progress_interval:
+                    reported = now
+                    percent = min(100, (sent + failed) * 100 // max(job["total"], 1))
+                    await self._progress(job, f"📊 Прогресс: {percent}%\n📨 Отправлено: {sent}, ❌ ошибок: {failed}")
+
+            self.db.finish_broadcast(job_id)
+            self.db.log_admin_action(job["admin_id"], "broadcast", details=f"Отправлено: {sent}, Ошибок: {failed}")
+            await self._progress(job, "✅ Рассылка завершена")
+            await self._notify(
+                job["admin_id"],
+                f"✅ <b>Рассылка завершена!</b>\n\n"
+                f"📨 Отправлено: {sent}\n"
+                f"❌ Ошибок: {failed}"
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Задачу не оставляем running: иначе ее подхватит только перезапуск, а админ ничего не узнает
+            logger.exception(f"Рассылка #{job_id} прервана: {e}")
+            self.db.finish_broadcast(job_id, status="failed")
+            if job is not None:
+                job = self.db.get_broadcast(job_id)
+                text = (f"❌ <b>Рассылка прервана ошибкой</b>\n\n"
+                        f"📨 Отправлено: {job['sent']}\n"
+                        f"❌ Ошибок: {job['failed']}\n"
+                        f"Подробности в логе бота")
+                await self._progress(job, text)
+                await self._notify(job["admin_id"], text)
+        finally:
+            for task in inflight:
+                task.cancel()
+            self._tasks.pop(job_id, None)
+
+    async def _deliver(self, entry, text):
+        entry[1] = await self._send(entry[0], text)
+
+    async def _progress(self, job, text):
+        if not job["progress_chat_id"]:
+            return
+        token = send_priority.set(PRIORITY_NOTIFY)
+        try:
+            await self.bot.edit_message_text(text, chat_id=job["progress_chat_id"],
+                                             message_id=job["progress_message_id"])
+        except Exception:
+            pass
+        finally:
+            send_priority.reset(token)
+
+    async def _notify(self, admin_id, text):
+        token = send_priority.set(PRIORITY_NOTIFY)
+        try:
+            await self.bot.send_message(admin_id, text, reply_markup=kb.admin_menu())
+        except Exception as e:
+            logger.error(f"Не удалось сообщить об окончании рассылки: {e}")
+        finally:
+            send_priority.reset(token)
+
+    async def stop(self):
+        """Останавливает задачи; в БД они остаются running и продолжатся после запуска"""
+        for task in list(self._tasks.values()):
+            task.cancel()
+        self._tasks.clear()
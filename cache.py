@@ -0,0 +1,52 @@
+import time
+from collections import OrderedDict
+
+
+class BoundedDict:
+    """Словарь с лимитом размера (вытесняются самые старые записи) и сроком жизни"""
+
+    def __init__(self, maxlen, ttl=None):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        # key -> (value, время записи); порядок = порядок записи
+        self._items = OrderedDict()
+
+    def __setitem__(self, key, value):
+        self._items[key] = (value, time.monotonic())
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxlen:
+            self._items.popitem(last=False)
+
+    def __getitem__(self, key):
+        return self._items[key][0]
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        return item[0] if item is not None else default
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return item[0] if item is not None else default
+
+    def prune(self):
+        """Удаляет записи старше ttl, возвращает их количество"""
+        if self.ttl is None:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        removed = 0
+        while self._items:
+            key, (_, stamp) = next(iter(self._items.items()))
+            if stamp >= deadline:
+                break
+            del self._items[key]
+            removed += 1
+        return removed
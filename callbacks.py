@@ -0,0 +1,144 @@
+import logging
+import time
+
+from aiogram.filters.callback_data import CallbackData
+
+logger = logging.getLogger(__name__)
+
+
+# Фабрики callback data для кнопок с параметрами. Префикс — ключ в таблице маршрутов,
+# упаковка "<префикс>:<поле>:<поле>" укладывается в 64 байта Telegram
+
+class RateCallback(CallbackData, prefix="rate"):
+    action: str  # like / dislike
+    partner_id: int
+
+
+class BlacklistAddCallback(CallbackData, prefix="bladd"):
+    user_id: int
+
+
+class BlacklistRemoveCallback(CallbackData, prefix="blrm"):
+    user_id: int
+
+
+class DistrictCallback(CallbackData, prefix="dist"):
+    index: int  # с единицы, как в TYUMEN_DISTRICTS по порядку
+
+
+class ChangeDistrictCallback(CallbackData, prefix="chdist"):
+    index: int
+
+
+class BanCallback(CallbackData, prefix="ban"):
+    user_id: int
+
+
+class UnbanCallback(CallbackData, prefix="unban"):
+    user_id: int
+
+
+# Старые кнопки вида "like_123" остаются в истории чатов: их префикс до последнего "_"
+# переводится в новую фабрику
+_LEGACY = {
+    "like": lambda tail: RateCallback(action="like", partner_id=int(tail)),
+    "dislike": lambda tail: RateCallback(action="dislike", partner_id=int(tail)),
+    "blacklist_add": lambda tail: BlacklistAddCallback(user_id=int(tail)),
+    "blacklist_remove": lambda tail: BlacklistRemoveCallback(user_id=int(tail)),
+    "district": lambda tail: DistrictCallback(index=int(tail)),
+    "change_district": lambda tail: ChangeDistrictCallback(index=int(tail)),
+    "admin_ban": lambda tail: BanCallback(user_id=int(tail)),
+    "admin_unban": lambda tail: UnbanCallback(user_id=int(tail)),
+}
+
+
+def upgrade_legacy(data):
+    """Callback data старого формата в новый или None, если это не старая кнопка"""
+    prefix, _, tail = data.rpartition("_")
+    convert = _LEGACY.get(prefix)
+    if convert is None or not tail.isdigit():
+        return None
+    return convert(tail).pack()
+
+
+class RouteStats:
+    __slots__ = ("calls", "errors", "total", "max")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class CallbackRouter:
+    """Callback data -> обработчик одним поиском в словаре.
+    Ключ — все до первого ":": для фабрик это префикс, для простых кнопок вся строка,
+    так что стоимость маршрутизации не зависит от числа кнопок"""
+
+    def __init__(self, admin_ids):
+        self.admin_ids = admin_ids
+        # ключ -> (обработчик, фабрика или None, только для админов)
+        self._routes = {}
+        self._stats = {}
+
+    def route(self, key, admin=False):
+        """Декоратор: key — строка callback data или фабрика CallbackData.
+        Обработчик получает (callback, state) и распакованные данные, если задана фабрика,
+        и возвращает True, если сам ответил на нажатие"""
+        factory = None
+        if isinstance(key, type) and issubclass(key, CallbackData):
+            factory, key = key, key.__prefix__
+
+        def decorator(handler):
+            if key in self._routes:
+                raise ValueError(f"Маршрут {key!r} уже зарегистрирован")
+            self._routes[key] = (handler, factory, admin)
+            self._stats[key] = RouteStats()
+            return handler
+        return decorator
+
+    async def dispatch(self, callback, state):
+        """Вызывает обработчик кнопки. True, если на нажатие уже ответили (отказ в доступе
+        или сам обработчик): Telegram принимает только один ответ на callback"""
+        data = callback.data or ""
+        key = data.partition(":")[0]
+        route = self._routes.get(key)
+        if route is None:
+            upgraded = upgrade_legacy(data)
+            if upgraded is None:
+                logger.debug(f"Неизвестная кнопка: {data}")
+                return False
+            data = upgraded
+            key = data.partition(":")[0]
+            route = self._routes[key]
+
+        handler, factory, admin = route
+        if admin and callback.from_user.id not in self.admin_ids:
+            await callback.answer("❌ Нет доступа", show_alert=True)
+            return True
+
+        args = (factory.unpack(data),) if factory else ()
+        stats = self._stats[key]
+        started = time.perf_counter()
+        try:
+            answered = await handler(callback, state, *args)
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stats.calls += 1
+            stats.total += elapsed
+            if elapsed > stats.max:
+                stats.max = elapsed
+        return bool(answered)
+
+    def stats(self, top=None):
+        """Маршруты по суммарному времени обработчиков: [(ключ, вызовы, ошибки, сред. мс, макс. мс)]"""
+        rows = [
+            (key, s.calls, s.errors, round(s.total / s.calls * 1000, 1), round(s.max * 1000, 1))
+            for key, s in self._stats.items() if s.calls
+        ]
+        rows.sort(key=lambda r: r[1] * r[3], reverse=True)
+        return rows[:top] if top else rows
@@ -0,0 +1,355 @@
+import asyncio
+import datetime
+import hmac
+import json
+import logging
+import time
+import zlib
+from collections import defaultdict
+from itertools import islice
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+# Канал координатора подбора пар; у каждого воркера свой канал shard:<n>
+COORDINATOR = "coordinator"
+
+# Поля профиля, с которыми пользователь встает в общую очередь
+QUEUE_FIELDS = ("user_id", "nickname", "district", "anon_mode", "referrals")
+
+# Сколько кандидатов координатор проверяет на бан и ЧС одним запросом
+MATCH_CHECK_BATCH = 64
+
+
+def shard_of(user_id, shards):
+    """Шард пользователя. crc32 одинаков во всех процессах и разносит соседние id по разным шардам"""
+    return zlib.crc32(str(user_id).encode()) % shards
+
+
+def shard_channel(shard):
+    return f"shard:{shard}"
+
+
+def update_user_id(update):
+    """id пользователя из апдейта Telegram в виде JSON или None (посты каналов, опросы).
+    У событий пользователя отправитель в поле from, у poll_answer и реакций — в user"""
+    for value in update.values():
+        if isinstance(value, dict):
+            user = value.get("from") or value.get("user")
+            if isinstance(user, dict):
+                return user.get("id")
+    return None
+
+
+class LocalBus:
+    """Шина внутри одного процесса: для тестов и проверки протокола без Redis.
+    Сообщения проходят через JSON, как и по сети"""
+
+    def __init__(self):
+        self._handlers = {}
+        self._queues = {}
+        self._tasks = {}
+
+    def subscribe(self, channel, handler):
+        self._handlers[channel] = handler
+        self._queues[channel] = asyncio.Queue()
+
+    async def publish(self, channel, message):
+        queue = self._queues.get(channel)
+        if queue is None:
+            logger.warning(f"Нет подписчика на канал {channel}")
+            return
+        queue.put_nowait(json.dumps(message, ensure_ascii=False))
+
+    async def start(self):
+        # Шину могут делить несколько Cluster одного процесса: у канала всегда один читатель
+        for channel in self._handlers:
+            if channel not in self._tasks:
+                self._tasks[channel] = asyncio.create_task(self._consume(channel))
+
+    async def _consume(self, channel):
+        handler, queue = self._handlers[channel], self._queues[channel]
+        while True:
+            await _deliver(handler, json.loads(await queue.get()))
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        self._tasks.clear()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class RedisBus:
+    """Шина через списки Redis (подойдет любой совместимый сервер: Valkey, KeyDB, Dragonfly).
+    У каждого канала один читатель, поэтому список, а не pub/sub: сообщения для
+    перезапускающегося воркера дождутся его, порядок внутри канала сохраняется"""
+
+    def __init__(self, url):
+        if aioredis is None:
+            raise RuntimeError("Для работы в несколько процессов нужен пакет redis: pip install redis")
+        self._redis = aioredis.from_url(url)
+        self._handlers = {}
+        self._task = None
+
+    def subscribe(self, channel, handler):
+        self._handlers[channel] = handler
+
+    async def publish(self, channel, message):
+        await self._redis.rpush(channel, json.dumps(message, ensure_ascii=False))
+
+    async def start(self):
+        if self._handlers:
+            self._task = asyncio.create_task(self._consume())
+
+    async def _consume(self):
+        channels = list(self._handlers)
+        while True:
+            try:
+                item = await self._redis.blpop(channels, timeout=5)
+            except Exception as e:
+                logger.error(f"Шина недоступна: {e}")
+                await asyncio.sleep(1)
+                continue
+            if item is None:
+                continue
+            channel, data = item
+            await _deliver(self._handlers[channel.decode()], json.loads(data))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self._redis.aclose()
+
+
+async def _deliver(handler, message):
+    # Обработчик вызывается по очереди: порядок сообщений канала важен (matched раньше closed).
+    # Долгую работу обработчик сам уносит в задачу
+    try:
+        await handler(message)
+    except Exception as e:
+        logger.exception(f"Ошибка обработки {message.get('op')}: {e}")
+
+
+class Cluster:
+    """Связь процесса с остальными: свой шард, шина и отправка в строгом порядке"""
+
+    def __init__(self, bus, shards, shard=None):
+        self.bus = bus
+        self.shards = shards
+        self.shard = shard
+        # Что этот воркер поставил в общую очередь: переотправляется, если координатор перезапустился
+        self.queued = {}
+        self._outbox = asyncio.Queue()
+        self._sender = None
+
+    def is_local(self, user_id):
+        return shard_of(user_id, self.shards) == self.shard
+
+    def send(self, channel, message):
+        """Не ждет отправки; сообщения уходят в том порядке, в каком вызывался send"""
+        self._outbox.put_nowait((channel, message))
+
+    def send_to_user(self, user_id, message):
+        self.send(shard_channel(shard_of(user_id, self.shards)), message)
+
+    def enqueue(self, user, same_district):
+        request = {"op": "enqueue", "user": {f: user[f] for f in QUEUE_FIELDS},
+                   "same_district": same_district, "shard": self.shard}
+        self.queued[user["user_id"]] = request
+        self.send(COORDINATOR, request)
+
+    def cancel(self, user_id):
+        if self.queued.pop(user_id, None) is not None:
+            self.send(COORDINATOR, {"op": "cancel", "user_id": user_id})
+
+    def requeue(self):
+        for request in self.queued.values():
+            self.send(COORDINATOR, request)
+        return len(self.queued)
+
+    async def _send_loop(self):
+        while True:
+            channel, message = await self._outbox.get()
+            try:
+                await self.bus.publish(channel, message)
+            except Exception as e:
+                logger.error(f"Не отправлено в {channel}: {e}")
+
+    async def start(self):
+        self._sender = asyncio.create_task(self._send_loop())
+        await self.bus.start()
+
+    async def stop(self):
+        if self._sender is None:
+            return
+        # Дописываем то, что уже в очереди на отправку (например, closed для собеседников)
+        while not self._outbox.empty():
+            await asyncio.sleep(0.05)
+        self._sender.cancel()
+        await asyncio.gather(self._sender, return_exceptions=True)
+        await self.bus.close()
+
+
+class ShardForwardWebhook:
+    """Роутер в режиме webhook: тело апдейта уходит воркеру шарда как есть, модели aiogram
+    строит только воркер. Роутеру остаются json.loads и поиск отправителя, так что прием
+    апдейтов не упирается в одно ядро. Апдейты без пользователя отдаются в local"""
+
+    def __init__(self, cluster, secret, local):
+        self.cluster = cluster
+        self.secret = secret
+        self.local = local
+
+    def register(self, app, path):
+        app.router.add_post(path, self.handle)
+
+    async def handle(self, request):
+        # Как в SimpleRequestHandler aiogram: без верного секрета — 401
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token, self.secret):
+            return web.Response(status=401, text="Unauthorized")
+        update = await request.json()
+        user_id = update_user_id(update)
+        if user_id is None:
+            self.local(update)
+        else:
+            self.cluster.send_to_user(user_id, {"op": "update", "update": update})
+        return web.Response()
+
+
+class ShardForwardMiddleware(BaseMiddleware):
+    """Роутер в режиме polling: апдейт пользователя уходит воркеру его шарда вместо обработки на месте.
+    aiogram здесь уже разобрал апдейт, поэтому для нагрузки роутер лучше запускать с webhook"""
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        self.cluster.send_to_user(user.id, {
+            "op": "update", "update": event.model_dump(mode="json", exclude_none=True, by_alias=True)
+        })
+
+
+class MatchCoordinator:
+    """Общая очередь поиска для всех шардов. Воркеры присылают enqueue/cancel,
+    найденная пара уходит шардам обоих собеседников сообщением matched.
+    Поиск смотрит только ждущих своего района и тех, кому район не важен; баны и ЧС
+    проверяются одним запросом на MATCH_CHECK_BATCH кандидатов. Чаты пар, найденных
+    подряд, пока сообщения копились в шине, пишутся в БД одним коммитом"""
+
+    def __init__(self, cluster, db, analytics):
+        self.cluster = cluster
+        self.db = db
+        self.analytics = analytics
+        # user_id -> (профиль, same_district, monotonic() постановки)
+        self.queue = {}
+        # Те же ждущие по районам и те, кто ищет по всей Тюмени; dict хранит порядок очереди
+        self._districts = defaultdict(dict)
+        self._anywhere = {}
+        # Найденные пары ждут записи чатов: matched уходит только после коммита
+        self._created = []
+        self._flush_handle = None
+
+    def _add(self, user, same_district, since):
+        user_id = user["user_id"]
+        self.queue[user_id] = (user, same_district, since)
+        self._districts[user["district"]][user_id] = True
+        if not same_district:
+            self._anywhere[user_id] = True
+
+    def _remove(self, user_id):
+        entry = self.queue.pop(user_id, None)
+        if entry is not None:
+            district = entry[0]["district"]
+            bucket = self._districts[district]
+            bucket.pop(user_id, None)
+            if not bucket:
+                del self._districts[district]
+            self._anywhere.pop(user_id, None)
+        return entry
+
+    def _candidates(self, user, same_district):
+        """Подходящие по району ждущие в порядке очереди: сначала свой район, затем остальные,
+        кому район не важен. «Только мой район» учитывается у обоих: ждущий тоже мог его выбрать"""
+        district = user["district"]
+        yield from self._districts.get(district, ())
+        if not same_district:
+            for uid in self._anywhere:
+                if self.queue[uid][0]["district"] != district:
+                    yield uid
+
+    def _find(self, user, same_district):
+        user_id = user["user_id"]
+        candidates = (uid for uid in self._candidates(user, same_district) if uid != user_id)
+        while True:
+            chunk = list(islice(candidates, MATCH_CHECK_BATCH))
+            if not chunk:
+                return None
+            excluded = self.db.get_match_exclusions(user_id, chunk)
+            for uid in chunk:
+                if uid not in excluded:
+                    return self.queue[uid][0]
+
+    async def handle(self, message):
+        op = message["op"]
+        if op == "cancel":
+            self._remove(message["user_id"])
+        elif op == "enqueue":
+            self._enqueue(message["user"], message["same_district"])
+
+    def _enqueue(self, user, same_district):
+        user_id = user["user_id"]
+        self._remove(user_id)
+        partner = self._find(user, same_district)
+        if partner is None:
+            self._add(user, same_district, time.monotonic())
+            return
+
+        _, _, since = self._remove(partner["user_id"])
+        chat_id = (f"{min(user_id, partner['user_id'])}_{max(user_id, partner['user_id'])}_"
+                   f"{datetime.datetime.now().timestamp()}")
+        district = user["district"] if user["district"] == partner["district"] else "разные районы"
+        self.analytics.chat_started(district)
+        self.analytics.matched(partner["district"], time.monotonic() - since)
+
+        row = (chat_id, user_id, partner["user_id"], user["nickname"], partner["nickname"], district)
+        matched = {"op": "matched", "chat_id": chat_id, "district": district, "user1": user, "user2": partner}
+        self._created.append((row, matched))
+        # Запись откладывается до конца текущей пачки сообщений шины: чаты одним коммитом
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        created, self._created = self._created, []
+        try:
+            self.db.create_chats([row for row, _ in created])
+        except Exception as e:
+            # Без записи в БД чат не открываем: пользователи останутся в поиске у своих воркеров
+            logger.exception(f"Не записаны чаты {len(created)} пар: {e}")
+            return
+        # Воркер может закрыть чат (end_chat), как только получит matched, — строка уже есть
+        for row, matched in created:
+            for shard in {shard_of(row[1], self.cluster.shards), shard_of(row[2], self.cluster.shards)}:
+                self.cluster.send(shard_channel(shard), matched)
+
+    def resync(self):
+        """После перезапуска координатора очередь пуста: просим воркеры прислать своих ждущих.
+        Все, что было в очереди, заменяется присланным"""
+        self.queue.clear()
+        self._districts.clear()
+        self._anywhere.clear()
+        for shard in range(self.cluster.shards):
+            self.cluster.send(shard_channel(shard), {"op": "resync"})
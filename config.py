@@ -9,6 +9,95 @@ ADMIN_IDS = [7479394466, 5063450800, 1959719142]
 DB_NAME = "data/tyumenchat.db"
 DEBUG = False
 
+# Снимок активных чатов и очереди для восстановления после перезапуска
+SNAPSHOT_FILE = "data/state_snapshot.json"
+SNAPSHOT_INTERVAL = 15
+
+# Сколько секунд хранится брошенное FSM состояние (например, недовыбранный район)
+FSM_STATE_TTL = 24 * 3600
+
+# Очистка: чаты без сообщений дольше CHAT_IDLE_TIMEOUT завершаются,
+# из очереди убираются ждущие дольше QUEUE_TTL (секунды)
+CLEANUP_INTERVAL = 60
+CHAT_IDLE_TIMEOUT = 30 * 60
+QUEUE_TTL = 15 * 60
+AUX_DICT_LIMIT = 1000
+AUX_DICT_TTL = 3600
+
+# Как часто счетчики онлайна по районам пишутся в district_stats (секунды)
+ONLINE_FLUSH_INTERVAL = 10
+
+# Как часто district_stats.user_count сверяется с таблицей users (секунды)
+USER_COUNT_RECONCILE_INTERVAL = 3600
+
+# Лимиты исходящих сообщений: всего в секунду и в один чат (скорость и всплеск)
+OUTBOUND_GLOBAL_RATE = 30
+OUTBOUND_CHAT_RATE = 1
+OUTBOUND_CHAT_BURST = 3
+
+# Сколько секунд собираются части альбома перед отправкой одним send_media_group
+MEDIA_GROUP_WINDOW = 1.0
+
+# Не чаще одного chat action («отправляет фото», пока копится альбом) на чат за столько секунд
+CHAT_ACTION_INTERVAL = 4.0
+
+# Антифлуд в чате: всплеск до FLOOD_BURST сообщений, дальше FLOOD_RATE в секунду (альбом — одно сообщение).
+# После FLOOD_WARN_AFTER отброшенных — предупреждение, после FLOOD_MUTE_AFTER — мьют,
+# после FLOOD_FLAG_AFTER мьютов — сигнал админам
+FLOOD_BURST = 8
+FLOOD_RATE = 1.0
+FLOOD_WARN_AFTER = 3
+FLOOD_MUTE_AFTER = 10
+FLOOD_MUTE_SECONDS = 120
+FLOOD_FLAG_AFTER = 3
+
+# Рассылка: получателей за одну порцию, одновременных отправок, как часто обновлять прогресс (с)
+BROADCAST_BATCH = 500
+BROADCAST_WORKERS = 16
+BROADCAST_PROGRESS_INTERVAL = 5
+# Курсор рассылки пишется в БД каждые столько обработанных получателей:
+# после перезапуска повторно получат сообщение не больше стольких (плюс отправки «в полете»)
+BROADCAST_CHECKPOINT_EVERY = 10
+
+# Username для админки: сколько секунд считается свежим и сколько get_chat параллельно
+USERNAME_TTL = 24 * 3600
+USERNAME_CONCURRENCY = 5
+
+# Как часто почасовые счетчики аналитики пишутся в БД (секунды)
+ANALYTICS_FLUSH_INTERVAL = 60
+
+# Журнал действий админов: записи старше стольких дней уезжают в admin_logs_archive
+ADMIN_LOG_RETENTION_DAYS = 90
+ADMIN_LOG_ARCHIVE_INTERVAL = 24 * 3600
+
+# Профили для меню в памяти: сколько пользователей и сколько секунд без перечитывания из БД
+PROFILE_CACHE_SIZE = 10000
+PROFILE_CACHE_TTL = 300
+
+# Сколько последних экранов (сообщений бота) помнить, чтобы не редактировать их тем же текстом
+SCREEN_CACHE_SIZE = 10000
+
+# Получение апдейтов: "polling" (getUpdates) или "webhook" (aiohttp-сервер за балансировщиком)
+UPDATE_MODE = "polling"
+# Webhook: публичный адрес для Telegram, путь и где слушать локально.
+# WEBHOOK_SECRET проверяется в заголовке X-Telegram-Bot-Api-Secret-Token;
+# пустой — выводится из BOT_TOKEN, так что у всех инстансов с одним токеном он совпадает
+WEBHOOK_URL = "https://example.com"
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_SECRET = ""
+
+# Режим процесса: "single" — все в одном процессе; "router" — получает апдейты и подбирает пары;
+# "worker" — обслуживает свой шард пользователей. Переопределяется ключами --role и --shard
+CLUSTER_ROLE = "single"
+# Сколько воркеров (шардов); пользователь попадает в шард crc32(user_id) % CLUSTER_WORKERS
+CLUSTER_WORKERS = 4
+# Номер шарда этого воркера, от 0 до CLUSTER_WORKERS - 1
+CLUSTER_SHARD = 0
+# Шина между процессами (Redis или совместимый сервер)
+CLUSTER_REDIS_URL = "redis://localhost:6379/0"
+
 
 TYUMEN_DISTRICTS = [
     "🏛️ Центральный",
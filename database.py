@@ -1,5 +1,6 @@
 import sqlite3
 import datetime
+import json
 import logging
 from config import DB_NAME
 
@@ -18,6 +19,8 @@ class Database:
     def init_db(self):
         conn = self.get_connection()
         cursor = conn.cursor()
+        # WAL: читатели не ждут писателя — базу делят несколько процессов (см. cluster.py)
+        cursor.execute('PRAGMA journal_mode=WAL')
         
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -127,10 +130,162 @@ class Database:
             )
         ''')
         
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                status TEXT DEFAULT 'running',
+                cursor INTEGER DEFAULT 0,
+                total INTEGER DEFAULT 0,
+                sent INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                progress_chat_id INTEGER,
+                progress_message_id INTEGER,
+                segment TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS unreachable (
+                user_id INTEGER PRIMARY KEY,
+                reason TEXT,
+                marked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS usernames (
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                fetched_at REAL NOT NULL
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_hourly (
+                hour TEXT NOT NULL,
+                district TEXT NOT NULL,
+                messages INTEGER DEFAULT 0,
+                chats_started INTEGER DEFAULT 0,
+                chats_ended INTEGER DEFAULT 0,
+                searches INTEGER DEFAULT 0,
+                matches INTEGER DEFAULT 0,
+                wait_total REAL DEFAULT 0,
+                active_users INTEGER DEFAULT 0,
+                PRIMARY KEY (hour, district)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_daily (
+                day TEXT NOT NULL,
+                district TEXT NOT NULL,
+                messages INTEGER DEFAULT 0,
+                chats_started INTEGER DEFAULT 0,
+                chats_ended INTEGER DEFAULT 0,
+                searches INTEGER DEFAULT 0,
+                matches INTEGER DEFAULT 0,
+                wait_total REAL DEFAULT 0,
+                active_users INTEGER DEFAULT 0,
+                PRIMARY KEY (day, district)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_activity_days (
+                user_id INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                district TEXT,
+                PRIMARY KEY (user_id, day)
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS cohort_retention (
+                cohort TEXT PRIMARY KEY,
+                size INTEGER DEFAULT 0,
+                d1 INTEGER DEFAULT 0,
+                d7 INTEGER DEFAULT 0,
+                d30 INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS referrals (
+                user_id INTEGER PRIMARY KEY,
+                count INTEGER DEFAULT 0,
+                protections_used INTEGER DEFAULT 0
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS admin_logs_archive (
+                id INTEGER PRIMARY KEY,
+                admin_id INTEGER NOT NULL,
+                action TEXT NOT NULL,
+                target_id INTEGER,
+                details TEXT,
+                timestamp TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_district ON users(district)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)')
+        # Индексы под фильтры аудитории рассылки
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_total_chats ON users(total_chats)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ratings_banned_rating ON ratings(banned, rating)')
+        
+        self._ensure_column(cursor, 'broadcast_jobs', 'segment', 'TEXT')
+        
+        # Индексы под постраничные списки админки
+        # Район листается по users.id: last_activity меняется, пока админ листает
+        cursor.execute('DROP INDEX IF EXISTS idx_users_district_activity')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_district_id ON users(district, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ratings_bans ON ratings(banned, ban_date, user_id)')
+        # Аналитика: когорты по дате регистрации, активность за день
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_join_date ON users(join_date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_days_day ON user_activity_days(day, district)')
+        
+        # Досье пользователя: счетчики ЧС хранятся в users, последние чаты и ЧС берутся по индексам
+        if self._ensure_column(cursor, 'users', 'blacklist_count', 'INTEGER DEFAULT 0'):
+            cursor.execute('''UPDATE users SET blacklist_count =
+                              (SELECT COUNT(*) FROM blacklist b WHERE b.user_id = users.user_id)''')
+        if self._ensure_column(cursor, 'users', 'blocked_by_count', 'INTEGER DEFAULT 0'):
+            cursor.execute('''UPDATE users SET blocked_by_count =
+                              (SELECT COUNT(*) FROM blacklist b WHERE b.blocked_id = users.user_id)''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user1_start ON chats(user1_id, start_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_chats_user2_start ON chats(user2_id, start_time)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_blacklist_user_date ON blacklist(user_id, block_date, blocked_id)')
+        # Кто заблокировал пользователя: обратная сторона ЧС при подборе пары
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_blacklist_blocked ON blacklist(blocked_id, user_id)')
+        
+        # Журнал действий админов: общая лента и фильтры по админу, цели и действию
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_logs_time ON admin_logs(timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_logs_admin ON admin_logs(admin_id, timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_logs_target ON admin_logs(target_id, timestamp)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_admin_logs_action ON admin_logs(action, timestamp)')
+        # Старые баны ставились без даты; NULL ломает сравнение курсора
+        cursor.execute("UPDATE ratings SET ban_date = '' WHERE banned = 1 AND ban_date IS NULL")
+        
         conn.commit()
         conn.close()
         logger.info("База данных инициализирована")
     
+    @staticmethod
+    def _ensure_column(cursor, table, column, declaration):
+        """Добавляет колонку в уже существующую таблицу из старой версии схемы"""
+        cursor.execute(f'PRAGMA table_info({table})')
+        if column in {row[1] for row in cursor.fetchall()}:
+            return False
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+        return True
+    
     def add_user(self, user_id, nickname, district):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -139,18 +294,20 @@ class Database:
                 INSERT OR IGNORE INTO users (user_id, nickname, district)
                 VALUES (?, ?, ?)
             ''', (user_id, nickname, district))
+            inserted = cursor.rowcount > 0
             
             cursor.execute('''
                 INSERT OR IGNORE INTO ratings (user_id, likes, dislikes, rating)
                 VALUES (?, 0, 0, 50.0)
             ''', (user_id,))
             
-            cursor.execute('''
-                INSERT INTO district_stats (district, user_count, online_now)
-                VALUES (?, 1, 0)
-                ON CONFLICT(district) DO UPDATE SET
-                user_count = user_count + 1
-            ''', (district,))
+            if inserted:
+                cursor.execute('''
+                    INSERT INTO district_stats (district, user_count, online_now)
+                    VALUES (?, 1, 0)
+                    ON CONFLICT(district) DO UPDATE SET
+                    user_count = user_count + 1
+                ''', (district,))
             
             conn.commit()
             return True
@@ -164,9 +321,10 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned
+            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, COALESCE(f.count, 0) AS referrals
             FROM users u
             LEFT JOIN ratings r ON u.user_id = r.user_id
+            LEFT JOIN referrals f ON u.user_id = f.user_id
             WHERE u.user_id = ?
         ''', (user_id,))
         user = cursor.fetchone()
@@ -179,8 +337,12 @@ class Database:
         
         cursor.execute('SELECT district FROM users WHERE user_id = ?', (user_id,))
         old = cursor.fetchone()
-        if old:
-            cursor.execute('UPDATE district_stats SET user_count = user_count - 1 WHERE district = ?', (old[0],))
+        if not old or old[0] == new_district:
+            conn.close()
+            return
+        cursor.execute('''
+            UPDATE district_stats SET user_count = MAX(user_count - 1, 0) WHERE district = ?
+        ''', (old[0],))
         
         cursor.execute('UPDATE users SET district = ? WHERE user_id = ?', (new_district, user_id))
         cursor.execute('''
@@ -248,30 +410,93 @@ class Database:
         conn.close()
         return bool(res and res[0] == 1)
     
+    def get_banned_ids(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM ratings WHERE banned = 1')
+        ids = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return ids
+    
+    def get_unreachable_ids(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT user_id FROM unreachable')
+        ids = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return ids
+    
+    def mark_unreachable(self, user_id, reason):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO unreachable (user_id, reason) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET reason = excluded.reason, marked_at = CURRENT_TIMESTAMP
+        ''', (user_id, reason))
+        conn.commit()
+        conn.close()
+    
+    def clear_unreachable(self, user_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM unreachable WHERE user_id = ?', (user_id,))
+        conn.commit()
+        conn.close()
+    
+    def get_usernames(self, user_ids):
+        """{user_id: (username, fetched_at)} для тех, кто есть в кеше usernames"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT user_id, username, fetched_at FROM usernames
+            WHERE user_id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list(user_ids)),))
+        names = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        conn.close()
+        return names
+    
+    def save_usernames(self, rows):
+        """rows: (user_id, username, fetched_at)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO usernames (user_id, username, fetched_at) VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, fetched_at = excluded.fetched_at
+        ''', rows)
+        conn.commit()
+        conn.close()
+    
     def ban_user(self, user_id, reason):
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('UPDATE ratings SET banned = 1, ban_reason = ? WHERE user_id = ?', (reason, user_id))
+        cursor.execute(
+            'UPDATE ratings SET banned = 1, ban_reason = ?, ban_date = CURRENT_TIMESTAMP WHERE user_id = ?',
+            (reason, user_id)
+        )
         conn.commit()
         conn.close()
     
     def unban_user(self, user_id):
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('UPDATE ratings SET banned = 0, ban_reason = NULL WHERE user_id = ?', (user_id,))
+        cursor.execute('UPDATE ratings SET banned = 0, ban_reason = NULL, ban_date = NULL WHERE user_id = ?', (user_id,))
         conn.commit()
         conn.close()
     
-    def get_banned_users(self):
+    def get_banned_users(self, key=None, forward=True, limit=15):
+        """Страница забаненных по (ban_date, user_id), последние баны сверху.
+        Пустой ban_date в курсоре — "" (см. encode_cursor), поэтому и в запросе NULL -> '' """
+        after, params, order = self._keyset(("COALESCE(r.ban_date, '')", "r.user_id"), key, forward)
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
-            SELECT u.user_id, u.nickname, u.district, r.likes, r.dislikes, r.rating, r.ban_reason
-            FROM users u
-            JOIN ratings r ON u.user_id = r.user_id
-            WHERE r.banned = 1
-            ORDER BY r.ban_date DESC
-        ''')
+        cursor.execute(f'''
+            SELECT u.user_id, u.nickname, u.district, r.likes, r.dislikes, r.rating, r.ban_reason, r.ban_date
+            FROM ratings r
+            JOIN users u ON u.user_id = r.user_id
+            WHERE r.banned = 1 AND {after}
+            ORDER BY {order}
+            LIMIT ?
+        ''', [*params, limit])
         users = cursor.fetchall()
         conn.close()
         return users
@@ -296,6 +521,9 @@ class Database:
         cursor = conn.cursor()
         cursor.execute('INSERT OR IGNORE INTO blacklist (user_id, blocked_id) VALUES (?, ?)', 
                       (user_id, blocked_id))
+        if cursor.rowcount:
+            cursor.execute('UPDATE users SET blacklist_count = blacklist_count + 1 WHERE user_id = ?', (user_id,))
+            cursor.execute('UPDATE users SET blocked_by_count = blocked_by_count + 1 WHERE user_id = ?', (blocked_id,))
         conn.commit()
         conn.close()
     
@@ -303,6 +531,11 @@ class Database:
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('DELETE FROM blacklist WHERE user_id = ? AND blocked_id = ?', (user_id, blocked_id))
+        if cursor.rowcount:
+            cursor.execute('UPDATE users SET blacklist_count = MAX(blacklist_count - 1, 0) WHERE user_id = ?',
+                           (user_id,))
+            cursor.execute('UPDATE users SET blocked_by_count = MAX(blocked_by_count - 1, 0) WHERE user_id = ?',
+                           (blocked_id,))
         conn.commit()
         conn.close()
     
@@ -320,6 +553,21 @@ class Database:
         conn.close()
         return bl
     
+    def get_match_exclusions(self, user_id, candidate_ids):
+        """Кто из candidate_ids не годится user_id в собеседники: забанен или в ЧС с ним
+        в любую сторону. Один запрос на всех кандидатов вместо трех на каждого"""
+        marks = ",".join("?" * len(candidate_ids))
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT user_id FROM ratings WHERE banned = 1 AND user_id IN ({marks})
+            UNION SELECT blocked_id FROM blacklist WHERE user_id = ? AND blocked_id IN ({marks})
+            UNION SELECT user_id FROM blacklist WHERE blocked_id = ? AND user_id IN ({marks})
+        ''', [*candidate_ids, user_id, *candidate_ids, user_id, *candidate_ids])
+        excluded = {row[0] for row in cursor.fetchall()}
+        conn.close()
+        return excluded
+    
     def is_blocked(self, user_id, target_id):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -329,21 +577,27 @@ class Database:
         return bool(res)
     
     def create_chat(self, chat_id, user1_id, user2_id, user1_nick, user2_nick, district=None):
+        self.create_chats([(chat_id, user1_id, user2_id, user1_nick, user2_nick, district)])
+    
+    def create_chats(self, rows):
+        """Пакетная запись новых чатов одним коммитом:
+        rows — (chat_id, user1_id, user2_id, user1_nick, user2_nick, district)"""
+        if not rows:
+            return
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
+        cursor.executemany('''
             INSERT INTO chats (chat_id, user1_id, user2_id, user1_nick, user2_nick, district)
             VALUES (?, ?, ?, ?, ?, ?)
-        ''', (chat_id, user1_id, user2_id, user1_nick, user2_nick, district))
+        ''', rows)
         
-        cursor.execute('UPDATE users SET total_chats = total_chats + 1 WHERE user_id IN (?, ?)', 
-                      (user1_id, user2_id))
+        cursor.executemany('UPDATE users SET total_chats = total_chats + 1 WHERE user_id IN (?, ?)', 
+                           [(row[1], row[2]) for row in rows])
         
-        if district and district != 'разные районы':
-            cursor.execute('''
-                UPDATE users SET district_chats = district_chats + 1
-                WHERE user_id IN (?, ?) AND district = ?
-            ''', (user1_id, user2_id, district))
+        cursor.executemany('''
+            UPDATE users SET district_chats = district_chats + 1
+            WHERE user_id IN (?, ?) AND district = ?
+        ''', [(row[1], row[2], row[5]) for row in rows if row[5] and row[5] != 'разные районы'])
         
         conn.commit()
         conn.close()
@@ -355,6 +609,23 @@ class Database:
         conn.commit()
         conn.close()
     
+    def get_open_chats(self):
+        """{chat_id: (user1_id, user2_id)} незакрытых чатов"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT chat_id, user1_id, user2_id FROM chats WHERE end_time IS NULL')
+        chats = {row['chat_id']: (row['user1_id'], row['user2_id']) for row in cursor.fetchall()}
+        conn.close()
+        return chats
+    
+    def end_chats(self, chat_ids):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('UPDATE chats SET end_time = CURRENT_TIMESTAMP WHERE chat_id = ?',
+                           [(cid,) for cid in chat_ids])
+        conn.commit()
+        conn.close()
+    
     def save_message(self, chat_id, from_user, to_user, from_nick, to_nick, text, msg_type='text', file_id=None):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -369,17 +640,37 @@ class Database:
         conn.commit()
         conn.close()
     
-    def search_messages(self, search_text, limit=50):
+    def save_messages(self, rows):
+        """Пакетная запись: rows — кортежи аргументов save_message одного чата и отправителя"""
+        if not rows:
+            return
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('''
+        cursor.executemany('''
+            INSERT INTO messages (chat_id, from_user, to_user, from_nick, to_nick, message_text, message_type, file_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        
+        chat_id, from_user = rows[0][0], rows[0][1]
+        cursor.execute('UPDATE chats SET message_count = message_count + ? WHERE chat_id = ?', (len(rows), chat_id))
+        cursor.execute('UPDATE users SET total_messages = total_messages + ? WHERE user_id = ?', (len(rows), from_user))
+        
+        conn.commit()
+        conn.close()
+    
+    def search_messages(self, search_text, key=None, forward=True, limit=10):
+        """Страница найденных сообщений по id, новые сверху"""
+        after, params, order = self._keyset(("m.id",), key, forward)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
             SELECT m.*, c.user1_nick, c.user2_nick
             FROM messages m
             JOIN chats c ON m.chat_id = c.chat_id
-            WHERE m.message_text LIKE ?
-            ORDER BY m.timestamp DESC
+            WHERE m.message_text LIKE ? AND {after}
+            ORDER BY {order}
             LIMIT ?
-        ''', (f'%{search_text}%', limit))
+        ''', [f'%{search_text}%', *params, limit])
         msgs = cursor.fetchall()
         conn.close()
         return msgs
@@ -397,35 +688,43 @@ class Database:
         conn.close()
         return chats
     
-    def get_user_details(self, user_id):
+    def get_user_details(self, user_id, chats_limit=3, blacklist_limit=5):
+        """Досье одним запросом: профиль, рейтинг, счетчики, последние чаты и ЧС (JSON-подзапросы)"""
         conn = self.get_connection()
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, r.ban_reason
+            SELECT u.*, r.likes, r.dislikes, r.rating, r.banned, r.ban_reason,
+                (SELECT json_group_array(json_object(
+                            'chat_id', chat_id, 'partner_id', partner_id, 'partner_nick', partner_nick,
+                            'start_time', start_time, 'message_count', message_count))
+                 FROM (SELECT * FROM (SELECT chat_id, user2_id AS partner_id, user2_nick AS partner_nick,
+                                             start_time, message_count
+                                      FROM chats WHERE user1_id = :uid
+                                      ORDER BY start_time DESC LIMIT :chats)
+                       UNION ALL
+                       SELECT * FROM (SELECT chat_id, user1_id, user1_nick, start_time, message_count
+                                      FROM chats WHERE user2_id = :uid
+                                      ORDER BY start_time DESC LIMIT :chats)
+                       ORDER BY start_time DESC LIMIT :chats)) AS recent_chats,
+                (SELECT json_group_array(json_object(
+                            'blocked_id', blocked_id, 'nickname', nickname, 'block_date', block_date))
+                 FROM (SELECT b.blocked_id, bu.nickname, b.block_date
+                       FROM blacklist b
+                       JOIN users bu ON bu.user_id = b.blocked_id
+                       WHERE b.user_id = :uid
+                       ORDER BY b.block_date DESC LIMIT :blacklist)) AS blacklist
             FROM users u
             LEFT JOIN ratings r ON u.user_id = r.user_id
-            WHERE u.user_id = ?
-        ''', (user_id,))
+            WHERE u.user_id = :uid
+        ''', {"uid": user_id, "chats": chats_limit, "blacklist": blacklist_limit})
         user = cursor.fetchone()
-        if user:
-            cursor.execute('SELECT COUNT(*) FROM chats WHERE user1_id = ? OR user2_id = ?', (user_id, user_id))
-            chats = cursor.fetchone()[0]
-            cursor.execute('SELECT COUNT(*) FROM messages WHERE from_user = ?', (user_id,))
-            msgs = cursor.fetchone()[0]
-            cursor.execute('SELECT COUNT(*) FROM blacklist WHERE user_id = ?', (user_id,))
-            bl = cursor.fetchone()[0]
-            cursor.execute('SELECT COUNT(*) FROM blacklist WHERE blocked_id = ?', (user_id,))
-            blocked_by = cursor.fetchone()[0]
-            
-            result = dict(user)
-            result['total_chats'] = chats
-            result['total_messages'] = msgs
-            result['blacklist_count'] = bl
-            result['blocked_by_count'] = blocked_by
-            conn.close()
-            return result
         conn.close()
-        return None
+        if not user:
+            return None
+        result = dict(user)
+        result['recent_chats'] = json.loads(result['recent_chats'])
+        result['blacklist'] = json.loads(result['blacklist'])
+        return result
     
     def get_district_stats(self):
         conn = self.get_connection()
@@ -435,44 +734,86 @@ class Database:
         conn.close()
         return stats
     
-    def update_online_status(self, user_id, is_online):
+    def reconcile_user_counts(self):
+        """Пересчитывает district_stats.user_count по users, возвращает {район: (было, стало)}"""
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT district FROM users WHERE user_id = ?', (user_id,))
-        user = cursor.fetchone()
-        if user:
-            if is_online:
-                cursor.execute('UPDATE district_stats SET online_now = online_now + 1 WHERE district = ?', (user[0],))
-            else:
-                cursor.execute('''
-                    UPDATE district_stats SET online_now = 
-                        CASE WHEN online_now > 0 THEN online_now - 1 ELSE 0 END
-                    WHERE district = ?
-                ''', (user[0],))
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute('SELECT district, COUNT(*) FROM users GROUP BY district')
+            actual = dict(cursor.fetchall())
+            cursor.execute('SELECT district, user_count FROM district_stats')
+            stored = dict(cursor.fetchall())
+            
+            changes = {}
+            for district in actual.keys() | stored.keys():
+                old, new = stored.get(district, 0), actual.get(district, 0)
+                if old != new:
+                    changes[district] = (old, new)
+            
+            cursor.executemany('''
+                INSERT INTO district_stats (district, user_count, online_now)
+                VALUES (?, ?, 0)
+                ON CONFLICT(district) DO UPDATE SET user_count = excluded.user_count
+            ''', [(d, new) for d, (_, new) in changes.items()])
+            conn.commit()
+            return changes
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error reconciling user counts: {e}")
+            return {}
+        finally:
+            conn.close()
+    
+    def set_online_counts(self, counts):
+        """Перезаписывает online_now всех районов одним UPDATE"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        if counts:
+            cases = " ".join("WHEN ? THEN ?" for _ in counts)
+            params = [v for item in counts.items() for v in item]
+            cursor.execute(f'UPDATE district_stats SET online_now = CASE district {cases} ELSE 0 END', params)
+        else:
+            cursor.execute('UPDATE district_stats SET online_now = 0')
         conn.commit()
         conn.close()
     
-    def get_users_by_district(self, district, exclude_user_id=None):
+    def get_districts(self, user_ids):
         conn = self.get_connection()
         cursor = conn.cursor()
-        if exclude_user_id:
-            cursor.execute('''
-                SELECT u.user_id, u.nickname, u.district, u.last_activity, 
-                       u.total_chats, u.total_messages, r.likes, r.dislikes, r.rating, r.banned
-                FROM users u
-                LEFT JOIN ratings r ON u.user_id = r.user_id
-                WHERE u.district = ? AND u.user_id != ? AND r.banned = 0
-                ORDER BY u.last_activity DESC
-            ''', (district, exclude_user_id))
-        else:
-            cursor.execute('''
-                SELECT u.user_id, u.nickname, u.district, u.last_activity, 
-                       u.total_chats, u.total_messages, r.likes, r.dislikes, r.rating, r.banned
-                FROM users u
-                LEFT JOIN ratings r ON u.user_id = r.user_id
-                WHERE u.district = ?
-                ORDER BY u.last_activity DESC
-            ''', (district,))
+        cursor.execute('''
+            SELECT user_id, district FROM users
+            WHERE user_id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list(user_ids)),))
+        districts = {row[0]: row[1] for row in cursor.fetchall()}
+        conn.close()
+        return districts
+    
+    @staticmethod
+    def _keyset(columns, key, forward):
+        """Условие и порядок для keyset-страницы: строки строго после key по columns"""
+        cols = ", ".join(columns)
+        order = ", ".join(f"{c} {'DESC' if forward else 'ASC'}" for c in columns)
+        if key is None:
+            return "1", [], order
+        marks = ", ".join("?" for _ in columns)
+        return f"({cols}) {'<' if forward else '>'} ({marks})", list(key), order
+    
+    def get_users_by_district(self, district, key=None, forward=True, limit=10):
+        """Страница пользователей района по users.id, новые сверху.
+        Ключ не меняется со временем: строки не повторяются и не пропадают между страницами"""
+        after, params, order = self._keyset(("u.id",), key, forward)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT u.user_id, u.nickname, u.district, u.last_activity, 
+                   u.total_chats, u.total_messages, r.likes, r.dislikes, r.rating, r.banned, u.id
+            FROM users u
+            LEFT JOIN ratings r ON u.user_id = r.user_id
+            WHERE u.district = ? AND {after}
+            ORDER BY {order}
+            LIMIT ?
+        ''', [district, *params, limit])
         users = cursor.fetchall()
         conn.close()
         return users
@@ -505,6 +846,155 @@ class Database:
         conn.commit()
         conn.close()
     
+    def add_hourly_counters(self, rows):
+        """rows: (hour, district, messages, chats_started, chats_ended, searches, matches, wait_total)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO analytics_hourly
+                (hour, district, messages, chats_started, chats_ended, searches, matches, wait_total)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(hour, district) DO UPDATE SET
+                messages = messages + excluded.messages,
+                chats_started = chats_started + excluded.chats_started,
+                chats_ended = chats_ended + excluded.chats_ended,
+                searches = searches + excluded.searches,
+                matches = matches + excluded.matches,
+                wait_total = wait_total + excluded.wait_total
+        ''', rows)
+        conn.commit()
+        conn.close()
+    
+    def add_hourly_active(self, hour, deltas):
+        """Прибавляет активных за час: процессы кластера видят непересекающихся пользователей"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO analytics_hourly (hour, district, active_users) VALUES (?, ?, ?)
+            ON CONFLICT(hour, district) DO UPDATE SET active_users = active_users + excluded.active_users
+        ''', [(hour, district, delta) for district, delta in deltas.items()])
+        conn.commit()
+        conn.close()
+    
+    def save_activity_days(self, rows):
+        """rows: (user_id, day, district); повторная активность за день игнорируется"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('INSERT OR IGNORE INTO user_activity_days (user_id, day, district) VALUES (?, ?, ?)', rows)
+        conn.commit()
+        conn.close()
+    
+    def rollup_analytics(self, keep_days=30):
+        """Сворачивает часы с последнего свернутого дня по сегодня в analytics_daily, старые часы удаляет.
+        Последний день пересчитывается: до полуночи он был свернут не целиком"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO analytics_daily
+                (day, district, messages, chats_started, chats_ended, searches, matches, wait_total, active_users)
+            SELECT substr(h.hour, 1, 10) AS day, h.district,
+                   SUM(h.messages), SUM(h.chats_started), SUM(h.chats_ended),
+                   SUM(h.searches), SUM(h.matches), SUM(h.wait_total),
+                   (SELECT COUNT(*) FROM user_activity_days a
+                    WHERE a.day = substr(h.hour, 1, 10) AND COALESCE(a.district, '—') = h.district)
+            FROM analytics_hourly h
+            WHERE h.hour >= COALESCE((SELECT MAX(day) FROM analytics_daily), '')
+            GROUP BY day, h.district
+            ON CONFLICT(day, district) DO UPDATE SET
+                messages = excluded.messages,
+                chats_started = excluded.chats_started,
+                chats_ended = excluded.chats_ended,
+                searches = excluded.searches,
+                matches = excluded.matches,
+                wait_total = excluded.wait_total,
+                active_users = excluded.active_users
+        ''')
+        cursor.execute("DELETE FROM analytics_hourly WHERE hour < strftime('%Y-%m-%d', 'now', ?)",
+                       (f'-{keep_days} days',))
+        conn.commit()
+        conn.close()
+    
+    def update_retention(self):
+        """Пересчитывает D1/D7/D30 только для когорт последних 31 дня — более старые уже не меняются"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO cohort_retention (cohort, size, d1, d7, d30)
+            SELECT DATE(u.join_date) AS cohort, COUNT(*),
+                   SUM(EXISTS(SELECT 1 FROM user_activity_days a
+                              WHERE a.user_id = u.user_id AND a.day = DATE(u.join_date, '+1 day'))),
+                   SUM(EXISTS(SELECT 1 FROM user_activity_days a
+                              WHERE a.user_id = u.user_id AND a.day = DATE(u.join_date, '+7 day'))),
+                   SUM(EXISTS(SELECT 1 FROM user_activity_days a
+                              WHERE a.user_id = u.user_id AND a.day = DATE(u.join_date, '+30 day')))
+            FROM users u
+            WHERE u.join_date >= DATE('now', '-31 days')
+            GROUP BY cohort
+            ON CONFLICT(cohort) DO UPDATE SET
+                size = excluded.size, d1 = excluded.d1, d7 = excluded.d7, d30 = excluded.d30,
+                updated_at = CURRENT_TIMESTAMP
+        ''')
+        conn.commit()
+        conn.close()
+    
+    def get_analytics_daily(self, days=7):
+        """Итоги по дням; активные — различные пользователи за день, а не сумма по районам"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT day, SUM(messages) AS messages, SUM(chats_started) AS chats_started,
+                   SUM(chats_ended) AS chats_ended, SUM(searches) AS searches,
+                   SUM(matches) AS matches, SUM(wait_total) AS wait_total,
+                   (SELECT COUNT(DISTINCT a.user_id) FROM user_activity_days a
+                    WHERE a.day = d.day) AS active_users
+            FROM analytics_daily d
+            WHERE day >= DATE('now', ?)
+            GROUP BY day
+            ORDER BY day DESC
+        ''', (f'-{days - 1} days',))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+    
+    def get_analytics_weekly(self, weeks=4):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT strftime('%Y-%W', d.day) AS week, MIN(d.day) AS since,
+                   SUM(d.messages) AS messages, SUM(d.chats_started) AS chats_started,
+                   SUM(d.matches) AS matches, SUM(d.wait_total) AS wait_total,
+                   (SELECT COUNT(DISTINCT a.user_id) FROM user_activity_days a
+                    WHERE strftime('%Y-%W', a.day) = strftime('%Y-%W', d.day)
+                      AND a.day >= DATE('now', ?)) AS active_users
+            FROM analytics_daily d
+            WHERE d.day >= DATE('now', ?)
+            GROUP BY week
+            ORDER BY week DESC
+        ''', (f'-{weeks * 7} days', f'-{weeks * 7} days'))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+    
+    def get_analytics_districts(self, day):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT district, messages, chats_started, active_users
+            FROM analytics_daily WHERE day = ?
+            ORDER BY active_users DESC
+        ''', (day,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+    
+    def get_retention(self, limit=14):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT cohort, size, d1, d7, d30 FROM cohort_retention ORDER BY cohort DESC LIMIT ?', (limit,))
+        rows = cursor.fetchall()
+        conn.close()
+        return rows
+    
     def get_all_stats(self):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -542,6 +1032,160 @@ class Database:
             'daily_stats': daily
         }
     
+    @staticmethod
+    def _segment_filter(segment):
+        """Условия WHERE для аудитории рассылки (см. segments.parse_segment)"""
+        clauses = ['COALESCE(r.banned, 0) = 0', 'u.user_id NOT IN (SELECT user_id FROM unreachable)']
+        params = []
+        segment = segment or {}
+        if "districts" in segment:
+            clauses.append('u.district IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(segment["districts"]))
+        if "active_days" in segment:
+            clauses.append("u.last_activity >= datetime('now', ?)")
+            params.append(f'-{int(segment["active_days"])} days')
+        if "min_rating" in segment:
+            clauses.append('COALESCE(r.rating, 50.0) >= ?')
+            params.append(segment["min_rating"])
+        if "min_chats" in segment:
+            clauses.append('u.total_chats >= ?')
+            params.append(segment["min_chats"])
+        if segment.get("has_referrals"):
+            clauses.append('u.user_id IN (SELECT user_id FROM referrals WHERE count > 0)')
+        # Рассылки, созданные до переноса рефералов в БД, хранят готовый список
+        if "referrers" in segment:
+            clauses.append('u.user_id IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps(segment["referrers"]))
+        return ' AND '.join(clauses), params
+    
+    def count_broadcast_recipients(self, segment=None):
+        """Сколько пользователей получит рассылку (забаненные исключены)"""
+        where, params = self._segment_filter(segment)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT COUNT(*) FROM users u
+            LEFT JOIN ratings r ON u.user_id = r.user_id
+            WHERE {where}
+        ''', params)
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+    
+    def get_broadcast_recipients(self, after_user_id, limit, segment=None):
+        """Следующая порция получателей после after_user_id (keyset по users.user_id)"""
+        where, params = self._segment_filter(segment)
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute(f'''
+            SELECT u.user_id FROM users u
+            LEFT JOIN ratings r ON u.user_id = r.user_id
+            WHERE u.user_id > ? AND {where}
+            ORDER BY u.user_id
+            LIMIT ?
+        ''', [after_user_id, *params, limit])
+        ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return ids
+    
+    def create_broadcast(self, admin_id, text, total, progress_chat_id=None, progress_message_id=None, segment=None):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO broadcast_jobs (admin_id, text, total, progress_chat_id, progress_message_id, segment)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (admin_id, text, total, progress_chat_id, progress_message_id,
+              json.dumps(segment, ensure_ascii=False) if segment else None))
+        job_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return job_id
+    
+    def get_broadcast(self, job_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM broadcast_jobs WHERE id = ?', (job_id,))
+        job = cursor.fetchone()
+        conn.close()
+        return job
+    
+    def get_running_broadcasts(self):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+        jobs = cursor.fetchall()
+        conn.close()
+        return jobs
+    
+    def checkpoint_broadcast(self, job_id, cursor_id, sent, failed):
+        """Запоминает, до какого user_id рассылка дошла"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcast_jobs SET cursor = ?, sent = ?, failed = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (cursor_id, sent, failed, job_id))
+        conn.commit()
+        conn.close()
+    
+    def finish_broadcast(self, job_id, status='done'):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (status, job_id))
+        conn.commit()
+        conn.close()
+    
+    def get_referral(self, user_id):
+        """(приглашено, использовано защит)"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT count, protections_used FROM referrals WHERE user_id = ?', (user_id,))
+        row = cursor.fetchone()
+        conn.close()
+        return (row['count'], row['protections_used']) if row else (0, 0)
+    
+    def add_referral(self, referrer_id):
+        """+1 приглашенный; возвращает новое количество"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO referrals (user_id, count) VALUES (?, 1)
+            ON CONFLICT(user_id) DO UPDATE SET count = count + 1
+        ''', (referrer_id,))
+        cursor.execute('SELECT count FROM referrals WHERE user_id = ?', (referrer_id,))
+        count = cursor.fetchone()[0]
+        conn.commit()
+        conn.close()
+        return count
+    
+    def use_protection(self, user_id):
+        """Списывает защиту от дизлайка (одна на двух приглашенных), если она есть"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.execute('''
+            UPDATE referrals SET protections_used = protections_used + 1
+            WHERE user_id = ? AND count / 2 > protections_used
+        ''', (user_id,))
+        used = cursor.rowcount > 0
+        conn.commit()
+        conn.close()
+        return used
+    
+    def import_referrals(self, data):
+        """Перенос из старого referrals.json; уже перенесенные записи не трогает"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT OR IGNORE INTO referrals (user_id, count, protections_used) VALUES (?, ?, ?)
+        ''', [(int(uid), info.get("count", 0), info.get("protections_used", 0)) for uid, info in data.items()])
+        imported = cursor.rowcount
+        conn.commit()
+        conn.close()
+        return imported
+    
     def log_admin_action(self, admin_id, action, target_id=None, details=None):
         conn = self.get_connection()
         cursor = conn.cursor()
@@ -552,10 +1196,58 @@ class Database:
         conn.commit()
         conn.close()
     
-    def get_admin_logs(self, limit=50):
+    def get_admin_logs(self, filters=None, key=None, forward=True, limit=15):
+        """Страница журнала по (timestamp, id) с фильтрами из audit.parse_log_filter;
+        ники админа и цели подтягиваются тем же запросом"""
+        filters = filters or {}
+        clauses, params = [], []
+        for column in ("admin_id", "target_id", "action"):
+            if column in filters:
+                clauses.append(f"l.{column} = ?")
+                params.append(filters[column])
+        if "since" in filters:
+            clauses.append("l.timestamp >= ?")
+            params.append(filters["since"])
+        if "until" in filters:
+            clauses.append("l.timestamp < DATE(?, '+1 day')")
+            params.append(filters["until"])
+        after, key_params, order = self._keyset(("l.timestamp", "l.id"), key, forward)
+        clauses.append(after)
+        
         conn = self.get_connection()
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM admin_logs ORDER BY timestamp DESC LIMIT ?', (limit,))
+        cursor.execute(f'''
+            SELECT l.*, a.nickname AS admin_nick, t.nickname AS target_nick
+            FROM admin_logs l
+            LEFT JOIN users a ON a.user_id = l.admin_id
+            LEFT JOIN users t ON t.user_id = l.target_id
+            WHERE {' AND '.join(clauses)}
+            ORDER BY {order}
+            LIMIT ?
+        ''', [*params, *key_params, limit])
         logs = cursor.fetchall()
         conn.close()
-        return logs
\ No newline at end of file
+        return logs
+    
+    def archive_admin_logs(self, days):
+        """Переносит записи старше days дней в admin_logs_archive, возвращает их число"""
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cutoff = (f'-{days} days',)
+            cursor.execute('''
+                INSERT OR IGNORE INTO admin_logs_archive (id, admin_id, action, target_id, details, timestamp)
+                SELECT id, admin_id, action, target_id, details, timestamp
+                FROM admin_logs WHERE timestamp < DATETIME('now', ?)
+            ''', cutoff)
+            cursor.execute("DELETE FROM admin_logs WHERE timestamp < DATETIME('now', ?)", cutoff)
+            moved = cursor.rowcount
+            conn.commit()
+            return moved
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error archiving admin logs: {e}")
+            return 0
+        finally:
+            conn.close()
\ No newline at end of file
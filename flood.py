@@ -0,0 +1,105 @@
+from array import array
+
+FLOOD_OK = 0
+FLOOD_DROP = 1
+FLOOD_WARN = 2
+FLOOD_MUTE = 3
+FLOOD_FLAG = 4
+
+
+class FloodControl:
+    """Антифлуд на жетонах. Состояние пользователей лежит в плоских массивах по номеру слота,
+    поэтому проверка — O(1) без создания объектов на каждое сообщение."""
+
+    def __init__(self, burst=8, rate=1.0, warn_after=3, mute_after=10, mute_seconds=120,
+                 flag_after=3, capacity=1024):
+        self.burst = float(burst)
+        self.rate = float(rate)
+        self.warn_after = warn_after
+        self.mute_after = mute_after
+        self.mute_seconds = mute_seconds
+        self.flag_after = flag_after
+        self._slot = {}
+        self._free = []
+        self._tokens = array('d')
+        self._stamp = array('d')
+        self._muted_until = array('d')
+        self._strikes = array('l')
+        self._mutes = array('l')
+        # user_id -> (media_group_id, решение по первой части): альбом стоит один жетон
+        self._groups = {}
+        self._grow(capacity)
+
+    def _grow(self, count):
+        start = len(self._tokens)
+        self._tokens.extend([0.0] * count)
+        self._stamp.extend([0.0] * count)
+        self._muted_until.extend([0.0] * count)
+        self._strikes.extend([0] * count)
+        self._mutes.extend([0] * count)
+        self._free.extend(range(start + count - 1, start - 1, -1))
+
+    def _slot_of(self, user_id, now):
+        i = self._slot.get(user_id)
+        if i is None:
+            if not self._free:
+                self._grow(len(self._tokens))
+            i = self._free.pop()
+            self._slot[user_id] = i
+            self._tokens[i] = self.burst
+            self._stamp[i] = now
+            self._muted_until[i] = 0.0
+            self._strikes[i] = 0
+            self._mutes[i] = 0
+        return i
+
+    def check(self, user_id, now, group=None):
+        """Списывает жетон за сообщение и возвращает одно из FLOOD_*.
+        group — media_group_id: остальные части альбома повторяют решение по первой"""
+        if group is not None:
+            last = self._groups.get(user_id)
+            if last is not None and last[0] == group:
+                return FLOOD_OK if last[1] == FLOOD_OK else FLOOD_DROP
+            verdict = self._check(user_id, now)
+            self._groups[user_id] = (group, verdict)
+            return verdict
+        return self._check(user_id, now)
+
+    def _check(self, user_id, now):
+        i = self._slot_of(user_id, now)
+        if self._muted_until[i] > now:
+            return FLOOD_DROP
+
+        tokens = self._tokens[i] + (now - self._stamp[i]) * self.rate
+        if tokens >= self.burst:
+            tokens = self.burst
+            self._strikes[i] = 0
+        self._stamp[i] = now
+
+        if tokens >= 1.0:
+            self._tokens[i] = tokens - 1.0
+            return FLOOD_OK
+
+        self._tokens[i] = tokens
+        self._strikes[i] += 1
+        strikes = self._strikes[i]
+        if strikes >= self.mute_after:
+            self._strikes[i] = 0
+            self._muted_until[i] = now + self.mute_seconds
+            self._mutes[i] += 1
+            return FLOOD_FLAG if self._mutes[i] >= self.flag_after else FLOOD_MUTE
+        if strikes == self.warn_after:
+            return FLOOD_WARN
+        return FLOOD_DROP
+
+    def release(self, user_id, now):
+        """Освобождает слот после чата; замьюченные и нарушители сохраняют историю"""
+        self._groups.pop(user_id, None)
+        i = self._slot.get(user_id)
+        if i is None or self._muted_until[i] > now or self._mutes[i]:
+            return
+        del self._slot[user_id]
+        self._free.append(i)
+
+    def __len__(self):
+        return len(self._slot)
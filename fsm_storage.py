@@ -0,0 +1,155 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+from config import DB_NAME
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM хранилище в SQLite: LRU-кеш в памяти, пакетная запись и TTL для брошенных состояний"""
+
+    def __init__(self, db_name=DB_NAME, cache_size=10000, ttl=86400, flush_interval=2.0):
+        self.db_name = db_name
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # key -> [state, data, updated_at]
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._task = None
+        self._init_table()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_name)
+
+    def _init_table(self):
+        conn = self._connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                state TEXT,
+                data TEXT,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage(updated_at)')
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def _key(key):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+    def _entry(self, key):
+        k = self._key(key)
+        entry = self._cache.get(k)
+        if entry is not None:
+            self._cache.move_to_end(k)
+        else:
+            entry = self._dirty.get(k)
+            if entry is None:
+                conn = self._connect()
+                row = conn.execute('SELECT state, data, updated_at FROM fsm_storage WHERE key = ?', (k,)).fetchone()
+                conn.close()
+                if row:
+                    entry = [row[0], json.loads(row[1]) if row[1] else {}, row[2]]
+                else:
+                    entry = [None, {}, time.time()]
+            self._cache[k] = entry
+            # Вытесняем только из кеша: несохраненные записи остаются в _dirty до сброса
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        if entry[0] is not None or entry[1]:
+            if time.time() - entry[2] > self.ttl:
+                entry[0], entry[1] = None, {}
+        return k, entry
+
+    def _touch(self, k, entry):
+        entry[2] = time.time()
+        self._dirty[k] = entry
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key, state=None):
+        k, entry = self._entry(key)
+        entry[0] = state.state if isinstance(state, State) else state
+        self._touch(k, entry)
+
+    async def get_state(self, key):
+        return self._entry(key)[1][0]
+
+    async def set_data(self, key, data):
+        k, entry = self._entry(key)
+        entry[1] = data.copy()
+        self._touch(k, entry)
+
+    async def get_data(self, key):
+        return self._entry(key)[1][1].copy()
+
+    def flush(self):
+        """Пишет накопленные изменения одной транзакцией"""
+        if not self._dirty:
+            return 0
+        dirty, self._dirty = self._dirty, {}
+        upserts = []
+        deletes = []
+        for k, (state, data, updated_at) in dirty.items():
+            if state is None and not data:
+                deletes.append((k,))
+            else:
+                upserts.append((k, state, json.dumps(data, ensure_ascii=False), updated_at))
+        conn = self._connect()
+        try:
+            conn.executemany('''
+                INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+            ''', upserts)
+            conn.executemany('DELETE FROM fsm_storage WHERE key = ?', deletes)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"Ошибка записи FSM: {e}")
+            # Вернем изменения, чтобы повторить при следующем сбросе
+            for k, entry in dirty.items():
+                self._dirty.setdefault(k, entry)
+            return 0
+        finally:
+            conn.close()
+        return len(dirty)
+
+    def expire(self):
+        """Удаляет состояния, не менявшиеся дольше ttl"""
+        deadline = time.time() - self.ttl
+        stale = [k for k, entry in self._cache.items() if entry[2] < deadline and k not in self._dirty]
+        for k in stale:
+            del self._cache[k]
+        conn = self._connect()
+        removed = conn.execute('DELETE FROM fsm_storage WHERE updated_at < ?', (deadline,)).rowcount
+        conn.commit()
+        conn.close()
+        return removed
+
+    async def _flush_loop(self):
+        last_expire = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+            if time.monotonic() - last_expire > 600:
+                last_expire = time.monotonic()
+                removed = self.expire()
+                if removed:
+                    logger.info(f"FSM: удалено брошенных состояний: {removed}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self.flush()
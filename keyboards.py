@@ -1,101 +1,222 @@
+from functools import lru_cache
+
+from aiohttp import FormData
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import TYUMEN_DISTRICTS
+from callbacks import (RateCallback, BlacklistAddCallback, BlacklistRemoveCallback, DistrictCallback,
+                       ChangeDistrictCallback, BanCallback, UnbanCallback)
 
-def main_menu():
+# Клавиатуры собираются один раз: модели pydantic дорогие в построении, а разметка не меняется.
+# Функции отдают общие объекты — менять их нельзя, только отправлять
+
+
+def _markup(rows):
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔍 Найти собеседника", callback_data="search_menu")],
-        [
-            InlineKeyboardButton(text="🗺️ Районы", callback_data="districts_menu"),
-            InlineKeyboardButton(text="🏆 Топ", callback_data="top_rating")
-        ],
-        [
-            InlineKeyboardButton(text="⚙️ Настройки", callback_data="settings"),
-            InlineKeyboardButton(text="🤝 Рефералы", callback_data="ref_menu"),  # Новая кнопка
-            InlineKeyboardButton(text="🚫 ЧС", callback_data="blacklist")
-        ]
+        [InlineKeyboardButton(**button) for button in row] for row in rows
     ])
 
+def _district_rows(factory, back):
+    rows = []
+    for i, d in enumerate(TYUMEN_DISTRICTS, 1):
+        button = dict(text=d, callback_data=factory(index=i).pack())
+        if rows and len(rows[-1]) < 2:
+            rows[-1].append(button)
+        else:
+            rows.append([button])
+    rows.append([dict(text="◀️ Назад", callback_data=back)])
+    return rows
+
+
+_MAIN_MENU = _markup([
+    [dict(text="🔍 Найти собеседника", callback_data="search_menu")],
+    [
+        dict(text="🗺️ Районы", callback_data="districts_menu"),
+        dict(text="🏆 Топ", callback_data="top_rating")
+    ],
+    [
+        dict(text="⚙️ Настройки", callback_data="settings"),
+        dict(text="🤝 Рефералы", callback_data="ref_menu"),
+        dict(text="🚫 ЧС", callback_data="blacklist")
+    ]
+])
+
+_SEARCH_MENU = _markup([
+    [dict(text="🌍 По всей Тюмени", callback_data="search_all")],
+    [dict(text="🏘️ В моем районе", callback_data="search_district")],
+    [dict(text="◀️ Назад", callback_data="menu")]
+])
+
+_CANCEL_SEARCH = _markup([
+    [dict(text="❌ Отменить поиск", callback_data="cancel_search")]
+])
+
+_DISTRICTS = _markup(_district_rows(DistrictCallback, "menu"))
+
+_SETTINGS_MENU = _markup([
+    [dict(text="👤 Сменить ник", callback_data="change_nick")],
+    [dict(text="🏘️ Сменить район", callback_data="change_district")],
+    [dict(text="🕵️ Анонимность", callback_data="toggle_anon")],
+    [dict(text="◀️ Назад", callback_data="menu")]
+])
+
+_CHANGE_DISTRICT = _markup(_district_rows(ChangeDistrictCallback, "settings"))
+
+_BLACKLIST_MENU = _markup([
+    [dict(text="📋 Показать ЧС", callback_data="show_blacklist")],
+    [dict(text="◀️ Назад", callback_data="menu")]
+])
+
+_ADMIN_MENU = _markup([
+    [dict(text="📊 Статистика", callback_data="admin_stats")],
+    [dict(text="👥 Онлайн", callback_data="admin_online")],
+    [dict(text="🗺️ Районы", callback_data="admin_districts")],
+    [dict(text="🔍 Поиск района", callback_data="admin_search_district")],
+    [dict(text="🔍 Поиск сообщений", callback_data="admin_search_messages")],
+    [dict(text="📈 По дням", callback_data="admin_daily")],
+    [dict(text="📊 Аналитика", callback_data="admin_analytics")],
+    [dict(text="👤 Детали", callback_data="admin_user_details")],
+    [dict(text="🔨 Баны", callback_data="admin_bans")],
+    [dict(text="📤 Рассылка", callback_data="admin_broadcast")],
+    [dict(text="📥 Скачать БД", callback_data="admin_getdb")],
+    [dict(text="📋 Логи", callback_data="admin_logs")],
+    [dict(text="◀️ Назад", callback_data="menu")]
+])
+
+_ANALYTICS_MENU = _markup([
+    [
+        dict(text="📅 Недели", callback_data="admin_analytics_weekly"),
+        dict(text="👥 Удержание", callback_data="admin_retention")
+    ],
+    [dict(text="◀️ Назад", callback_data="admin_menu")]
+])
+
+_BROADCAST_CONFIRM = _markup([
+    [
+        dict(text="✅ Отправить", callback_data="broadcast_confirm_send"),
+        dict(text="❌ Отмена", callback_data="broadcast_confirm_cancel")
+    ]
+])
+
+_CANCEL = _markup([
+    [dict(text="❌ Отмена", callback_data="cancel")]
+])
+
+_CHAT_ACTIONS = _markup([
+    [dict(text="🚫 Завершить чат", callback_data="stop")]
+])
+
+# Статические клавиатуры: их JSON для Bot API тоже считается один раз (см. SharedMarkupSession)
+_STATIC = (_MAIN_MENU, _SEARCH_MENU, _CANCEL_SEARCH, _DISTRICTS, _SETTINGS_MENU, _CHANGE_DISTRICT,
+           _BLACKLIST_MENU, _ADMIN_MENU, _ANALYTICS_MENU, _BROADCAST_CONFIRM, _CANCEL, _CHAT_ACTIONS)
+
+
+def main_menu():
+    return _MAIN_MENU
+
 def search_menu_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🌍 По всей Тюмени", callback_data="search_all")],
-        [InlineKeyboardButton(text="🏘️ В моем районе", callback_data="search_district")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    return _SEARCH_MENU
+
+def cancel_search_keyboard():
+    return _CANCEL_SEARCH
 
 def districts_keyboard():
-    buttons = []
-    row = []
-    for i, d in enumerate(TYUMEN_DISTRICTS, 1):
-        row.append(InlineKeyboardButton(text=d, callback_data=f"district_{i}"))
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="menu")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return _DISTRICTS
 
 def settings_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="👤 Сменить ник", callback_data="change_nick")],
-        [InlineKeyboardButton(text="🏘️ Сменить район", callback_data="change_district")],
-        [InlineKeyboardButton(text="🕵️ Анонимность", callback_data="toggle_anon")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    return _SETTINGS_MENU
 
 def change_district_keyboard():
-    buttons = []
-    row = []
-    for i, d in enumerate(TYUMEN_DISTRICTS, 1):
-        row.append(InlineKeyboardButton(text=d, callback_data=f"change_district_{i}"))
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data="settings")])
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
+    return _CHANGE_DISTRICT
 
 def blacklist_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📋 Показать ЧС", callback_data="show_blacklist")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    return _BLACKLIST_MENU
 
 def admin_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Статистика", callback_data="admin_stats")],
-        [InlineKeyboardButton(text="👥 Онлайн", callback_data="admin_online")],
-        [InlineKeyboardButton(text="🗺️ Районы", callback_data="admin_districts")],
-        [InlineKeyboardButton(text="🔍 Поиск района", callback_data="admin_search_district")],
-        [InlineKeyboardButton(text="🔍 Поиск сообщений", callback_data="admin_search_messages")],
-        [InlineKeyboardButton(text="📈 По дням", callback_data="admin_daily")],
-        [InlineKeyboardButton(text="👤 Детали", callback_data="admin_user_details")],
-        [InlineKeyboardButton(text="🔨 Баны", callback_data="admin_bans")],
-        [InlineKeyboardButton(text="📤 Рассылка", callback_data="admin_broadcast")],
-        [InlineKeyboardButton(text="📥 Скачать БД", callback_data="admin_getdb")],
-        [InlineKeyboardButton(text="📋 Логи", callback_data="admin_logs")],
-        [InlineKeyboardButton(text="◀️ Назад", callback_data="menu")]
-    ])
+    return _ADMIN_MENU
+
+def analytics_menu():
+    return _ANALYTICS_MENU
+
+def broadcast_confirm_keyboard():
+    return _BROADCAST_CONFIRM
 
 def cancel_keyboard():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")]
-    ])
+    return _CANCEL
 
 def chat_actions():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🚫 Завершить чат", callback_data="stop")]
-    ])
+    return _CHAT_ACTIONS
+
 
+# Клавиатуры с параметрами кешируются по ключу: оценку после чата получают оба собеседника,
+# а список ЧС перерисовывается на каждое удаление
+
+@lru_cache(maxsize=4096)
 def rating_keyboard(partner_id):
-    return InlineKeyboardMarkup(inline_keyboard=[
+    return _markup([
         [
-            InlineKeyboardButton(text="👍", callback_data=f"like_{partner_id}"),
-            InlineKeyboardButton(text="👎", callback_data=f"dislike_{partner_id}")
+            dict(text="👍", callback_data=RateCallback(action="like", partner_id=partner_id).pack()),
+            dict(text="👎", callback_data=RateCallback(action="dislike", partner_id=partner_id).pack())
         ],
         [
-            InlineKeyboardButton(text="🚫 В ЧС", callback_data=f"blacklist_add_{partner_id}"),
-            InlineKeyboardButton(text="🔍 Новый поиск", callback_data="search_menu")
+            dict(text="🚫 В ЧС", callback_data=BlacklistAddCallback(user_id=partner_id).pack()),
+            dict(text="🔍 Новый поиск", callback_data="search_menu")
         ]
     ])
+
+@lru_cache(maxsize=1024)
+def blacklist_keyboard(entries):
+    """entries — кортеж (blocked_id, nickname), чтобы служить ключом кеша"""
+    rows = [[dict(text=f"❌ {nickname}", callback_data=BlacklistRemoveCallback(user_id=blocked_id).pack())]
+            for blocked_id, nickname in entries]
+    rows.append([dict(text="◀️ Назад", callback_data="blacklist")])
+    return _markup(rows)
+
+@lru_cache(maxsize=256)
+def admin_user_keyboard(user_id):
+    return _markup([
+        [
+            dict(text="🔨 Забанить", callback_data=BanCallback(user_id=user_id).pack()),
+            dict(text="✅ Разбанить", callback_data=UnbanCallback(user_id=user_id).pack())
+        ],
+        [dict(text="◀️ Назад", callback_data="admin_user_details")]
+    ])
+
+@lru_cache(maxsize=1024)
+def referral_keyboard(ref_link):
+    return _markup([
+        [dict(text="🔗 Поделиться ссылкой",
+              url=f"https://t.me/share/url?url={ref_link}&text=Присоединяйся%20к%20ТюменьChat!")]
+    ])
+
+
+class SharedMarkupSession(AiohttpSession):
+    """Сессия Bot API, которая не сериализует статические клавиатуры заново:
+    их JSON считается при первой отправке и дальше берется готовым.
+
+    Перехватывается build_form_data: дальше метод уже превращен в словарь
+    через model_dump, и общий объект клавиатуры по id не узнать"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._static_ids = {id(markup) for markup in _STATIC}
+        self._serialized = {}
+
+    def build_form_data(self, bot, method):
+        markup = getattr(method, "reply_markup", None)
+        if id(markup) not in self._static_ids:
+            return super().build_form_data(bot, method)
+
+        form = FormData(quote_fields=False)
+        files = {}
+        for key, value in method.model_dump(warnings=False, exclude={"reply_markup"}).items():
+            value = self.prepare_value(value, bot=bot, files=files)
+            if value:
+                form.add_field(key, value)
+        cached = self._serialized.get(id(markup))
+        if cached is None:
+            cached = self._serialized[id(markup)] = self.prepare_value(markup, bot=bot, files=files)
+        form.add_field("reply_markup", cached)
+        for key, value in files.items():
+            form.add_field(key, value.read(bot), filename=value.filename or key)
+        return form
@@ -0,0 +1,53 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class KeyedLock:
+    """Набор asyncio.Lock по ключу (например, user_id), неиспользуемые замки удаляются"""
+
+    def __init__(self):
+        self._locks = {}
+        self._waiters = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+            self._waiters[key] = 0
+        self._waiters[key] += 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class ShardedLock:
+    """Фиксированный пул замков, ключ попадает в шард по хешу"""
+
+    def __init__(self, shards=64):
+        self._shards = [asyncio.Lock() for _ in range(shards)]
+
+    def shard_of(self, key):
+        return hash(key) % len(self._shards)
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        # Шарды берутся в порядке возрастания номера, чтобы не было взаимных блокировок
+        indexes = sorted({self.shard_of(k) for k in keys if k is not None})
+        acquired = []
+        try:
+            for i in indexes:
+                await self._shards[i].acquire()
+                acquired.append(i)
+            yield
+        finally:
+            for i in reversed(acquired):
+                self._shards[i].release()
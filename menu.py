@@ -0,0 +1,75 @@
+import logging
+import time
+
+from aiogram.exceptions import TelegramBadRequest
+
+from cache import BoundedDict
+
+logger = logging.getLogger(__name__)
+
+# Поля users/ratings/referrals, которые нужны экранам меню и настроек
+PROFILE_FIELDS = ("user_id", "nickname", "district", "anon_mode", "rating", "referrals")
+
+
+class ProfileCache:
+    """Профили для меню без похода в БД на каждое нажатие.
+    Запись сбрасывается при изменении профиля (invalidate), ttl страхует от пропущенного сброса"""
+
+    def __init__(self, db, maxlen=10000, ttl=300):
+        self.db = db
+        self.ttl = ttl
+        # user_id -> (профиль, когда прочитан)
+        self._profiles = BoundedDict(maxlen, ttl=ttl)
+
+    def get(self, user_id):
+        cached = self._profiles.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            return cached[0]
+        user = self.db.get_user(user_id)
+        if not user:
+            return None
+        profile = {field: user[field] for field in PROFILE_FIELDS}
+        self._profiles[user_id] = (profile, time.monotonic())
+        return profile
+
+    def invalidate(self, user_id):
+        self._profiles.pop(user_id)
+
+    def prune(self):
+        return self._profiles.prune()
+
+
+class Screens:
+    """Что бот последним показал в каждом своем сообщении: повторный показ того же экрана
+    не тратит запрос edit_text, а «message is not modified» не превращается в новое сообщение"""
+
+    def __init__(self, maxlen=10000):
+        # (chat_id, message_id) -> (текст, клавиатура)
+        self._shown = BoundedDict(maxlen)
+
+    def _remember(self, message, text, reply_markup):
+        self._shown[(message.chat.id, message.message_id)] = (text, reply_markup)
+
+    async def show(self, message, text, reply_markup=None, edit=True):
+        """Редактирует message на новый экран или, если это невозможно, отправляет новое сообщение.
+        edit=False — message от пользователя, его не отредактировать: сразу отправляем"""
+        if edit:
+            shown = self._shown.get((message.chat.id, message.message_id))
+            # Клавиатуры — общие объекты из keyboards, поэтому хватает сравнения по identity
+            if shown is not None and shown[0] == text and shown[1] is reply_markup:
+                return message
+            try:
+                result = await message.edit_text(text, reply_markup=reply_markup)
+                self._remember(message, text, reply_markup)
+                return result
+            except TelegramBadRequest as e:
+                if "message is not modified" in e.message:
+                    self._remember(message, text, reply_markup)
+                    return message
+                logger.debug(f"edit_text не удался, отправляю новое сообщение: {e.message}")
+            except Exception as e:
+                logger.debug(f"edit_text не удался, отправляю новое сообщение: {e}")
+
+        sent = await message.answer(text, reply_markup=reply_markup)
+        self._remember(sent, text, reply_markup)
+        return sent
@@ -0,0 +1,56 @@
+from aiogram import BaseMiddleware
+
+from locks import KeyedLock
+
+
+class UserSerializeMiddleware(BaseMiddleware):
+    """Обрабатывает апдейты одного пользователя строго по очереди"""
+
+    def __init__(self, locks: KeyedLock):
+        self.locks = locks
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None:
+            return await handler(event, data)
+        async with self.locks.hold(user.id):
+            return await handler(event, data)
+
+
+class ReachabilityMiddleware(BaseMiddleware):
+    """Снимает отметку «недоступен», как только пользователь снова пишет боту"""
+
+    def __init__(self, reachability):
+        self.reachability = reachability
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            self.reachability.clear(user.id)
+        return await handler(event, data)
+
+
+class UsernameCaptureMiddleware(BaseMiddleware):
+    """Запоминает username отправителя каждого апдейта, чтобы админке не звать get_chat"""
+
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            self.resolver.remember(user.id, user.username)
+        return await handler(event, data)
+
+
+class ActivityMiddleware(BaseMiddleware):
+    """Отмечает пользователя активным в аналитике (раз в час, остальное — проверка множества)"""
+
+    def __init__(self, analytics):
+        self.analytics = analytics
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            self.analytics.active(user.id)
+        return await handler(event, data)
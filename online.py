@@ -0,0 +1,58 @@
+class OnlineCounter:
+    """Онлайн по районам. Меняется только на переходах очередь/чат, без запросов к БД"""
+
+    def __init__(self):
+        self._district_of = {}
+        self._counts = {}
+        self._dirty = True
+
+    def add(self, user_id, district):
+        old = self._district_of.get(user_id)
+        if old == district:
+            return
+        if old is not None:
+            self._dec(old)
+        self._district_of[user_id] = district
+        self._counts[district] = self._counts.get(district, 0) + 1
+        self._dirty = True
+
+    def remove(self, user_id):
+        district = self._district_of.pop(user_id, None)
+        if district is not None:
+            self._dec(district)
+            self._dirty = True
+
+    def move(self, user_id, district):
+        """Смена района у пользователя, который сейчас онлайн"""
+        if user_id in self._district_of:
+            self.add(user_id, district)
+
+    def _dec(self, district):
+        count = self._counts.get(district, 0) - 1
+        if count > 0:
+            self._counts[district] = count
+        else:
+            self._counts.pop(district, None)
+
+    def district_of(self, user_id):
+        return self._district_of.get(user_id)
+
+    def get(self, district):
+        return self._counts.get(district, 0)
+
+    def by_district(self):
+        return dict(self._counts)
+
+    def __contains__(self, user_id):
+        return user_id in self._district_of
+
+    def __len__(self):
+        return len(self._district_of)
+
+    def flush(self, db):
+        """Пишет district_stats.online_now одним запросом, если что-то менялось"""
+        if not self._dirty:
+            return False
+        self._dirty = False
+        db.set_online_counts(self._counts)
+        return True
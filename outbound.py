@@ -0,0 +1,240 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих: пересылка в чате важнее уведомлений, уведомления важнее рассылки
+PRIORITY_CHAT = 0
+PRIORITY_NOTIFY = 1
+PRIORITY_BULK = 2
+
+send_priority = contextvars.ContextVar("send_priority", default=PRIORITY_NOTIFY)
+
+# Методы Bot API, на которые распространяются лимиты Telegram.
+# sendChatAction не сообщение: его частоту ограничивает дебаунс в relay
+LIMITED_PREFIXES = ("send", "copy", "forward", "edit")
+UNLIMITED_METHODS = {"sendChatAction"}
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, now):
+        """Сколько ждать до появления жетона (0 — можно сейчас)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ("call", "future", "priority", "created")
+
+    def __init__(self, call, future, priority):
+        self.call = call
+        self.future = future
+        self.priority = priority
+        self.created = time.monotonic()
+
+
+class OutboundScheduler:
+    """Очередь исходящих запросов: FIFO на получателя, глобальный и личный лимиты, retry_after"""
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._buckets = {}
+        self._pending = {}
+        self._ready = (deque(), deque(), deque())
+        self._delayed = []
+        self._seq = itertools.count()
+        self._scheduled = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        # Запросы «в полете»: stop() отменяет их вместе с очередью
+        self._inflight = set()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.latency_avg = 0.0
+        self.latency_max = 0.0
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает отправку. Запросы в очереди и «в полете» отменяются:
+        обработчики, которые ждут их future, получают CancelledError, а не висят"""
+        if self._task is None:
+            return
+        # Дальше OutboundMiddleware отправляет напрямую
+        task, self._task = self._task, None
+        task.cancel()
+        for inflight in self._inflight:
+            inflight.cancel()
+        await asyncio.gather(task, *self._inflight, return_exceptions=True)
+        for queue in self._pending.values():
+            for job in queue:
+                job.future.cancel()
+        self._pending.clear()
+        self._scheduled.clear()
+        self._delayed.clear()
+        for queue in self._ready:
+            queue.clear()
+
+    def submit(self, chat_id, call, priority=None):
+        """Ставит запрос в очередь получателя, возвращает future с результатом"""
+        future = asyncio.get_running_loop().create_future()
+        job = _Job(call, future, send_priority.get() if priority is None else priority)
+        self._pending.setdefault(chat_id, deque()).append(job)
+        if chat_id not in self._scheduled:
+            self._schedule(chat_id)
+        return future
+
+    def _schedule(self, chat_id, not_before=0.0):
+        now = time.monotonic()
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        when = max(now + bucket.wait_time(now), not_before)
+        self._scheduled.add(chat_id)
+        if when <= now:
+            self._ready[self._pending[chat_id][0].priority].append(chat_id)
+        else:
+            heapq.heappush(self._delayed, (when, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _next_ready(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, chat_id = heapq.heappop(self._delayed)
+            self._ready[self._pending[chat_id][0].priority].append(chat_id)
+        for queue in self._ready:
+            if queue:
+                return queue.popleft()
+        return None
+
+    async def _run(self):
+        while True:
+            chat_id = self._next_ready()
+            if chat_id is None:
+                self._wakeup.clear()
+                timeout = self._delayed[0][0] - time.monotonic() if self._delayed else None
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            wait = self._global.wait_time(time.monotonic())
+            if wait:
+                await asyncio.sleep(wait)
+            now = time.monotonic()
+            self._global.take(now)
+            self._buckets[chat_id].take(now)
+            job = self._pending[chat_id].popleft()
+            task = asyncio.create_task(self._execute(chat_id, job))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _execute(self, chat_id, job):
+        not_before = 0.0
+        try:
+            result = await job.call()
+        except TelegramRetryAfter as e:
+            # Запрос возвращается в голову очереди получателя и ждет retry_after
+            self.retries += 1
+            self._pending[chat_id].appendleft(job)
+            not_before = time.monotonic() + e.retry_after
+            logger.warning(f"Flood control для {chat_id}: повтор через {e.retry_after} с")
+        except asyncio.CancelledError:
+            job.future.cancel()
+            raise
+        except Exception as e:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(e)
+        else:
+            self.sent += 1
+            latency = time.monotonic() - job.created
+            self.latency_avg = latency if self.sent == 1 else self.latency_avg * 0.95 + latency * 0.05
+            self.latency_max = max(self.latency_max, latency)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._scheduled.discard(chat_id)
+            if self._pending[chat_id]:
+                self._schedule(chat_id, not_before)
+            else:
+                del self._pending[chat_id]
+            if self.sent % 1000 == 0 and len(self._buckets) > 10000:
+                self._prune_buckets()
+
+    def _prune_buckets(self):
+        """Забывает получателей без очереди, чей лимит уже полностью восстановился"""
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._buckets.items() if c not in self._pending]:
+            bucket = self._buckets[chat_id]
+            bucket.wait_time(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._buckets[chat_id]
+
+    def queue_depth(self):
+        return sum(len(q) for q in self._pending.values())
+
+    def stats(self):
+        depth = [0, 0, 0]
+        for q in self._pending.values():
+            for job in q:
+                depth[job.priority] += 1
+        return {
+            "queued": sum(depth),
+            "queued_chat": depth[PRIORITY_CHAT],
+            "queued_notify": depth[PRIORITY_NOTIFY],
+            "queued_bulk": depth[PRIORITY_BULK],
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "latency_avg_ms": round(self.latency_avg * 1000, 1),
+            "latency_max_ms": round(self.latency_max * 1000, 1),
+        }
+
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Пропускает отправку сообщений через OutboundScheduler"""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        api_method = getattr(method, "__api_method__", "")
+        if (chat_id is None or not self.scheduler.running
+                or not api_method.startswith(LIMITED_PREFIXES) or api_method in UNLIMITED_METHODS):
+            return await make_request(bot, method)
+        return await self.scheduler.submit(chat_id, lambda: make_request(bot, method))
@@ -0,0 +1,63 @@
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+# Callback data страниц: "pg:<вид>:<аргумент>:<n|p>:<курсор>" (Telegram ограничивает 64 байтами)
+PAGE_PREFIX = "pg:"
+
+
+class Page:
+    __slots__ = ("rows", "has_prev", "has_next", "first", "last")
+
+    def __init__(self, rows, has_prev, has_next, key):
+        self.rows = rows
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.first = key(rows[0]) if rows else None
+        self.last = key(rows[-1]) if rows else None
+
+
+def fetch_page(fetch, cursor, direction, size, key):
+    """Одна страница keyset-запросом.
+    fetch(cursor, forward, limit) возвращает строки за курсором в сторону forward;
+    берем на одну больше, чтобы знать, есть ли продолжение"""
+    forward = direction != "p"
+    rows = fetch(cursor, forward, size + 1)
+    more = len(rows) > size
+    rows = list(rows[:size])
+    if forward:
+        return Page(rows, cursor is not None, more, key)
+    rows.reverse()
+    return Page(rows, more, True, key)
+
+
+def encode_cursor(values):
+    return "|".join("" if v is None else str(v) for v in values)
+
+
+def decode_cursor(text):
+    """Курсор обратно в список; последнее поле всегда id (int)"""
+    if not text:
+        return None
+    values = text.split("|")
+    values[-1] = int(values[-1])
+    return values
+
+
+def parse_page_data(data):
+    """(вид, аргумент, направление, курсор) из callback data"""
+    _, view, arg, direction, cursor = data.split(":", 4)
+    return view, arg, direction, decode_cursor(cursor)
+
+
+def page_keyboard(view, arg, page, back="admin_menu", extra=None):
+    nav = []
+    if page.has_prev:
+        nav.append(InlineKeyboardButton(
+            text="◀️", callback_data=f"{PAGE_PREFIX}{view}:{arg}:p:{encode_cursor(page.first)}"))
+    if page.has_next:
+        nav.append(InlineKeyboardButton(
+            text="▶️", callback_data=f"{PAGE_PREFIX}{view}:{arg}:n:{encode_cursor(page.last)}"))
+    buttons = [nav] if nav else []
+    if extra:
+        buttons.extend(extra)
+    buttons.append([InlineKeyboardButton(text="◀️ Назад", callback_data=back)])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
@@ -0,0 +1,65 @@
+import logging
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+
+logger = logging.getLogger(__name__)
+
+
+class Reachability:
+    """Пользователи, до которых Telegram не доставляет сообщения (бот заблокирован,
+    аккаунт удален). Держится в памяти, изменения сразу пишутся в таблицу unreachable"""
+
+    def __init__(self, db):
+        self.db = db
+        self._unreachable = set()
+
+    def load(self):
+        self._unreachable = self.db.get_unreachable_ids()
+        return len(self._unreachable)
+
+    def mark(self, user_id, reason):
+        if user_id in self._unreachable:
+            return
+        self._unreachable.add(user_id)
+        self.db.mark_unreachable(user_id, reason)
+        logger.info(f"Пользователь {user_id} недоступен: {reason}")
+
+    def clear(self, user_id):
+        """Пользователь снова написал боту — значит, доставка опять работает"""
+        if user_id not in self._unreachable:
+            return
+        self._unreachable.discard(user_id)
+        self.db.clear_unreachable(user_id)
+
+    def __contains__(self, user_id):
+        return user_id in self._unreachable
+
+    def __len__(self):
+        return len(self._unreachable)
+
+
+def unreachable_reason(error):
+    """Причина недоступности по ошибке Bot API или None, если ошибка не про получателя"""
+    if isinstance(error, TelegramForbiddenError):
+        return error.message
+    if isinstance(error, TelegramBadRequest) and "chat not found" in error.message.lower():
+        return error.message
+    return None
+
+
+class ReachabilityRequestMiddleware(BaseRequestMiddleware):
+    """Отмечает получателя недоступным по ошибке любого запроса с chat_id"""
+
+    def __init__(self, reachability):
+        self.reachability = reachability
+
+    async def __call__(self, make_request, bot, method):
+        try:
+            return await make_request(bot, method)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            chat_id = getattr(method, "chat_id", None)
+            reason = unreachable_reason(e)
+            if reason and isinstance(chat_id, int) and chat_id > 0:
+                self.reachability.mark(chat_id, reason)
+            raise
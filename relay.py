@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+
+from aiogram.types import InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
+
+logger = logging.getLogger(__name__)
+
+# Тип -> подпись по умолчанию (None — тип без подписи, пересылается как есть)
+MEDIA_CAPTIONS = {
+    "photo": "📸 Фото",
+    "video": "🎥 Видео",
+    "animation": "🎬 GIF",
+    "audio": "🎵 Аудио",
+    "document": "📎 Документ",
+    "sticker": None,
+    "voice": None,
+    "video_note": None,
+}
+
+# Что показать собеседнику, пока вложение еще в пути
+MEDIA_ACTIONS = {
+    "photo": "upload_photo",
+    "video": "upload_video",
+    "document": "upload_document",
+    "audio": "upload_document",
+}
+
+ALBUM_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+
+def media_of(message):
+    """Возвращает (тип, file_id) вложения или (None, None)"""
+    for kind in MEDIA_CAPTIONS:
+        media = getattr(message, kind)
+        if media:
+            return kind, (media[-1] if kind == "photo" else media).file_id
+    return None, None
+
+
+class _Album:
+    __slots__ = ("session", "user_id", "sender", "items")
+
+    def __init__(self, session, user_id, sender):
+        self.session = session
+        self.user_id = user_id
+        self.sender = sender
+        self.items = []
+
+
+class Relay:
+    """Пересылка собеседнику: текст с подписью, вложения через copy_message, альбомы одним send_media_group"""
+
+    def __init__(self, bot, db, sessions, album_window=1.0, action_interval=4.0):
+        self.bot = bot
+        self.db = db
+        self.sessions = sessions
+        self.album_window = album_window
+        self.action_interval = action_interval
+        self._albums = {}
+        # Фоновые задачи (отправка альбома, chat action): ссылка держит их до конца
+        self._tasks = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Ошибка фоновой пересылки", exc_info=task.exception())
+
+    def signal(self, session, partner_id, action):
+        """Показывает собеседнику chat action, не чаще раза в action_interval на сессию.
+        Только upload_* для копящегося альбома: «печатает» бот честно показать не может —
+        он узнает о сообщении, когда оно уже написано"""
+        now = time.time()
+        if now - (session.action_at or 0.0) < self.action_interval:
+            return
+        session.action_at = now
+        self._spawn(self._send_action(partner_id, action))
+
+    async def _send_action(self, partner_id, action):
+        try:
+            await self.bot.send_chat_action(partner_id, action)
+        except Exception as e:
+            logger.debug(f"Chat action not sent: {e}")
+
+    async def relay(self, message, session, user_id, sender):
+        partner_id = session.partner_of(user_id)
+        partner_nick = session.nick_of(partner_id)
+
+        if message.text:
+            await self.bot.send_message(partner_id, f"<b>{sender}:</b> {message.text}")
+            self.db.save_message(session.chat_id, user_id, partner_id, sender, partner_nick, message.text, "text")
+            return
+
+        kind, file_id = media_of(message)
+        if kind is None:
+            return
+
+        if message.media_group_id and kind in ALBUM_MEDIA:
+            self._buffer(message, session, user_id, sender, kind, file_id)
+            return
+
+        default = MEDIA_CAPTIONS[kind]
+        caption = f"<b>{sender}:</b> {message.caption or default}" if default else None
+        await self.bot.copy_message(partner_id, message.chat.id, message.message_id, caption=caption)
+        self.db.save_message(
+            session.chat_id, user_id, partner_id, sender, partner_nick,
+            message.caption if default else None, kind, file_id
+        )
+
+    def _buffer(self, message, session, user_id, sender, kind, file_id):
+        """Копит части альбома album_window секунд, потом отправляет одним запросом"""
+        key = (user_id, message.media_group_id)
+        album = self._albums.get(key)
+        if album is None:
+            album = self._albums[key] = _Album(session, user_id, sender)
+            self._spawn(self._flush_album(key))
+            self.signal(session, session.partner_of(user_id), MEDIA_ACTIONS[kind])
+        album.items.append((kind, file_id, message.caption))
+
+    async def _flush_album(self, key):
+        await asyncio.sleep(self.album_window)
+        album = self._albums.pop(key)
+        session, user_id = album.session, album.user_id
+        # За время ожидания чат мог закончиться
+        if self.sessions.get(user_id) is not session:
+            return
+        partner_id = session.partner_of(user_id)
+        partner_nick = session.nick_of(partner_id)
+
+        media = []
+        for i, (kind, file_id, caption) in enumerate(album.items):
+            if i == 0:
+                caption = f"<b>{album.sender}:</b> {caption or MEDIA_CAPTIONS[kind]}"
+            media.append(ALBUM_MEDIA[kind](media=file_id, caption=caption))
+        try:
+            await self.bot.send_media_group(partner_id, media)
+        except Exception as e:
+            logger.error(f"Error sending album: {e}")
+            return
+        self.db.save_messages([
+            (session.chat_id, user_id, partner_id, album.sender, partner_nick, caption, kind, file_id)
+            for kind, file_id, caption in album.items
+        ])
@@ -0,0 +1,72 @@
+SEGMENT_HELP = (
+    "🎯 <b>Кому отправить?</b>\n\n"
+    "Напиши <code>все</code> или условия, каждое с новой строки:\n"
+    "• <code>районы: Центральный, Мыс</code>\n"
+    "• <code>активны: 7</code> — заходили за последние N дней\n"
+    "• <code>рейтинг: 60</code> — рейтинг не ниже\n"
+    "• <code>чатов: 5</code> — не меньше N чатов\n"
+    "• <code>рефералы</code> — пригласили хотя бы одного друга"
+)
+
+_NUMBER_KEYS = {
+    "активны": "active_days",
+    "рейтинг": "min_rating",
+    "чатов": "min_chats",
+}
+
+
+def parse_segment(text, districts):
+    """Разбирает описание аудитории в dict; пустой dict — все пользователи.
+    При ошибке бросает ValueError с текстом для админа"""
+    segment = {}
+    text = text.strip().lower()
+    if text in ("все", "всем", "all"):
+        return segment
+
+    for line in text.splitlines():
+        line = line.strip(" •-")
+        if not line:
+            continue
+        key, _, value = line.partition(":")
+        key, value = key.strip(), value.strip()
+
+        if key == "рефералы":
+            segment["has_referrals"] = True
+        elif key == "районы":
+            chosen = []
+            for part in filter(None, (p.strip() for p in value.split(","))):
+                matches = [d for d in districts if part in d.lower()]
+                if not matches:
+                    raise ValueError(f"Нет района «{part}»")
+                chosen.extend(m for m in matches if m not in chosen)
+            if not chosen:
+                raise ValueError("Не указаны районы")
+            segment["districts"] = chosen
+        elif key in _NUMBER_KEYS:
+            try:
+                number = float(value) if key == "рейтинг" else int(value)
+            except ValueError:
+                raise ValueError(f"«{key}»: нужно число, а не «{value}»")
+            if number < 0:
+                raise ValueError(f"«{key}»: число не может быть отрицательным")
+            segment[_NUMBER_KEYS[key]] = number
+        else:
+            raise ValueError(f"Непонятное условие «{line}»")
+    return segment
+
+
+def describe_segment(segment):
+    if not segment:
+        return "все пользователи"
+    parts = []
+    if "districts" in segment:
+        parts.append("районы: " + ", ".join(segment["districts"]))
+    if "active_days" in segment:
+        parts.append(f"активны за {segment['active_days']} дн.")
+    if "min_rating" in segment:
+        parts.append(f"рейтинг от {segment['min_rating']:g}")
+    if "min_chats" in segment:
+        parts.append(f"чатов от {segment['min_chats']}")
+    if segment.get("has_referrals"):
+        parts.append("есть рефералы")
+    return "; ".join(parts)
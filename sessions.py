@@ -0,0 +1,165 @@
+import sys
+import time
+
+
+class ChatSession:
+    """Одна пара собеседников. Оба user_id указывают на один и тот же объект.
+
+    Для пересылки без запросов к БД здесь же лежат ники, режим анонимности,
+    подпись отправителя и бан каждой стороны. Подпись сбрасывается (label = None)
+    при смене ника, анонимности или премиум статуса.
+    """
+
+    __slots__ = (
+        "user1_id", "user2_id", "chat_id", "name1", "name2",
+        "district", "started_at", "last_activity", "message_count",
+        "nick1", "nick2", "anon1", "anon2", "label1", "label2", "banned1", "banned2",
+        "action_at", "touched_at",
+    )
+
+    def __init__(self, user1_id, user2_id, chat_id, name1, name2, district,
+                 nick1=None, nick2=None, anon1=True, anon2=True):
+        self.user1_id = user1_id
+        self.user2_id = user2_id
+        self.chat_id = chat_id
+        self.name1 = name1
+        self.name2 = name2
+        self.district = district
+        self.started_at = time.time()
+        self.last_activity = self.started_at
+        self.message_count = 0
+        self.nick1 = nick1
+        self.nick2 = nick2
+        self.anon1 = anon1
+        self.anon2 = anon2
+        self.label1 = None
+        self.label2 = None
+        self.banned1 = False
+        self.banned2 = False
+        # Когда собеседнику последний раз отправлялся chat action (для дебаунса)
+        self.action_at = 0.0
+        # Когда шарду собеседника последний раз сообщали об активности (кластер)
+        self.touched_at = 0.0
+
+    def partner_of(self, user_id):
+        return self.user2_id if user_id == self.user1_id else self.user1_id
+
+    def name_of(self, user_id):
+        return self.name1 if user_id == self.user1_id else self.name2
+
+    def nick_of(self, user_id):
+        nick = self.nick1 if user_id == self.user1_id else self.nick2
+        return nick if nick is not None else self.name_of(user_id)
+
+    def is_anon(self, user_id):
+        return (self.anon1 if user_id == self.user1_id else self.anon2) is not False
+
+    def is_banned(self, user_id):
+        return bool(self.banned1 if user_id == self.user1_id else self.banned2)
+
+    def label_of(self, user_id):
+        return self.label1 if user_id == self.user1_id else self.label2
+
+    def set_label(self, user_id, label):
+        if user_id == self.user1_id:
+            self.label1 = label
+        else:
+            self.label2 = label
+
+    def update(self, user_id, **fields):
+        """Меняет поля стороны user_id (nick, name, anon, banned) и сбрасывает подпись"""
+        side = "1" if user_id == self.user1_id else "2"
+        for field, value in fields.items():
+            setattr(self, field + side, value)
+        setattr(self, "label" + side, None)
+
+    def to_row(self):
+        return [getattr(self, f) for f in self.__slots__]
+
+    @classmethod
+    def from_row(cls, row):
+        session = cls.__new__(cls)
+        # Недостающие в старом снимке поля заполняются None
+        row = list(row) + [None] * (len(cls.__slots__) - len(row))
+        for f, v in zip(cls.__slots__, row):
+            setattr(session, f, v)
+        return session
+
+
+class SessionStore:
+    """Активные чаты: user_id -> ChatSession, O(1) поиск собеседника"""
+
+    def __init__(self):
+        self._by_user = {}
+        self.total_opened = 0
+        self.total_messages = 0
+
+    def open(self, user1_id, user2_id, chat_id, name1, name2, district, **profile):
+        if user1_id in self._by_user or user2_id in self._by_user:
+            return None
+        session = ChatSession(user1_id, user2_id, chat_id, name1, name2, district, **profile)
+        self._by_user[user1_id] = session
+        self._by_user[user2_id] = session
+        self.total_opened += 1
+        return session
+
+    def add(self, session):
+        """Добавляет готовую сессию (восстановление из снимка)"""
+        if session.user1_id in self._by_user or session.user2_id in self._by_user:
+            return False
+        self._by_user[session.user1_id] = session
+        self._by_user[session.user2_id] = session
+        return True
+
+    def get(self, user_id):
+        return self._by_user.get(user_id)
+
+    def partner_of(self, user_id):
+        session = self._by_user.get(user_id)
+        return session.partner_of(user_id) if session else None
+
+    def close(self, user_id):
+        """Удаляет сессию сразу для обоих собеседников"""
+        session = self._by_user.pop(user_id, None)
+        if session is not None:
+            self._by_user.pop(session.partner_of(user_id), None)
+        return session
+
+    def update_user(self, user_id, **fields):
+        """Обновляет данные пользователя в его активной сессии, если она есть"""
+        session = self._by_user.get(user_id)
+        if session is not None:
+            session.update(user_id, **fields)
+
+    def touch(self, session):
+        session.last_activity = time.time()
+        session.message_count += 1
+        self.total_messages += 1
+
+    def users(self):
+        return self._by_user.keys()
+
+    def sessions(self):
+        seen = set()
+        for session in self._by_user.values():
+            if id(session) not in seen:
+                seen.add(id(session))
+                yield session
+
+    def __contains__(self, user_id):
+        return user_id in self._by_user
+
+    def __len__(self):
+        return len(self._by_user) // 2
+
+    def memory_per_session(self):
+        """Оценка памяти на одну сессию в байтах (объект, строки, две записи в индексе)"""
+        count = len(self)
+        if not count:
+            return 0
+        total = sys.getsizeof(self._by_user)
+        for s in self.sessions():
+            total += sys.getsizeof(s)
+            total += sys.getsizeof(s.chat_id) + sys.getsizeof(s.name1) + sys.getsizeof(s.name2)
+            total += sys.getsizeof(s.district) if s.district else 0
+        return total // count
@@ -0,0 +1,41 @@
+import json
+import logging
+import os
+import time
+
+from sessions import ChatSession
+
+logger = logging.getLogger(__name__)
+
+
+def save_snapshot(path, sessions, waiting_users):
+    """Пишет снимок во временный файл и атомарно подменяет им старый"""
+    now = time.monotonic()
+    data = {
+        "saved_at": time.time(),
+        "sessions": [s.to_row() for s in sessions.sessions()],
+        # В очереди хранится время ожидания: monotonic() не переживает перезапуск
+        "queue": [[uid, now - since] for uid, since in waiting_users.items()],
+        "total_opened": sessions.total_opened,
+        "total_messages": sessions.total_messages,
+    }
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_snapshot(path):
+    """Читает снимок; возвращает None, если его нет или он поврежден"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        data["sessions"] = [ChatSession.from_row(row) for row in data.get("sessions", [])]
+        return data
+    except Exception as e:
+        logger.error(f"Не удалось прочитать снимок {path}: {e}")
+        return None
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class SentMessages(list):
+    """Вместо bot.send_message: запоминает (chat_id, text), в Telegram не ходит"""
+
+    async def __call__(self, chat_id, text, **kwargs):
+        self.append((chat_id, text))
+
+
+class FakeMessage:
+    """Сообщение бота или пользователя: edit_text и answer только запоминают текст"""
+
+    _ids = iter(range(1, 10 ** 9))
+
+    def __init__(self, user_id, text=""):
+        self.chat = SimpleNamespace(id=user_id)
+        self.from_user = SimpleNamespace(id=user_id)
+        self.message_id = next(self._ids)
+        self.text = text
+        self.shown = []
+
+    async def edit_text(self, text, **kwargs):
+        self.shown.append(text)
+        return self
+
+    async def answer(self, text, **kwargs):
+        self.shown.append(text)
+        return FakeMessage(self.chat.id, text)
+
+
+class FakeCallback:
+    """Нажатие кнопки: callback.answer() запоминает, сколько раз на него ответили"""
+
+    def __init__(self, user_id, data):
+        self.from_user = SimpleNamespace(id=user_id)
+        self.data = data
+        self.message = FakeMessage(user_id)
+        self.answers = []
+
+    async def answer(self, text=None, **kwargs):
+        self.answers.append(text)
+
+
+class FakeState:
+    async def get_state(self):
+        return None
+
+    async def clear(self):
+        pass
+
+    async def set_state(self, state=None):
+        pass
+
+    async def update_data(self, **kwargs):
+        pass
+
+
+@pytest.fixture(scope="session")
+def botmod(tmp_path_factory):
+    """bot.py с базой во временном каталоге (пути в config относительные) и без Telegram"""
+    workdir = tmp_path_factory.mktemp("bot")
+    (workdir / "data").mkdir()
+    cwd = os.getcwd()
+    argv = sys.argv
+    os.chdir(workdir)
+    # Ключи pytest не должны попасть в --role/--shard
+    sys.argv = [argv[0]]
+    try:
+        import bot
+    finally:
+        sys.argv = argv
+    bot.bot.send_message = SentMessages()
+    yield bot
+    os.chdir(cwd)
+
+
+@pytest.fixture
+def botstate(botmod):
+    """Пустые очередь, чаты и онлайн; свежие замки (asyncio.Lock привязывается к циклу событий)"""
+    from locks import KeyedLock, ShardedLock
+    from online import OnlineCounter
+
+    botmod.waiting_users.clear()
+    for user_id in list(botmod.sessions.users()):
+        botmod.sessions.close(user_id)
+    botmod.online = OnlineCounter()
+    botmod.user_locks = KeyedLock()
+    botmod.match_locks = ShardedLock()
+    botmod.db.end_chats(list(botmod.db.get_open_chats()))
+    botmod.bot.send_message.clear()
+    return botmod
+
+
+def run(coro):
+    return asyncio.run(coro)
@@ -0,0 +1,39 @@
+"""Свертка аналитики: дни, пропущенные простоем, и активные без двойного счета"""
+import datetime
+
+from database import Database
+
+
+def utc_day(offset):
+    today = datetime.datetime.now(datetime.timezone.utc).date()
+    return (today - datetime.timedelta(days=offset)).isoformat()
+
+
+def test_rollup_catches_up_after_downtime(tmp_path):
+    db = Database(str(tmp_path / "analytics.db"))
+    db.add_hourly_counters([(f"{utc_day(5)} 12", "Центральный", 1, 0, 0, 0, 0, 0)])
+    db.rollup_analytics()
+
+    # Бот лежал четыре дня: часы копились, свертки не было
+    db.add_hourly_counters([(f"{utc_day(offset)} 12", "Центральный", 1, 0, 0, 0, 0, 0)
+                            for offset in (5, 4, 3, 2, 1, 0)])
+    db.rollup_analytics()
+
+    days = {row["day"]: row["messages"] for row in db.get_analytics_daily(7)}
+    assert days == {utc_day(offset): 1 for offset in (4, 3, 2, 1, 0)} | {utc_day(5): 2}
+
+
+def test_daily_active_counts_district_switch_once(tmp_path):
+    db = Database(str(tmp_path / "analytics.db"))
+    today = utc_day(0)
+    db.add_user(1, "user1", "Центральный")
+    db.add_user(2, "user2", "Калининский")
+    # Первый сменил район посреди дня: его часы есть в обоих районах
+    db.add_hourly_active(f"{today} 09", {"Центральный": 1, "Калининский": 1})
+    db.add_hourly_active(f"{today} 18", {"Калининский": 1})
+    db.save_activity_days([(1, today, "Центральный"), (2, today, "Калининский")])
+    db.save_activity_days([(1, today, "Калининский")])
+    db.rollup_analytics()
+
+    day, = db.get_analytics_daily(1)
+    assert day["active_users"] == 2
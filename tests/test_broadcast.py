@@ -0,0 +1,143 @@
+"""Рассылку прерывают посреди порции: после продолжения каждый получает сообщение,
+а повторов не больше, чем получателей между сохранениями курсора плюс отправки «в полете»"""
+import asyncio
+import random
+from collections import Counter
+
+from conftest import run
+from broadcast import Broadcaster
+from database import Database
+
+USERS = 300
+BATCH = 100
+WORKERS = 8
+CHECKPOINT_EVERY = 10
+FIRST_ID = 200000
+
+
+class FakeBot:
+    def __init__(self, stop_after=None):
+        self.received = Counter()
+        self.stop_after = stop_after
+        self.stopped = asyncio.Event()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        # Ответы Telegram приходят не по порядку
+        await asyncio.sleep(random.random() / 1000)
+        self.received[chat_id] += 1
+        if self.stop_after is not None and sum(self.received.values()) >= self.stop_after:
+            self.stopped.set()
+
+    async def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+class FakeOutbound:
+    retries = 0
+
+
+def test_resume_after_cancel_mid_batch(tmp_path):
+    random.seed(38)
+    db = Database(str(tmp_path / "broadcast.db"))
+    users = list(range(FIRST_ID, FIRST_ID + USERS))
+    for user_id in users:
+        db.add_user(user_id, f"user{user_id}", "Центральный")
+    admin_id = users[0]
+    job_id = db.create_broadcast(admin_id, "тест", USERS)
+
+    # Останавливаем посреди второй порции — до ее конца курсор раньше не сохранялся
+    first = FakeBot(stop_after=BATCH + BATCH // 2)
+
+    async def interrupted():
+        broadcaster = Broadcaster(first, db, FakeOutbound(), BATCH, WORKERS, 0, CHECKPOINT_EVERY)
+        broadcaster.start(job_id)
+        await first.stopped.wait()
+        await broadcaster.stop()
+
+    run(interrupted())
+    job = db.get_broadcast(job_id)
+    assert job["status"] == "running"
+    assert job["cursor"] > users[BATCH - 1], "курсор не сдвинулся внутри порции"
+
+    second = FakeBot()
+
+    async def resumed():
+        broadcaster = Broadcaster(second, db, FakeOutbound(), BATCH, WORKERS, 0, CHECKPOINT_EVERY)
+        assert broadcaster.resume() == 1
+        while broadcaster.active:
+            await asyncio.sleep(0.01)
+
+    run(resumed())
+    assert db.get_broadcast(job_id)["status"] == "done"
+
+    total = first.received + second.received
+    # Администратор еще получает отчет об окончании
+    total[admin_id] -= 1
+    assert all(total[user_id] >= 1 for user_id in users), "кто-то остался без рассылки"
+    repeated = sum(count - 1 for count in total.values())
+    assert repeated <= CHECKPOINT_EVERY + WORKERS
+
+
+class SlowFirstBot(FakeBot):
+    """Первый получатель отвечает, только когда его отпустят"""
+
+    def __init__(self, slow_id):
+        super().__init__()
+        self.slow_id = slow_id
+        self.release = asyncio.Event()
+        self.before_release = set()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if chat_id == self.slow_id:
+            await self.release.wait()
+        elif not self.release.is_set():
+            self.before_release.add(chat_id)
+        await super().send_message(chat_id, text, **kwargs)
+
+
+def test_slow_send_does_not_hold_next_batch(tmp_path):
+    db = Database(str(tmp_path / "broadcast.db"))
+    users = list(range(FIRST_ID, FIRST_ID + 30))
+    for user_id in users:
+        db.add_user(user_id, f"user{user_id}", "Центральный")
+    job_id = db.create_broadcast(users[-1], "тест", len(users))
+    bot = SlowFirstBot(users[0])
+
+    async def main():
+        broadcaster = Broadcaster(bot, db, FakeOutbound(), 10, 4, 0, 5)
+        broadcaster.start(job_id)
+        await asyncio.sleep(0.1)
+        # Вторая порция пошла, хотя первая еще не закончилась
+        assert bot.before_release & set(users[10:20])
+        assert db.get_broadcast(job_id)["cursor"] == 0, "курсор не может уйти дальше зависшего"
+        bot.release.set()
+        while broadcaster.active:
+            await asyncio.sleep(0.01)
+
+    run(main())
+    job = db.get_broadcast(job_id)
+    assert job["status"] == "done" and job["sent"] == len(users)
+
+
+class BrokenDb(Database):
+    def get_broadcast_recipients(self, *args, **kwargs):
+        raise RuntimeError("диск отвалился")
+
+
+def test_error_marks_job_failed_and_tells_admin(tmp_path):
+    db = BrokenDb(str(tmp_path / "broadcast.db"))
+    admin_id = FIRST_ID
+    db.add_user(admin_id, "admin", "Центральный")
+    job_id = db.create_broadcast(admin_id, "тест", 1)
+    bot = FakeBot()
+
+    async def main():
+        broadcaster = Broadcaster(bot, db, FakeOutbound(), BATCH, WORKERS, 0, CHECKPOINT_EVERY)
+        broadcaster.start(job_id)
+        while broadcaster.active:
+            await asyncio.sleep(0.01)
+
+    run(main())
+    assert db.get_broadcast(job_id)["status"] == "failed"
+    assert db.get_running_broadcasts() == []
+    assert bot.received[admin_id] == 1
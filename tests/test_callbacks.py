@@ -0,0 +1,26 @@
+"""Telegram принимает один ответ на нажатие: общий callback.answer() не дублирует ответ обработчика"""
+import pytest
+
+from conftest import run, FakeCallback, FakeState
+from callbacks import BlacklistAddCallback, BlacklistRemoveCallback, RateCallback
+
+USER = 500001
+
+
+@pytest.mark.parametrize("data, text", [
+    ("admin_stats", "❌ Нет доступа"),
+    ("stop", "❌ Ты не в чате"),
+    (BlacklistAddCallback(user_id=USER).pack(), "❌ Нельзя добавить себя в ЧС"),
+    (BlacklistRemoveCallback(user_id=USER + 1).pack(), "✅ Пользователь удален из ЧС"),
+    (RateCallback(action="like", partner_id=USER + 1).pack(), "❌ Собеседник не найден"),
+    ("menu", None),
+])
+def test_callback_answered_once(botstate, data, text):
+    bot = botstate
+    if bot.db.get_user(USER) is None:
+        bot.db.add_user(USER, "user", bot.TYUMEN_DISTRICTS[0])
+    assert USER not in bot.ADMIN_IDS
+    callback = FakeCallback(USER, data)
+
+    run(bot.handle_all_callbacks(callback, FakeState()))
+    assert callback.answers == [text]
@@ -0,0 +1,282 @@
+"""Координатор и два шарда на LocalBus: bot.py работает шардом 0, шард 1 изображает тест.
+Пара через шарды, отмена поиска до прихода matched, перезапуск координатора"""
+import asyncio
+import logging
+import random
+from collections import Counter
+from itertools import count
+
+import pytest
+
+from conftest import run
+from analytics import Analytics
+from cluster import Cluster, LocalBus, MatchCoordinator, COORDINATOR, shard_channel, shard_of
+from database import Database
+
+SHARDS = 2
+FIRST_ID = 300000
+
+
+class RemoteShard:
+    """Шард 1: запоминает, что ему прислали"""
+
+    def __init__(self, bus):
+        self.cluster = Cluster(bus, SHARDS, 1)
+        self.received = []
+        bus.subscribe(shard_channel(1), self.handle)
+
+    async def handle(self, message):
+        self.received.append(message)
+
+    def ops(self, op):
+        return [m for m in self.received if m["op"] == op]
+
+
+class LocalShard:
+    """Вход шарда 0: сообщения можно придержать, чтобы проверить гонки с отменой"""
+
+    def __init__(self, bus, bot):
+        self.bot = bot
+        self.held = False
+        self.pending = []
+        bus.subscribe(shard_channel(0), self.handle)
+
+    async def handle(self, message):
+        if self.held:
+            self.pending.append(message)
+        else:
+            await self.bot.on_shard_message(message)
+
+    async def release(self):
+        self.held = False
+        while self.pending:
+            await self.bot.on_shard_message(self.pending.pop(0))
+
+
+async def settle():
+    # LocalBus и отправка Cluster — задачи в этом же цикле: даем им пройти
+    for _ in range(100):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def cluster(botstate, monkeypatch):
+    """Шина, кластер бота (шард 0), шард 1 и координатор; задачи запускает scenario"""
+    bot = botstate
+    ids = (uid for uid in count(FIRST_ID))
+
+    def user_on(shard):
+        user_id = next(uid for uid in ids if shard_of(uid, SHARDS) == shard)
+        bot.db.add_user(user_id, f"user{user_id}", bot.TYUMEN_DISTRICTS[0])
+        return user_id
+
+    def scenario(body):
+        async def main():
+            bus = LocalBus()
+            monkeypatch.setattr(bot, "cluster", Cluster(bus, SHARDS, 0))
+            router = Cluster(bus, SHARDS)
+            coordinator = MatchCoordinator(router, bot.db, bot.analytics)
+            bus.subscribe(COORDINATOR, coordinator.handle)
+            local, remote = LocalShard(bus, bot), RemoteShard(bus)
+            clusters = (bot.cluster, router, remote.cluster)
+            for c in clusters:
+                await c.start()
+            try:
+                await body(bot, coordinator, local, remote)
+            finally:
+                for c in clusters:
+                    await c.stop()
+
+        run(main())
+
+    scenario.user_on = user_on
+    return scenario
+
+
+def test_cross_shard_match_and_close(cluster):
+    local_id, remote_id = cluster.user_on(0), cluster.user_on(1)
+
+    async def body(bot, coordinator, local, remote):
+        remote.cluster.enqueue(bot.db.get_user(remote_id), False)
+        await settle()
+        assert remote_id in coordinator.queue
+
+        assert await bot.match_user(local_id, bot.db.get_user(local_id)) is None
+        await settle()
+
+        session = bot.sessions.get(local_id)
+        assert session is not None and session.partner_of(local_id) == remote_id
+        assert local_id not in bot.waiting_users and not coordinator.queue
+        assert set(bot.db.get_open_chats()) == {session.chat_id}
+        assert [m["chat_id"] for m in remote.ops("matched")] == [session.chat_id]
+
+        await bot.stop_chat(local_id, bot.db, bot.bot)
+        await settle()
+        assert remote.ops("closed") == [{"op": "closed", "chat_id": session.chat_id, "user_id": local_id}]
+        assert not bot.db.get_open_chats() and not len(bot.sessions)
+
+    cluster(body)
+
+
+def test_cancel_before_matched_closes_remote_copy(cluster):
+    local_id, remote_id = cluster.user_on(0), cluster.user_on(1)
+
+    async def body(bot, coordinator, local, remote):
+        remote.cluster.enqueue(bot.db.get_user(remote_id), False)
+        await settle()
+        local.held = True
+        await bot.match_user(local_id, bot.db.get_user(local_id))
+        await settle()
+        (matched,) = local.pending
+        assert matched["op"] == "matched"
+
+        # Пользователь отменил поиск, а matched еще в пути
+        async with bot.match_locks.hold(local_id):
+            assert bot.leave_queue(local_id)
+        await local.release()
+        await settle()
+
+        assert local_id not in bot.sessions and local_id not in bot.waiting_users
+        assert local_id not in bot.cluster.queued
+        assert remote.ops("closed") == [{"op": "closed", "chat_id": matched["chat_id"], "user_id": local_id}]
+        assert not bot.db.get_open_chats()
+        assert not coordinator.queue
+
+    cluster(body)
+
+
+def test_closed_before_matched_requeues_local_user(cluster):
+    local_id, remote_id = cluster.user_on(0), cluster.user_on(1)
+
+    async def body(bot, coordinator, local, remote):
+        remote.cluster.enqueue(bot.db.get_user(remote_id), False)
+        await settle()
+        local.held = True
+        await bot.match_user(local_id, bot.db.get_user(local_id))
+        await settle()
+        (matched,) = local.pending
+
+        # Шард 1 успел открыть и закрыть свою копию раньше, чем matched дошел сюда
+        await bot.on_shard_message({"op": "closed", "chat_id": matched["chat_id"], "user_id": remote_id})
+        await local.release()
+        await settle()
+
+        assert local_id not in bot.sessions
+        assert local_id in bot.waiting_users and local_id in bot.cluster.queued
+        assert local_id in coordinator.queue
+        assert not remote.ops("closed")
+        assert not bot.db.get_open_chats()
+
+    cluster(body)
+
+
+def test_resync_after_coordinator_restart(cluster):
+    local_id = cluster.user_on(0)
+
+    async def body(bot, coordinator, local, remote):
+        await bot.match_user(local_id, bot.db.get_user(local_id))
+        await settle()
+        assert local_id in coordinator.queue
+
+        # Координатор перезапустился с пустой очередью
+        coordinator.queue.clear()
+        coordinator.resync()
+        await settle()
+
+        assert local_id in coordinator.queue
+        assert remote.ops("resync")
+
+    cluster(body)
+
+
+def test_failed_update_task_is_logged(botstate, caplog):
+    bot = botstate
+
+    async def main():
+        await bot.on_shard_message({"op": "update", "update": {"update_id": 1, "message": "не апдейт"}})
+        assert bot.shard_tasks
+        while bot.shard_tasks:
+            await asyncio.sleep(0)
+
+    with caplog.at_level(logging.ERROR, logger="bot"):
+        run(main())
+    assert any(r.exc_info for r in caplog.records if r.name == "bot")
+
+
+class CountingDb(Database):
+    def __init__(self, path):
+        super().__init__(path)
+        self.calls = Counter()
+
+    def get_match_exclusions(self, user_id, candidate_ids):
+        self.calls["exclusions"] += 1
+        return super().get_match_exclusions(user_id, candidate_ids)
+
+    def create_chats(self, rows):
+        self.calls["create_chats"] += 1
+        return super().create_chats(rows)
+
+
+def test_coordinator_pairs_respect_districts_bans_and_blocks(tmp_path):
+    """Очередь по районам дает те же правила, что полный перебор: пары допустимы,
+    а из оставшихся в очереди никого нельзя свести друг с другом"""
+    random.seed(50)
+    db = CountingDb(str(tmp_path / "coordinator.db"))
+    districts = ["Центральный", "Калининский", "Ленинский", "Восточный"]
+    users = [dict(user_id=uid, nickname=f"user{uid}", district=random.choice(districts), anon_mode=0, referrals=0)
+             for uid in range(FIRST_ID, FIRST_ID + 120)]
+    same = {u["user_id"]: random.random() < 0.5 for u in users}
+    for user in users:
+        db.add_user(user["user_id"], user["nickname"], user["district"])
+    banned = {u["user_id"] for u in random.sample(users, 10)}
+    for uid in banned:
+        db.ban_user(uid, "тест")
+    blocked = set()
+    for a, b in (random.sample(users, 2) for _ in range(200)):
+        db.add_to_blacklist(a["user_id"], b["user_id"])
+        blocked |= {(a["user_id"], b["user_id"]), (b["user_id"], a["user_id"])}
+    by_id = {u["user_id"]: u for u in users}
+
+    def compatible(a, b):
+        if a == b or b in banned or a in banned or (a, b) in blocked:
+            return False
+        return not ((same[a] or same[b]) and by_id[a]["district"] != by_id[b]["district"])
+
+    pairs = []
+
+    async def main():
+        bus = LocalBus()
+        router = Cluster(bus, SHARDS)
+        coordinator = MatchCoordinator(router, db, Analytics(db))
+        bus.subscribe(COORDINATOR, coordinator.handle)
+        workers = [Cluster(bus, SHARDS, shard) for shard in range(SHARDS)]
+
+        async def on_shard(message):
+            if message["op"] == "matched":
+                pairs.append((message["user1"]["user_id"], message["user2"]["user_id"]))
+
+        for shard in range(SHARDS):
+            bus.subscribe(shard_channel(shard), on_shard)
+        for c in [router] + workers:
+            await c.start()
+        # Забаненные встали в очередь раньше бана: ждут, но в пару не годятся
+        for phase in (banned, set(by_id) - banned):
+            for uid in phase:
+                workers[shard_of(uid, SHARDS)].enqueue(by_id[uid], same[uid])
+            await settle()
+        for c in [router] + workers:
+            await c.stop()
+        return coordinator
+
+    coordinator = run(main())
+    pairs = set(pairs)
+    assert pairs and all(compatible(a, b) for a, b in pairs)
+    matched = [uid for pair in pairs for uid in pair]
+    assert len(matched) == len(set(matched))
+    assert set(db.get_open_chats().values()) == pairs
+    left = list(coordinator.queue)
+    assert not set(left) & set(matched)
+    assert not any(compatible(a, b) for a in left for b in left)
+    # Все пары накопились за одну пачку сообщений шины — один коммит
+    assert db.calls["create_chats"] == 1
+    assert db.calls["exclusions"] <= len(users)
@@ -0,0 +1,32 @@
+"""SharedMarkupSession: JSON статической клавиатуры считается один раз и совпадает с обычным"""
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.methods import SendMessage
+
+import keyboards as kb
+
+
+def fields(form):
+    return {options["name"]: value for options, _, value in form._fields}
+
+
+def test_static_markup_is_serialized_once():
+    bot = Bot("1:test")
+    plain, shared = AiohttpSession(), kb.SharedMarkupSession()
+    method = SendMessage(chat_id=1, text="Меню", reply_markup=kb.main_menu())
+
+    first = fields(shared.build_form_data(bot, method))
+    assert len(shared._serialized) == 1
+    second = fields(shared.build_form_data(bot, method))
+    assert len(shared._serialized) == 1
+    assert first == second == fields(plain.build_form_data(bot, method))
+    assert first["reply_markup"] is shared._serialized[id(kb.main_menu())]
+
+
+def test_dynamic_markup_is_not_cached():
+    bot = Bot("1:test")
+    plain, shared = AiohttpSession(), kb.SharedMarkupSession()
+    method = SendMessage(chat_id=1, text="Оцените", reply_markup=kb.rating_keyboard(42))
+
+    assert fields(shared.build_form_data(bot, method)) == fields(plain.build_form_data(bot, method))
+    assert not shared._serialized
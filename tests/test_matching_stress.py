@@ -0,0 +1,105 @@
+"""Тысячи одновременных нажатий search/stop/cancel/start по нескольким сотням пользователей:
+после них очередь, чаты, онлайн и открытые чаты в БД должны сходиться"""
+import asyncio
+import random
+from collections import Counter
+from contextlib import asynccontextmanager
+
+from conftest import run, FakeCallback, FakeMessage, FakeState
+from locks import ShardedLock
+
+USERS = 200
+TAPS = 1000
+FIRST_ID = 100000
+DISTRICTS = 3
+
+
+class YieldingLock(ShardedLock):
+    """Перед захватом отдает управление: другие нажатия успевают вклиниться
+    между поиском собеседника и замком, как при занятом шарде в проде"""
+
+    @asynccontextmanager
+    async def hold(self, *keys):
+        await asyncio.sleep(0)
+        async with super().hold(*keys):
+            yield
+
+
+def check_invariants(bot):
+    waiting = set(bot.waiting_users)
+    in_chat = set(bot.sessions.users())
+    assert not waiting & in_chat, "пользователь одновременно в очереди и в чате"
+
+    for user_id in in_chat:
+        session = bot.sessions.get(user_id)
+        partner_id = session.partner_of(user_id)
+        assert partner_id != user_id
+        assert bot.sessions.get(partner_id) is session, "чат несимметричен"
+        assert {session.user1_id, session.user2_id} == {user_id, partner_id}
+
+    online = waiting | in_chat
+    assert len(bot.online) == len(online)
+    assert all(user_id in bot.online for user_id in online)
+    districts = bot.db.get_districts(list(online))
+    assert bot.online.by_district() == dict(Counter(districts.values()))
+
+    live = {session.chat_id for session in bot.sessions.sessions()}
+    assert set(bot.db.get_open_chats()) == live, "открытые чаты в БД расходятся с живыми"
+
+
+async def tap(bot, user_id, action):
+    """Нажатие идет через настоящие обработчики: /start или кнопку через handle_all_callbacks"""
+    # Как UserSerializeMiddleware: апдейты одного пользователя идут по очереди
+    async with bot.user_locks.hold(user_id):
+        await asyncio.sleep(0)
+        if action == "start":
+            await bot.cmd_start(FakeMessage(user_id, "/start"), FakeState())
+        else:
+            await bot.handle_all_callbacks(FakeCallback(user_id, action), FakeState())
+
+
+def test_concurrent_taps_keep_state_consistent(botstate):
+    bot = botstate
+    bot.match_locks = YieldingLock()
+    random.seed(26)
+    districts = bot.TYUMEN_DISTRICTS[:DISTRICTS]
+    users = list(range(FIRST_ID, FIRST_ID + USERS))
+    for i, user_id in enumerate(users):
+        bot.db.add_user(user_id, f"user{i}", districts[i % DISTRICTS])
+    for user_id in random.sample(users, 20):
+        bot.db.add_to_blacklist(user_id, random.choice(users))
+
+    actions = ["search_all"] * 4 + ["search_district"] + ["stop"] * 2 + ["cancel_search", "start"]
+
+    async def storm():
+        # Двойные нажатия: один и тот же пользователь часто попадает в выборку несколько раз подряд
+        await asyncio.gather(*(tap(bot, random.choice(users), random.choice(actions)) for _ in range(TAPS)))
+
+    run(storm())
+    check_invariants(bot)
+    assert len(bot.sessions) > 0
+
+    # Все завершают чаты и выходят из очереди — ничего не должно остаться
+    async def drain():
+        await asyncio.gather(*(tap(bot, user_id, "stop") for user_id in users))
+
+    run(drain())
+    check_invariants(bot)
+    assert not bot.waiting_users and not len(bot.sessions) and not len(bot.online)
+
+
+def test_simultaneous_searches_pair_up(botstate):
+    """Двое нажали «Поиск» одновременно: оба видят пустую очередь, но встать в нее должен один"""
+    bot = botstate
+    bot.match_locks = YieldingLock()
+    first, second = FIRST_ID + USERS, FIRST_ID + USERS + 1
+    for user_id in (first, second):
+        bot.db.add_user(user_id, f"user{user_id}", bot.TYUMEN_DISTRICTS[0])
+
+    async def both():
+        await asyncio.gather(tap(bot, first, "search_all"), tap(bot, second, "search_all"))
+
+    run(both())
+    check_invariants(bot)
+    assert not bot.waiting_users
+    assert bot.sessions.partner_of(first) == second
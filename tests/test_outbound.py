@@ -0,0 +1,49 @@
+"""OutboundScheduler.stop(): ни один ждущий отправку обработчик не остается висеть"""
+import asyncio
+
+import pytest
+
+from conftest import run
+from outbound import OutboundScheduler
+
+
+def test_stop_cancels_queued_and_inflight_sends():
+    async def main():
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=100, chat_burst=100)
+        scheduler.start()
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.Event().wait()
+
+        async def quick():
+            return "ok"
+
+        # Очередь получателя FIFO: второй запрос ждет, пока первый «в полете»
+        inflight = scheduler.submit(1, hang)
+        queued = scheduler.submit(1, quick)
+        await started.wait()
+        await scheduler.stop()
+
+        for future in (inflight, queued):
+            with pytest.raises(asyncio.CancelledError):
+                await asyncio.wait_for(future, 1)
+        assert not scheduler.running and scheduler.queue_depth() == 0
+
+    run(main())
+
+
+def test_sends_complete_before_stop():
+    async def main():
+        scheduler = OutboundScheduler(global_rate=100, chat_rate=100, chat_burst=100)
+        scheduler.start()
+
+        async def quick():
+            return "ok"
+
+        assert await asyncio.wait_for(scheduler.submit(1, quick), 1) == "ok"
+        await scheduler.stop()
+        await scheduler.stop()
+
+    run(main())
@@ -0,0 +1,61 @@
+"""Keyset-страницы админки: каждая строка ровно один раз, пока данные меняются под курсором"""
+from database import Database
+from pagination import fetch_page, encode_cursor, decode_cursor
+
+DISTRICT = "🏛️ Центральный"
+
+
+def walk(fetch, size, key):
+    """Листает вперед до конца, затем назад до начала; курсор ходит через callback data"""
+    forward, cursor = [], None
+    while True:
+        page = fetch_page(fetch, cursor, "n", size, key)
+        forward.append([row["user_id"] for row in page.rows])
+        if not page.has_next:
+            break
+        cursor = decode_cursor(encode_cursor(page.last))
+    backward = []
+    cursor = decode_cursor(encode_cursor(page.first))
+    while page.has_prev:
+        page = fetch_page(fetch, cursor, "p", size, key)
+        backward.append([row["user_id"] for row in page.rows])
+        cursor = decode_cursor(encode_cursor(page.first))
+    return forward, backward
+
+
+def test_district_pages_survive_activity_updates(tmp_path):
+    db = Database(str(tmp_path / "pages.db"))
+    users = list(range(1, 24))
+    for user_id in users:
+        db.add_user(user_id, f"user{user_id}", DISTRICT)
+
+    def fetch(key, forward, limit):
+        rows = db.get_users_by_district(DISTRICT, key, forward, limit)
+        # Пока админ смотрит страницу, показанные пользователи пишут сообщения
+        for row in rows:
+            db.update_user_activity(row["user_id"])
+        return rows
+
+    forward, _ = walk(fetch, 5, lambda u: (u["id"],))
+    seen = [uid for page in forward for uid in page]
+    assert sorted(seen) == users, "строки повторились или пропали"
+    assert seen == sorted(seen, reverse=True), "новые сверху"
+
+
+def test_ban_pages_with_null_ban_date(tmp_path):
+    db = Database(str(tmp_path / "pages.db"))
+    users = list(range(1, 12))
+    for user_id in users:
+        db.add_user(user_id, f"user{user_id}", DISTRICT)
+        db.ban_user(user_id, "спам")
+    # Старые баны без даты
+    conn = db.get_connection()
+    conn.execute("UPDATE ratings SET ban_date = NULL WHERE user_id <= 6")
+    conn.commit()
+    conn.close()
+
+    forward, backward = walk(db.get_banned_users, 3, lambda u: (u["ban_date"], u["user_id"]))
+    seen = [uid for page in forward for uid in page]
+    assert sorted(seen) == users
+    assert len(seen) == len(set(seen))
+    assert sorted(uid for page in backward for uid in page) == sorted(set(seen) - set(forward[-1]))
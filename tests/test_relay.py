@@ -0,0 +1,111 @@
+"""Relay: альбомы и фоновые задачи пересылки"""
+import asyncio
+import logging
+from types import SimpleNamespace
+
+from conftest import run, FakeState
+from flood import FloodControl
+from relay import Relay, MEDIA_CAPTIONS
+from sessions import SessionStore
+
+USER, PARTNER = 1, 2
+
+
+class FakeBot:
+    def __init__(self):
+        self.albums = []
+        self.actions = []
+
+    async def send_media_group(self, chat_id, media):
+        self.albums.append((chat_id, media))
+
+    async def send_chat_action(self, chat_id, action):
+        self.actions.append((chat_id, action))
+
+    async def send_message(self, chat_id, text, **kwargs):
+        pass
+
+
+class MemoryDb:
+    def save_message(self, *row):
+        pass
+
+    def save_messages(self, rows):
+        pass
+
+
+class FailingDb:
+    def save_messages(self, rows):
+        raise RuntimeError("база недоступна")
+
+
+def photo(message_id, group):
+    message = SimpleNamespace(**dict.fromkeys(MEDIA_CAPTIONS), text=None, caption=None,
+                              media_group_id=group, message_id=message_id, chat=SimpleNamespace(id=USER))
+    message.photo = [SimpleNamespace(file_id=f"file{message_id}")]
+    return message
+
+
+def make_relay(bot, db):
+    sessions = SessionStore()
+    sessions.open(USER, PARTNER, "1_2_0", "Волк", "Лис", "Центральный", nick1="Волк", nick2="Лис")
+    return Relay(bot, db, sessions, album_window=0.01), sessions.get(USER)
+
+
+def test_album_flush_error_is_logged(caplog):
+    async def main():
+        relay, session = make_relay(FakeBot(), FailingDb())
+        await relay.relay(photo(1, "g"), session, USER, "Волк")
+        await asyncio.sleep(0.05)
+        assert not relay._tasks
+
+    with caplog.at_level(logging.ERROR, logger="relay"):
+        run(main())
+    assert any("база недоступна" in str(r.exc_info[1]) for r in caplog.records if r.exc_info)
+
+
+def test_chat_action_only_for_buffered_album():
+    async def main():
+        bot = FakeBot()
+        relay, session = make_relay(bot, MemoryDb())
+        for i in range(3):
+            text = SimpleNamespace(text=f"привет {i}", media_group_id=None)
+            await relay.relay(text, session, USER, "Волк")
+        await asyncio.sleep(0)
+        assert not bot.actions
+
+        for i in range(3):
+            await relay.relay(photo(i, "g"), session, USER, "Волк")
+        await asyncio.sleep(0.05)
+        assert bot.actions == [(PARTNER, "upload_photo")]
+        assert len(bot.albums) == 1
+
+    run(main())
+
+
+def test_ten_photo_album_is_relayed_in_full(botstate, monkeypatch):
+    """Альбом больше FLOOD_BURST частей проходит антифлуд целиком: он стоит один жетон"""
+    bot = botstate
+    user_id, partner_id = 400001, 400002
+    for uid in (user_id, partner_id):
+        bot.db.add_user(uid, f"user{uid}", bot.TYUMEN_DISTRICTS[0])
+    bot.open_chat(bot.db.get_user(user_id), bot.db.get_user(partner_id), bot.db)
+    fake = FakeBot()
+    monkeypatch.setattr(bot.bot, "send_media_group", fake.send_media_group, raising=False)
+    monkeypatch.setattr(bot.bot, "send_chat_action", fake.send_chat_action, raising=False)
+    monkeypatch.setattr(bot.chat_relay, "album_window", 0.01)
+    monkeypatch.setattr(bot, "flood", FloodControl(bot.FLOOD_BURST, bot.FLOOD_RATE))
+    assert bot.FLOOD_BURST < 10
+
+    async def main():
+        for i in range(10):
+            message = photo(i, "album")
+            message.from_user = SimpleNamespace(id=user_id, username=None, first_name="Волк")
+            message.chat = SimpleNamespace(id=user_id)
+            await bot.handle_messages(message, FakeState())
+        await asyncio.sleep(0.05)
+
+    run(main())
+    (chat_id, media), = fake.albums
+    assert chat_id == partner_id and len(media) == 10
+    assert not bot.bot.send_message, "антифлуд не должен был ничего сказать"
@@ -0,0 +1,73 @@
+"""Webhook бота: секрет одинаков у всех процессов, чужие запросы отбиваются"""
+import asyncio
+import hashlib
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from conftest import run
+from cluster import Cluster, LocalBus, shard_channel, shard_of
+
+
+def test_secret_is_stable_without_config(botmod, monkeypatch):
+    monkeypatch.setattr(botmod, "WEBHOOK_SECRET", "")
+    secret = botmod.webhook_secret()
+    assert secret == botmod.webhook_secret()
+    assert secret == hashlib.sha256(f"webhook:{botmod.BOT_TOKEN}".encode()).hexdigest()
+
+    monkeypatch.setattr(botmod, "WEBHOOK_SECRET", "configured")
+    assert botmod.webhook_secret() == "configured"
+
+
+@pytest.mark.filterwarnings("ignore:Detected unknown update type")
+def test_webhook_checks_secret(botmod):
+    secret = botmod.webhook_secret()
+
+    async def post(token):
+        async with TestClient(TestServer(botmod.webhook_app(secret))) as client:
+            # Апдейт без события: диспетчеру нечего обрабатывать, проверяется только прием
+            response = await client.post(botmod.WEBHOOK_PATH, json={"update_id": 1},
+                                         headers={"X-Telegram-Bot-Api-Secret-Token": token})
+            return response.status
+
+    assert run(post("wrong")) == 401
+    assert run(post(secret)) == 200
+
+
+@pytest.mark.filterwarnings("ignore:Detected unknown update type")
+def test_router_forwards_raw_update(botmod, monkeypatch):
+    """Роутер отдает шарду тело апдейта как пришло; апдейт без пользователя обрабатывает сам"""
+    secret = botmod.webhook_secret()
+    bus = LocalBus()
+    monkeypatch.setattr(botmod, "ROLE", "router")
+    monkeypatch.setattr(botmod, "cluster", Cluster(bus, 2))
+    received = {0: [], 1: []}
+
+    def recorder(shard):
+        async def handle(message):
+            received[shard].append(message)
+        return handle
+
+    for shard in received:
+        bus.subscribe(shard_channel(shard), recorder(shard))
+    user_id = 600001
+    update = {"update_id": 7, "message": {
+        "message_id": 1, "date": 1700000000, "text": "привет",
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Волк"},
+    }}
+
+    async def main():
+        await botmod.cluster.start()
+        async with TestClient(TestServer(botmod.webhook_app(secret))) as client:
+            headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+            assert (await client.post(botmod.WEBHOOK_PATH, json=update, headers=headers)).status == 200
+            assert (await client.post(botmod.WEBHOOK_PATH, json=update, headers={})).status == 401
+            assert (await client.post(botmod.WEBHOOK_PATH, json={"update_id": 8}, headers=headers)).status == 200
+        while botmod.shard_tasks:
+            await asyncio.sleep(0)
+        await botmod.cluster.stop()
+
+    run(main())
+    assert received[shard_of(user_id, 2)] == [{"op": "update", "update": update}]
+    assert not received[1 - shard_of(user_id, 2)]
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+
+from cache import BoundedDict
+
+logger = logging.getLogger(__name__)
+
+
+class UsernameResolver:
+    """Username пользователей для админки: память -> таблица usernames -> get_chat.
+    Большинство имен приходит даром из апдейтов (remember), get_chat только для промахов"""
+
+    def __init__(self, bot, db, reachability, ttl=24 * 3600, concurrency=5, maxlen=10000):
+        self.bot = bot
+        self.db = db
+        self.reachability = reachability
+        self.ttl = ttl
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # user_id -> (username или None, когда получен)
+        self._cache = BoundedDict(maxlen)
+
+    def remember(self, user_id, username):
+        """Пассивно запоминает username из апдейта; в БД пишет только изменения"""
+        now = time.time()
+        cached = self._cache.get(user_id)
+        if cached is not None and cached[0] == username and now - cached[1] < self.ttl / 2:
+            return
+        self._cache[user_id] = (username, now)
+        self.db.save_usernames([(user_id, username, now)])
+
+    async def _fetch(self, user_id):
+        async with self._semaphore:
+            try:
+                chat = await self.bot.get_chat(user_id)
+                return user_id, chat.username, True
+            except Exception as e:
+                logger.debug(f"get_chat({user_id}) не удался: {e}")
+                return user_id, None, False
+
+    async def resolve_many(self, user_ids):
+        """{user_id: username или None} одним запросом к БД и параллельными get_chat для промахов"""
+        now = time.time()
+        result = {}
+        missing = []
+        for uid in dict.fromkeys(user_ids):
+            cached = self._cache.get(uid)
+            if cached is not None and now - cached[1] < self.ttl:
+                result[uid] = cached[0]
+            else:
+                missing.append(uid)
+
+        if missing:
+            stored = self.db.get_usernames(missing)
+            fetch = []
+            for uid in missing:
+                row = stored.get(uid)
+                if row is not None and now - row[1] < self.ttl:
+                    self._cache[uid] = row
+                    result[uid] = row[0]
+                elif uid in self.reachability:
+                    # get_chat для недоступных все равно не ответит — отдаем что есть
+                    result[uid] = row[0] if row else None
+                else:
+                    fetch.append(uid)
+
+            if fetch:
+                rows = []
+                for uid, username, ok in await asyncio.gather(*(self._fetch(uid) for uid in fetch)):
+                    if ok:
+                        self._cache[uid] = (username, now)
+                        rows.append((uid, username, now))
+                    else:
+                        # Ошибка не значит «нет username»: не кешируем, берем устаревшее из БД
+                        username = stored[uid][0] if uid in stored else None
+                    result[uid] = username
+                if rows:
+                    self.db.save_usernames(rows)
+        return result
+
+    async def resolve(self, user_id):
+        return (await self.resolve_many([user_id]))[user_id]
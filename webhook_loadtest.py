@@ -0,0 +1,98 @@
+"""Нагрузочный тест webhook: синтетические апдейты POST-ом на эндпоинт, пропускная способность и задержки.
+
+    python webhook_loadtest.py                      # локально: SimpleRequestHandler с пустым диспетчером
+    python webhook_loadtest.py --url https://bot.example.com/webhook --secret ...
+
+Локальный режим меряет сам прием апдейта (HTTP, проверка секрета, разбор Update),
+без обработчиков бота. На боевом адресе апдейты обрабатываются по-настоящему:
+пользователи выдуманные, отправки им будут падать — запускайте на тестовом боте"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from aiohttp import ClientSession, TCPConnector, web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+
+FIRST_USER_ID = 900000000
+
+
+def make_update(i, users=1000):
+    user_id = FIRST_USER_ID + i % users
+    user = {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}"}
+    return {
+        "update_id": i + 1,
+        "message": {
+            "message_id": i + 1,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": f"сообщение {i}",
+        },
+    }
+
+
+async def local_endpoint(secret, path="/webhook", port=8099):
+    """Сервер как в run_webhook, но с пустым диспетчером и без Telegram"""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=Dispatcher(), bot=Bot("1:loadtest"), secret_token=secret).register(app, path=path)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, f"http://127.0.0.1:{port}{path}"
+
+
+async def load(url, secret, total, concurrency, users):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret}
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker(session):
+        nonlocal errors
+        for i in counter:
+            started = time.perf_counter()
+            async with session.post(url, json=make_update(i, users), headers=headers) as response:
+                await response.read()
+                if response.status != 200:
+                    errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    async with ClientSession(connector=TCPConnector(limit=concurrency)) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return elapsed, sorted(latencies), errors
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="адрес webhook; без него поднимается локальный сервер")
+    parser.add_argument("--secret", default="loadtest", help="X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--users", type=int, default=1000, help="сколько разных отправителей")
+    args = parser.parse_args()
+
+    runner = None
+    url = args.url
+    if url is None:
+        runner, url = await local_endpoint(args.secret)
+    try:
+        elapsed, latencies, errors = await load(url, args.secret, args.updates, args.concurrency, args.users)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    print(f"{args.updates} апдейтов, {args.concurrency} соединений: {elapsed:.2f} с, "
+          f"{args.updates / elapsed:.0f} апдейтов/с, ошибок: {errors}")
+    print(f"задержка, мс: p50 {percentile(0.5):.1f}, p95 {percentile(0.95):.1f}, "
+          f"p99 {percentile(0.99):.1f}, среднее {statistics.mean(latencies) * 1000:.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())